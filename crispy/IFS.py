@@ -13,17 +13,31 @@ try:
     from astropy.io import fits as pyf
 except BaseException:
     import pyfits as pyf
+import os
+import copy
 import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import matplotlib.pyplot as plt
-from crispy.tools.image import Image
-from crispy.tools.lenslet import processImagePlane, propagateLenslets
+from crispy.tools.image import Image, writeSlices
+from crispy.tools.lenslet import processImagePlane, processImageCube, propagateLenslets, \
+    subWavelengthCounts, activeLenslets, lensletGrid, addStamps, loadPSFLetPositions, \
+    lensletLocations
+from crispy.tools.transfer import getTransferOperator, transferSlice
 from crispy.tools.spectrograph import createAllWeightsArray, selectKernel, loadKernels
-from crispy.tools.detector import rebinDetector
+from crispy.tools.detutils import getDtype
+from crispy.tools.calibration import loadLamsol
 from crispy.tools.plotting import plotKernels
 from crispy.tools.reduction import testReduction, lstsqExtract, intOptimalExtract
 import multiprocessing
-from crispy.tools.par_utils import Task, Consumer
+from crispy.tools.par_utils import Task, Consumer, threadMap
+from crispy.tools.tiling import makeTileJobs, runTileJob, writeTileJobs, tileWorker, \
+    gatherTileJobs, lensletExtents
 from crispy.tools.wavecal import get_sim_hires
+from crispy.tools.templates import templateCache
 from scipy.interpolate import interp1d
 import glob
 import astropy.units as u
@@ -52,6 +66,118 @@ from crispy.tools.initLogger import getLogger
 log = getLogger('crispy')
 
 
+def loadTemplates(par, lam_arr=None):
+    '''
+    Loads the PSFLet templates used by polychromeIFS
+
+    Parameters
+    ----------
+    par :   Parameter instance
+            with at least the key IFS parameters, interlacing and scale
+    lam_arr: list of floats
+            Wavelengths of the templates. Read from the wavelength solution
+            in par.wavecalDir if left to None
+
+    Returns
+    -------
+    hires_arrs: list of 4D ndarrays
+            Oversampled PSFLet templates, simulated Gaussians if par.gaussian,
+            with the floating-point type set by par.precision
+    lam_arr: 1D array
+            Wavelengths corresponding to hires_arrs
+    '''
+    # lam_arr needs to be provided the first time you create monochromatic
+    # flats!
+    if lam_arr is None:
+        lam_arr = loadLamsol(par)[:, 0]
+
+    hires_arrs = []
+    if par.gaussian:
+        for i in range(len(lam_arr)):
+            hiresarr = get_sim_hires(par, lam_arr[i])
+            hires_arrs += [hiresarr]
+        log.info('Creating Gaussian PSFLet templates')
+    else:
+        try:
+            hires_list = np.sort(
+                glob.glob(
+                    par.wavecalDir +
+                    'hires_psflets_lam???.fits'))
+            hires_arrs = [pyf.getdata(filename) for filename in hires_list]
+            log.info('Loaded PSFLet templates')
+        except BaseException:
+            log.error('Failed loading the PSFLet templates')
+            raise
+    dtype = getDtype(par)
+    hires_arrs = [arr.astype(dtype) for arr in hires_arrs]
+    return hires_arrs, lam_arr
+
+
+def startWorkers(ncpus=None):
+    '''
+    Starts one Consumer process per CPU
+
+    Returns
+    -------
+    workers: tuple
+            Task queue, result queue and list of Consumer processes
+    '''
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    if ncpus is None:
+        ncpus = multiprocessing.cpu_count()
+    consumers = [Consumer(tasks, results)
+                 for i in range(ncpus)]
+    for w in consumers:
+        w.start()
+    return tasks, results, consumers
+
+
+def stopWorkers(workers):
+    '''
+    Sends a poison pill to each of the workers started by startWorkers
+    '''
+    tasks, results, consumers = workers
+    for i in range(len(consumers)):
+        tasks.put(None)
+
+
+def binEndpoints(waveList, wavelist_endpts=None, dlambda=None):
+    '''
+    Endpoints of the wavelength bins of an input cube, see polychromeIFS
+
+    Parameters
+    ----------
+    waveList: 1D array
+            Wavelengths in nm of the center of each bin
+    wavelist_endpts: 1D array
+            Endpoints of the bins, returned unchanged if set
+    dlambda: float
+            Width of the bin in nm when there is a single wavelength
+
+    Returns
+    -------
+    wavelist_endpts: 1D array
+            Endpoints of the bins, one longer than waveList
+    '''
+    if wavelist_endpts is None:
+        log.warning('Assuming slices are evenly spread in wavelengths')
+        if len(waveList) > 1:
+            dlam = waveList[1] - waveList[0]
+            wavelist_endpts = np.zeros(len(waveList) + 1)
+            wavelist_endpts[:-1] = waveList - dlam / 2.
+            wavelist_endpts[-1] = waveList[-1] + dlam / 2.
+        else:
+            if dlambda is None:
+                log.error('No bandwidth specified')
+            else:
+                wavelist_endpts = np.array(
+                    [waveList[0] - dlambda / 2., waveList[0] + dlambda / 2.])
+    else:
+        log.warning('Assuming endpoints wavelist is given')
+    return wavelist_endpts
+
+
 def polychromeIFS(par, inWavelist, inputcube,
                   name='detectorFrame',
                   parallel=True,
@@ -65,7 +191,15 @@ def polychromeIFS(par, inWavelist, inputcube,
                   upsample=3, # need to make this part of the header in the templates
                   npix=13,
                   nlam=10,
-                  order=3
+                  order=3,
+                  transfer=False,
+                  transferDir=None,
+                  nthreads=None,
+                  hires_arrs=None,
+                  workers=None,
+                  fluxThreshold=0.0,
+                  tiles=None,
+                  tileDir=None
                   ):
     '''
     Propagates an input cube through the Integral Field Spectrograph
@@ -81,8 +215,11 @@ def polychromeIFS(par, inWavelist, inputcube,
             header needs to contain the 'PIXSIZE' and 'LAM_C' keywords
     name: string
             Name of the output file (without .fits extension)
-    parallel: boolean
-            Whether to use parallel computing for this (recommended)
+    parallel: boolean or 'threads'
+            Whether to use parallel computing for this (recommended). True uses one process per CPU
+            and one wavelength slice per task. 'threads' keeps everything in this process and uses a
+            pool of threads sharing the templates and output arrays: wavelength slices are split among
+            the threads, or the lenslets of each slice if there are fewer slices than threads.
     QE: boolean
             Whether to take into account wavelength-dependent detector QE (from file defined in par.QE)
     wavelist_endpts: list of floats
@@ -99,11 +236,54 @@ def polychromeIFS(par, inWavelist, inputcube,
     noRot: boolean
         A rarely used option that allows to NOT rotate the input cube, if we want to simulate sending
         a input map aligned with the lenslets
+    transfer: boolean
+        If True, propagate the cube with a precomputed sparse transfer operator (see tools.transfer).
+        The operator is built the first time and saved, so that later simulations with the same
+        parameters, templates and wavelength bins reduce to a sparse matrix-vector product.
+    transferDir: string
+        Directory in which the transfer operators are stored. Defaults to par.wavecalDir
+    nthreads: int
+        Number of threads used when parallel='threads'. Defaults to the number of CPUs
+    nlam: int
+        Number of sub-wavelengths used to sample each bin. If par.lamtol is set, the number
+        is instead chosen for each bin so that no PSFLet moves by more than par.lamtol
+        detector pixels between sub-wavelengths. It is recorded in the header.
+    hires_arrs: list of 4D ndarrays
+        PSFLet templates corresponding to lam_arr, as returned by loadTemplates. They are
+        loaded from par.wavecalDir if left to None. If par.gaussian is True, the PSFLets are
+        computed in closed form and templates are only used with transfer=True
+    workers: tuple
+        Already running worker processes, as returned by startWorkers, to use when
+        parallel=True instead of starting new ones. They are left running.
+    fluxThreshold: float
+        Lenslets whose flux never exceeds fluxThreshold times that of the brightest lenslet
+        of the cube are not propagated (see lenslet.activeLenslets). The list of lenslets is
+        computed once for the cube, and the fraction of the flux that is dropped is logged
+        and recorded in the header. Coronagraphic or planet-only scenes, where most lenslets
+        are dark, then only cost as much as their bright lenslets.
+    tiles: int or tuple
+        If set, split the detector into tiles x tiles (or ny x nx) tiles, each computed
+        independently from the lenslets that overlap it (see tools.tiling), instead of
+        splitting the work by wavelength. The tiles are run according to parallel, or
+        through tileDir.
+    tileDir: string
+        Directory on a shared filesystem to which the tile jobs are written when tiles is
+        set. They are run by this process and by any worker started with
+        "python -m crispy.tools.tiling tileDir" on other machines, then stitched together.
 
     Returns
     -------
     detectorFrame : 2D array
             Return the detector frame
+
+    Notes
+    -----
+    With par.precision = 'float32', templates, stamps and slices are computed in single
+    precision, and the slices are accumulated into the detector frame in double precision.
+
+    With par.pxperdetpix > 1, the PSFLets are integrated over par.pxperdetpix x par.pxperdetpix
+    points of each detector pixel while they are stamped (see lenslet.propagateLenslets), so
+    all the arrays, including the saved slices, stay at the detector resolution.
     '''
     
     
@@ -149,6 +329,12 @@ def polychromeIFS(par, inWavelist, inputcube,
          'Factor by which the input slice is rescaled'),
         end=True)
 
+    par.hdr.append(
+        ('PRECISN',
+         np.dtype(getDtype(par)).name,
+         'Floating-point type of the simulation'),
+        end=True)
+
     nframes = inputcube.data.shape[0]
     allweights = None
 
@@ -172,115 +358,185 @@ def polychromeIFS(par, inWavelist, inputcube,
         log.info('Using PSFlet gaussian approximation')
 
     ######################################################################
-    # Allocate arrays, make sure you have abundant memory
+    # Allocate arrays. Each slice is added to the detector frame as soon
+    # as it is computed. Slices are only kept if par.savePoly, in a
+    # memory-mapped file, so memory does not scale with the number of slices
     ######################################################################
-    finalFrame = np.zeros(
-        (par.npix * par.pxperdetpix,
-         par.npix * par.pxperdetpix))
-    polyimage = np.zeros(
-        (len(waveList),
-         par.npix *
-         par.pxperdetpix,
-         par.npix *
-         par.pxperdetpix))
+    finalFrame = np.zeros((par.npix, par.npix))
+    polyimage = None
+    if par.savePoly:
+        polyfile = par.exportDir + '/' + name + 'poly.npy'
+        polyimage = np.lib.format.open_memmap(
+            polyfile, mode='w+', dtype=np.float32,
+            shape=(len(waveList),) + finalFrame.shape)
+    lock = threading.Lock()
+
+    def _addSlice(i, poly):
+        if polyimage is not None:
+            polyimage[i] = poly
+        with lock:
+            finalFrame[:] += poly
+
+    def _addTile(tile, stack):
+        y1, y2, x1, x2 = tile
+        if polyimage is not None:
+            polyimage[:, y1:y2, x1:x2] = stack
+        finalFrame[y1:y2, x1:x2] += np.sum(stack, axis=0, dtype=finalFrame.dtype)
 
     ######################################################################
     # Determine wavelength endpoints
     ######################################################################
-    if wavelist_endpts is None:
-        log.warning('Assuming slices are evenly spread in wavelengths')
-        if len(waveList) > 1:
-            dlam = waveList[1] - waveList[0]
-            wavelist_endpts = np.zeros(len(waveList) + 1)
-            wavelist_endpts[:-1] = waveList - dlam / 2.
-            wavelist_endpts[-1] = waveList[-1] + dlam / 2.
-        else:
-            if dlambda is None:
-                log.error('No bandwidth specified')
-            else:
-                wavelist_endpts = np.array(
-                    [waveList[0] - dlambda / 2., waveList[0] + dlambda / 2.])
-    else:
-        log.warning('Assuming endpoints wavelist is given')
-#     print wavelist_endpts
+    wavelist_endpts = binEndpoints(waveList, wavelist_endpts, dlambda)
 
     ######################################################################
     # Load template PSFLets
     ######################################################################
-    # lam_arr needs to be provided the first time you create monochromatic
-    # flats!
-    if lam_arr is None:
-        lam_arr = np.loadtxt(par.wavecalDir + "lamsol.dat")[:, 0]
-
-    hires_arrs = []
+    # Gaussian PSFLets are computed in closed form by propagateLenslets,
+    # templates are only needed to build the transfer operator
+    if hires_arrs is None and (transfer or not par.gaussian):
+        hires_arrs, lam_arr = loadTemplates(par, lam_arr)
     if par.gaussian:
-        for i in range(len(lam_arr)):
-            hiresarr = get_sim_hires(par, lam_arr[i])
-            hires_arrs += [hiresarr]
-        log.info('Creating Gaussian PSFLet templates')
-        upsample=10
-    else:
-        try:
-            hires_list = np.sort(
-                glob.glob(
-                    par.wavecalDir +
-                    'hires_psflets_lam???.fits'))
-            hires_arrs = [pyf.getdata(filename) for filename in hires_list]
-            log.info('Loaded PSFLet templates')
-        except BaseException:
-            log.error('Failed loading the PSFLet templates')
-            raise
+        upsample = 10
 
-    inputCube = []
+    ######################################################################
+    # Rotate and rebin all the slices on the lenslet array at once, and
+    # multiply them by their bandwidth
+    ######################################################################
+    inputCube = processImageCube(par, interpolatedInputCube.data, noRot)
+    inputCube *= np.diff(wavelist_endpts)[:, np.newaxis, np.newaxis]
 
-    if not parallel:
+    ######################################################################
+    # Lenslets that are bright enough in at least one slice. All the
+    # wavelengths are propagated from this compact index
+    ######################################################################
+    lenslets, dropped = activeLenslets(inputCube, fluxThreshold)
+    log.info('Propagating %d lenslets, dropping %.3g of the flux' %
+             (len(lenslets), dropped))
+    par.hdr.append(('NACTIVE', len(lenslets), 'Number of lenslets propagated'), end=True)
+    par.hdr.append(('FLUXDROP', dropped, 'Fraction of the flux in culled lenslets'), end=True)
+    if transfer and fluxThreshold > 0:
+        # the transfer operator covers all the lenslets, so cull the input instead
+        planeindx = lensletGrid(inputCube[0].shape)[3]
+        keep = np.zeros(inputCube[0].size, dtype=bool)
+        keep[planeindx[lenslets]] = True
+        inputCube *= np.reshape(keep, inputCube[0].shape)
+
+    ######################################################################
+    # Number of sub-wavelengths in each bin, fixed or chosen from the
+    # PSFLet motion across the bin if par.lamtol is set
+    ######################################################################
+    lamtol = getattr(par, 'lamtol', None)
+    nlams = subWavelengthCounts(par, inputCube[0].shape, wavelist_endpts,
+                                lamtol, nlam, order, dx)
+    if lamtol is None:
+        par.hdr.append(('NLAM', nlam, 'Sub-wavelengths per bin'), end=True)
+    else:
+        log.info('Sub-wavelengths per bin: ' + ' '.join(['%d' % n for n in nlams]))
+        par.hdr.append(('LAMTOL', lamtol, 'Max PSFLet shift between sub-wavelengths (px)'),
+                       end=True)
+        for i in range(len(nlams)):
+            par.hdr.append(('NLAM%03d' % i, nlams[i], 'Sub-wavelengths in bin %d' % i),
+                           end=True)
+
+    if transfer:
+        operator = getTransferOperator(par, inputCube[0].shape, wavelist_endpts,
+                                       hires_arrs, lam_arr, upsample,
+                                       nlam if lamtol is None else nlams,
+                                       npix, order, dx, outdir=transferDir)
         for i in range(len(waveList)):
-            imagePlaneRot = (wavelist_endpts[i + 1] - wavelist_endpts[i]) * \
-                processImagePlane(par, interpolatedInputCube.data[i], noRot)
-            inputCube += [imagePlaneRot]
-            polyimage[i] = propagateLenslets(par,
-                                             imagePlaneRot,
-                                             wavelist_endpts[i],
-                                             wavelist_endpts[i + 1],
-                                             hires_arrs,
-                                             lam_arr,
-                                             upsample,
-                                             nlam,
-                                             npix,
-                                             order,
-                                             dx)
+            _addSlice(i, transferSlice(operator, inputCube[i], i,
+                                       len(waveList), par.npix))
+    elif tiles is not None:
+        common, jobs = makeTileJobs(par, inputCube, wavelist_endpts, tiles, lenslets,
+                                    hires_arrs, lam_arr, upsample, nlams, npix,
+                                    order, dx)
+        # the tiles do not overlap, so they can be added concurrently
+        def _propagateTile(job):
+            _addTile(job['tile'], runTileJob(common, job))
+
+        if tileDir is not None:
+            writeTileJobs(tileDir, common, jobs)
+            tileWorker(tileDir)
+            for job, stack in zip(jobs, gatherTileJobs(tileDir, len(jobs))):
+                _addTile(job['tile'], stack)
+        elif parallel == 'threads':
+            threadMap(_propagateTile, [(job,) for job in jobs], nthreads)
+        elif parallel:
+            if workers is None:
+                tasks, results, consumers = startWorkers()
+            else:
+                tasks, results, consumers = workers
+            for job in jobs:
+                tasks.put(Task(job['index'], runTileJob, (common, job)))
+            if workers is None:
+                stopWorkers((tasks, results, consumers))
+            for job in jobs:
+                index, stack = results.get()
+                _addTile(jobs[index]['tile'], stack)
+        else:
+            for job in jobs:
+                _propagateTile(job)
+    elif parallel == 'threads':
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+
+        def _propagateSlice(i, lensletThreads):
+            _addSlice(i, propagateLenslets(par, inputCube[i],
+                                           wavelist_endpts[i],
+                                           wavelist_endpts[i + 1],
+                                           hires_arrs, lam_arr, upsample,
+                                           nlams[i], npix, order, dx,
+                                           nthreads=lensletThreads,
+                                           lenslets=lenslets))
+
+        if len(waveList) >= nthreads:
+            threadMap(_propagateSlice,
+                      [(i, 1) for i in range(len(waveList))], nthreads)
+        else:
+            for i in range(len(waveList)):
+                _propagateSlice(i, nthreads)
+    elif not parallel:
+        for i in range(len(waveList)):
+            _addSlice(i, propagateLenslets(par,
+                                           inputCube[i],
+                                           wavelist_endpts[i],
+                                           wavelist_endpts[i + 1],
+                                           hires_arrs,
+                                           lam_arr,
+                                           upsample,
+                                           nlams[i],
+                                           npix,
+                                           order,
+                                           dx,
+                                           lenslets=lenslets))
     else:
-        tasks = multiprocessing.Queue()
-        results = multiprocessing.Queue()
-        ncpus = multiprocessing.cpu_count()
-        consumers = [Consumer(tasks, results)
-                     for i in range(ncpus)]
-        for w in consumers:
-            w.start()
+        if workers is None:
+            tasks, results, consumers = startWorkers()
+        else:
+            tasks, results, consumers = workers
 
         for i in range(len(waveList)):
-            imagePlaneRot = (wavelist_endpts[i + 1] - wavelist_endpts[i]) * \
-                processImagePlane(par, interpolatedInputCube.data[i], noRot)
-            inputCube += [imagePlaneRot]
             tasks.put(Task(i,
                            propagateLenslets,
                            (par,
-                            imagePlaneRot,
+                            inputCube[i],
                             wavelist_endpts[i],
                                wavelist_endpts[i + 1],
                                hires_arrs,
                                lam_arr,
                                upsample,
-                               nlam,
+                               nlams[i],
                                npix,
                                order,
-                               dx)))
+                               dx,
+                               1,
+                               lenslets)))
 
-        for i in range(ncpus):
-            tasks.put(None)
+        if workers is None:
+            stopWorkers((tasks, results, consumers))
         for i in range(len(waveList)):
             index, poly = results.get()
-            polyimage[index] = poly
+            _addSlice(index, poly)
 
     if par.saveRotatedInput:
         Image(
@@ -289,18 +545,15 @@ def polychromeIFS(par, inWavelist, inputcube,
             par.exportDir +
             '/imagePlaneRot.fits')
     if par.savePoly:
-        Image(
-            data=polyimage,
-            header=par.hdr).write(
-            par.exportDir +
-            '/' +
-            name +
-            'poly.fits')
-
-    detectorFrame = np.sum(polyimage, axis=0)
-
-    if par.pxperdetpix != 1.:
-        detectorFrame = rebinDetector(par, detectorFrame, clip=False)
+        polyimage.flush()
+        writeSlices(par.exportDir + '/' + name + 'poly.fits',
+                    polyimage, par.hdr)
+        polyimage = None
+        os.remove(polyfile)
+
+    # with par.pxperdetpix > 1 the pixel integration is already folded into
+    # the stamps, so the frame is at the detector resolution
+    detectorFrame = finalFrame.astype(getDtype(par))
     if par.saveDetector:
         Image(
             data=detectorFrame,
@@ -316,6 +569,276 @@ def polychromeIFS(par, inWavelist, inputcube,
     return detectorFrame
 
 
+def polychromeIFSBatch(par, inWavelist, cubes,
+                       name='detectorFrame',
+                       parallel=True,
+                       lam_arr=None,
+                       nthreads=None,
+                       savePoly=False,
+                       **kwargs):
+    '''
+    Propagates a series of input cubes through the Integral Field Spectrograph
+
+    The templates and the worker processes are set up once for the whole
+    series, so that the cost per cube reduces to the propagation itself.
+
+    Parameters
+    ----------
+    par :   Parameter instance
+            with at least the key IFS parameters, interlacing and scale
+    inWavelist : list of floats
+            List of wavelengths in nm corresponding to the center of each bin
+    cubes : list, generator or string
+            Input cubes (Image or HDU, see polychromeIFS), or name of a folder
+            from which all the FITS files are read in alphabetical order
+    name: string
+            Prefix of the output files. Frame i is named name_%04d % i
+    parallel: boolean or 'threads'
+            See polychromeIFS
+    lam_arr: list of floats
+            See polychromeIFS
+    nthreads: int
+            See polychromeIFS
+    savePoly: boolean
+            Write the polychromatic cube of every frame (name_%04dpoly.fits), a
+            Nlam x npix x npix cube per input cube. par.savePoly is not used.
+    kwargs:
+            Other keywords passed to polychromeIFS
+
+    Returns
+    -------
+    frames : generator
+            Yields the detector frame of each cube, in the order of the input.
+            par.hdr holds the header of the last frame that was yielded.
+    '''
+    if isinstance(cubes, basestring):
+        filelist = sorted(glob.glob(os.path.join(cubes, '*.fits*')))
+        cubes = (pyf.open(filename)[0] for filename in filelist)
+
+    hires_arrs = None
+    if kwargs.get('transfer', False) or not par.gaussian:
+        hires_arrs, lam_arr = loadTemplates(par, lam_arr)
+    workers = None
+    if parallel and parallel != 'threads':
+        workers = startWorkers()
+    framepar = copy.copy(par)
+    framepar.savePoly = savePoly
+    try:
+        for i, cube in enumerate(cubes):
+            detectorFrame = polychromeIFS(framepar, inWavelist, cube,
+                                          name='%s_%04d' % (name, i),
+                                          parallel=parallel,
+                                          lam_arr=lam_arr,
+                                          nthreads=nthreads,
+                                          hires_arrs=hires_arrs,
+                                          workers=workers,
+                                          **kwargs)
+            par.hdr = framepar.hdr
+            yield detectorFrame
+    finally:
+        if workers is not None:
+            stopWorkers(workers)
+
+
+class IncrementalFrame(object):
+    """
+    Noiseless detector frame of a base scene, updated by rendering only the
+    lenslets that change
+
+    The forward model is linear in the input cube, so adding, removing or
+    changing a source amounts to adding the frame of the difference. That
+    frame is only computed for the lenslets where the difference is non-zero,
+    and only over the part of the detector that their PSFLets cover (see
+    lenslet.propagateLenslets). Injection-recovery grids then cost one
+    planet per frame instead of one whole cube.
+
+    Parameters
+    ----------
+    par :   Parameter instance
+            with at least the key IFS parameters, interlacing and scale
+    inWavelist : list of floats
+            List of wavelengths in nm corresponding to the center of each bin
+    inputcube : Image
+            or HDU of the base scene, see polychromeIFS. All the changes are
+            cubes with the same shape and sampling.
+    wavelist_endpts, dlambda, lam_arr, QE, noRot, dx, upsample, npix, nlam, order, hires_arrs:
+            See polychromeIFS. The templates are kept for the updates.
+    fluxThreshold: float
+            Lenslets of a change whose flux stays below fluxThreshold times that of
+            its brightest lenslet are not rendered. The spline interpolation of the
+            input leaves tails of order 1e-16 far away from a source, so this
+            should be small but not zero.
+    kwargs:
+            Other keywords passed to polychromeIFS for the base frame
+
+    Notes
+    -----
+    The shared templates.templateCache is grown if needed to hold the templates of
+    all the sub-wavelengths, so that they are only interpolated once.
+
+    Attributes
+    ----------
+    frame: 2D ndarray
+            Current noiseless frame, in double precision
+    header: Header
+            Header of the base frame
+    """
+
+    def __init__(self, par, inWavelist, inputcube,
+                 wavelist_endpts=None,
+                 dlambda=None,
+                 lam_arr=None,
+                 QE=True,
+                 noRot=False,
+                 dx=0.0,
+                 upsample=3,
+                 npix=13,
+                 nlam=10,
+                 order=3,
+                 hires_arrs=None,
+                 fluxThreshold=1e-10,
+                 **kwargs):
+        if hires_arrs is None and not par.gaussian:
+            hires_arrs, lam_arr = loadTemplates(par, lam_arr)
+        self.frame = np.asarray(polychromeIFS(par, inWavelist, inputcube,
+                                              wavelist_endpts=wavelist_endpts,
+                                              dlambda=dlambda, lam_arr=lam_arr, QE=QE,
+                                              noRot=noRot, dx=dx, upsample=upsample,
+                                              npix=npix, nlam=nlam, order=order,
+                                              hires_arrs=hires_arrs, **kwargs),
+                                dtype=np.float64)
+        self.header = par.hdr.copy()
+
+        if isinstance(inWavelist, u.Quantity):
+            self.waveList = inWavelist.to(u.nm).value
+        else:
+            self.waveList = np.asarray(inWavelist)
+        self.wavelist_endpts = binEndpoints(self.waveList, wavelist_endpts, dlambda)
+        nbins = len(self.waveList)
+        if 'LAMTOL' in self.header:
+            self.nlams = [self.header['NLAM%03d' % i] for i in range(nbins)]
+        else:
+            self.nlams = [self.header['NLAM']] * nbins
+
+        self.par = par
+        self.pixperlenslet = par.pixperlenslet
+        self.hires_arrs = hires_arrs
+        self.lam_arr = lam_arr
+        self.QE = QE
+        self.noRot = noRot
+        self.dx = dx
+        self.upsample = 10 if par.gaussian else upsample
+        self.npix = npix
+        self.order = order
+        self.fluxThreshold = fluxThreshold
+
+        # keep the templates of all the sub-wavelengths between updates
+        if not par.gaussian and templateCache.maxsize < sum(self.nlams):
+            log.info('Growing the template cache to %d entries' % sum(self.nlams))
+            templateCache.maxsize = sum(self.nlams)
+
+    def deltaFrame(self, deltacube, nthreads=1):
+        '''
+        Detector image of a change of the scene
+
+        Parameters
+        ----------
+        deltacube: 3D ndarray, Image or HDU
+                Difference between the new and the current input cube
+        nthreads: int
+                Number of threads among which the wavelength bins are split
+
+        Returns
+        -------
+        region: tuple
+                (y1, y2, x1, x2) detector pixels affected by the change, None if there are none
+        delta: 2D ndarray
+                Change of the frame over region
+        '''
+        par = self.par
+        # the plate scale may have been changed by another simulation
+        par.pixperlenslet = self.pixperlenslet
+        cube = np.array(getattr(deltacube, 'data', deltacube), dtype=float)
+        if self.QE:
+            cube *= np.reshape(getQE(par, self.waveList), (-1, 1, 1))
+        planes = processImageCube(par, cube, self.noRot)
+        planes *= np.diff(self.wavelist_endpts)[:, np.newaxis, np.newaxis]
+
+        lenslets, dropped = activeLenslets(planes, self.fluxThreshold)
+        if len(lenslets) == 0 or not np.any(planes):
+            return None, np.zeros((0, 0))
+        log.info('Updating %d lenslets, dropping %.3g of the flux of the change' %
+                 (len(lenslets), dropped))
+
+        ######################################################################
+        # Detector area covered by the PSFLets of these lenslets
+        ######################################################################
+        ymin, ymax, xmin, xmax = lensletExtents(par, planes[0].shape, self.wavelist_endpts,
+                                                lenslets, self.order, self.dx)
+        margin = self.npix // 2 + 2
+        region = (max(0, int(np.amin(ymin)) - margin), min(par.npix, int(np.amax(ymax)) + margin),
+                  max(0, int(np.amin(xmin)) - margin), min(par.npix, int(np.amax(xmax)) + margin))
+        if region[0] >= region[1] or region[2] >= region[3]:
+            return None, np.zeros((0, 0))
+
+        def _propagateBin(i):
+            return propagateLenslets(par, planes[i],
+                                     self.wavelist_endpts[i],
+                                     self.wavelist_endpts[i + 1],
+                                     self.hires_arrs, self.lam_arr, self.upsample,
+                                     self.nlams[i], self.npix, self.order, self.dx,
+                                     lenslets=lenslets, region=region)
+
+        delta = np.zeros((region[1] - region[0], region[3] - region[2]))
+        for image in threadMap(_propagateBin, [(i,) for i in range(len(planes))], nthreads):
+            delta += image
+        return region, delta
+
+    def inject(self, deltacube, nthreads=1):
+        '''
+        Frame of the scene with a change, leaving the current frame untouched
+
+        Parameters
+        ----------
+        deltacube: 3D ndarray, Image or HDU
+                Difference between the new and the current input cube, e.g. a planet
+        nthreads: int
+                See deltaFrame
+
+        Returns
+        -------
+        frame: 2D ndarray
+                New noiseless frame
+        '''
+        frame = self.frame.copy()
+        region, delta = self.deltaFrame(deltacube, nthreads)
+        if region is not None:
+            frame[region[0]:region[1], region[2]:region[3]] += delta
+        return frame
+
+    def update(self, deltacube, nthreads=1):
+        '''
+        Applies a change of the scene to the current frame
+
+        Parameters
+        ----------
+        deltacube: 3D ndarray, Image or HDU
+                Difference between the new and the current input cube. Removing a
+                source or changing its spectrum is done with negative values.
+        nthreads: int
+                See deltaFrame
+
+        Returns
+        -------
+        frame: 2D ndarray
+                Updated frame
+        '''
+        region, delta = self.deltaFrame(deltacube, nthreads)
+        if region is not None:
+            self.frame[region[0]:region[1], region[2]:region[3]] += delta
+        return self.frame
+
+
 def reduceIFSMap(
         par,
         IFSimageName,
@@ -331,7 +854,8 @@ def reduceIFSMap(
         pixnoise=None,
         medsub=True,
         normpsflets=False,
-        gain=0.5):
+        gain=0.5,
+        nthreads=1):
     '''
     Main reduction function
 
@@ -349,6 +873,9 @@ def reduceIFSMap(
             the microspectrum as a weighted sum of these PSFs in the least-square sense. Can weigh the data by its variance.
             'optext': use a matched filter to appropriately weigh each pixel and assign the fluxes, making use of the inverse
             wavlength calibration map. Then remap each microspectrum onto the desired wavelengths
+    nthreads : int
+            Number of threads among which the lenslets of the frame are split
+            in lstsq and lstsq_conv modes, see lstsqExtract
 
     Returns
     -------
@@ -431,7 +958,8 @@ def reduceIFSMap(
             niter=niter,
             pixnoise=pixnoise,
             normpsflets=normpsflets,
-            gain=gain)
+            gain=gain,
+            nthreads=nthreads)
     elif method == 'optext':
         reducedName += '_red_optext'
         cube = intOptimalExtract(
@@ -624,7 +1152,27 @@ def prepareCube(par, wavelist, incube, QE=True, adjustment=1.0):
     return wavelist, outcube
 
 
-def createWavecalFiles(par, lamlist, dlam=1., flux=None, background=0.0):
+def _wavecalFrame(par, wav, inCube, dlam, lam_arr, hires_arrs, flux, background, seed):
+    '''
+    Monochromatic frame of createWavecalFiles, with its header
+
+    par is modified (its header is rebuilt), so each concurrent call needs its own copy.
+    '''
+    detectorFrame = polychromeIFS(par,
+                                  [wav],
+                                  inCube,
+                                  dlambda=dlam,
+                                  parallel=False,
+                                  lam_arr=lam_arr,
+                                  hires_arrs=hires_arrs)
+    if flux is not None:
+        detectorFrame /= getQE(par, wav) * (par.lensletsampling / inCube.header['PIXSIZE'])**2
+        detectorFrame = np.random.RandomState(seed).poisson(flux * detectorFrame + background)
+    return detectorFrame, par.hdr
+
+
+def createWavecalFiles(par, lamlist, dlam=1., flux=None, background=0.0,
+                       parallel=False, nthreads=None, seed=None):
     '''
     Creates a set of monochromatic IFS images to be used in wavelength calibration step
 
@@ -642,6 +1190,15 @@ def createWavecalFiles(par, lamlist, dlam=1., flux=None, background=0.0):
             image is preferred, leave this to None
     background: float
             Adds Poisson-distributed background to the image. Leave to None to ignore.
+    parallel: boolean or 'threads'
+            True computes the frames in one process per CPU, 'threads' in a pool of nthreads
+            threads sharing the templates. False computes them one after the other.
+    nthreads: int
+            Number of threads used when parallel='threads'. Defaults to the number of CPUs
+    seed: int
+            Seed of the Poisson noise. Frame i uses its own stream seeded with (seed, i), so
+            the frames do not depend on the order in which they are computed. Drawn at random
+            if left to None.
 
     Notes
     -----
@@ -650,6 +1207,9 @@ def createWavecalFiles(par, lamlist, dlam=1., flux=None, background=0.0):
     two fields need to be populated manually with the set of files and wavelengths that
     you want to use for the calibration.
 
+    The templates are loaded once for all the frames, and the files are written by a
+    background thread while the next frames are computed.
+
     '''
 
     par.saveDetector = False
@@ -657,79 +1217,244 @@ def createWavecalFiles(par, lamlist, dlam=1., flux=None, background=0.0):
     inCube = pyf.HDUList(pyf.PrimaryHDU(inputCube))
     inCube[0].header['LAM_C'] = 0.5 * (lamlist[-1] + lamlist[0]) / 1000.
     inCube[0].header['PIXSIZE'] = 0.1
-    filelist = []
-    for wav in lamlist:
-        # note the argument lam_arr, necessary when computing things for the
-        # first time
-        detectorFrame = polychromeIFS(
-                                    par,
-                                    [wav],
-                                    inCube[0],
-                                    dlambda=dlam,
-                                    parallel=False,
-                                    lam_arr=lamlist)
-        if flux is not None:
-            detectorFrame /= getQE(par,wav)*(par.lensletsampling/inCube[0].header['PIXSIZE'])**2
-            detectorFrame = np.random.poisson(flux*detectorFrame+background)
-        filename = par.wavecalDir + 'det_%3d.fits' % (wav)
-        filelist.append(filename)
-        Image(data=detectorFrame, header=par.hdr).write(filename)
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    # note the argument lamlist, necessary when computing things for the
+    # first time
+    hires_arrs, lam_arr = None, lamlist
+    if not par.gaussian:
+        hires_arrs, lam_arr = loadTemplates(par, lamlist)
+
+    ######################################################################
+    # Frames are written by a background thread, in the order in which
+    # they are finished
+    ######################################################################
+    filelist = [par.wavecalDir + 'det_%3d.fits' % (wav) for wav in lamlist]
+    towrite = queue.Queue()
+
+    def _writer():
+        while True:
+            item = towrite.get()
+            if item is None:
+                break
+            filename, detectorFrame, hdr = item
+            Image(data=detectorFrame, header=hdr).write(filename)
+
+    writer = threading.Thread(target=_writer)
+    writer.start()
+    headers = [None] * len(lamlist)
+    args = []
+    for i, wav in enumerate(lamlist):
+        # the intermediate products of each frame would overwrite each other
+        framepar = copy.copy(par)
+        framepar.savePoly = False
+        framepar.saveRotatedInput = False
+        args += [(framepar, wav, inCube[0], dlam, lam_arr, hires_arrs, flux, background,
+                  [seed, i])]
+    try:
+        if parallel and parallel != 'threads':
+            tasks, results, consumers = startWorkers()
+            for i in range(len(lamlist)):
+                tasks.put(Task(i, _wavecalFrame, args[i]))
+            stopWorkers((tasks, results, consumers))
+            for i in range(len(lamlist)):
+                index, (detectorFrame, headers[index]) = results.get()
+                towrite.put((filelist[index], detectorFrame, headers[index]))
+        else:
+            def _frame(i):
+                detectorFrame, headers[i] = _wavecalFrame(*args[i])
+                towrite.put((filelist[i], detectorFrame, headers[i]))
+            threadMap(_frame, [(i,) for i in range(len(lamlist))],
+                      nthreads if parallel == 'threads' else 1)
+    finally:
+        towrite.put(None)
+        writer.join()
+
+    par.hdr = headers[-1]
     par.lamlist = lamlist
     par.filelist = filelist
     return filelist
 
 from crispy.tools.locate_psflets import transform
-from crispy.tools.imgtools import gausspsf
-
-def quickMonochromatic(par=None, 
-                        fwhm =2.0,
-                        coefs = None,
-                        Dx = 0.0,
-                        Dy = 0.0,
-                        flux = 1.0,
-                        gsize = 5,
-                        order = 3,
-                        nlens = 108,
-                        npix = 1024,
-                        returnCoords = False):
-
-    if coefs is None:
-        if par is None: 
-            raise
-        else:
-            scale = par.pitch / par.pixsize
-            cphi = np.cos(par.philens)
-            sphi = np.sin(par.philens)
-            Xcoefs = np.array([par.npix//2+Dx,cphi*scale,0.0,0.,-sphi*scale,0.0,0.0,0.0,0.0,0.0])
-            Ycoefs = np.array([par.npix//2+Dy,sphi*scale,0.0,0.,cphi*scale,0.0,0.0,0.0,0.0,0.0])
-            coefs = np.concatenate([Xcoefs,Ycoefs])
-    
+from scipy.special import erf
+
+
+def quickMonochromatic(par=None,
+                       fwhm=2.0,
+                       coefs=None,
+                       Dx=0.0,
+                       Dy=0.0,
+                       flux=1.0,
+                       gsize=5,
+                       order=3,
+                       nlens=108,
+                       npix=1024,
+                       returnCoords=False):
+    '''
+    Monochromatic detector frame with Gaussian PSFLets, see quickMonochromaticStack
+    '''
+    frames = quickMonochromaticStack(par, fwhm=fwhm, coefs=coefs, Dx=Dx, Dy=Dy, flux=flux,
+                                     gsize=gsize, order=order, nlens=nlens, npix=npix,
+                                     returnCoords=returnCoords)
+    if returnCoords:
+        frames, (Xc, Yc) = frames
+        return frames[0], (Xc[0], Yc[0])
+    return frames[0]
+
+
+def quickMonochromaticStack(par=None,
+                            lams=None,
+                            fwhm=2.0,
+                            coefs=None,
+                            Dx=0.0,
+                            Dy=0.0,
+                            flux=1.0,
+                            gsize=5,
+                            order=3,
+                            nlens=108,
+                            npix=1024,
+                            filename=None,
+                            nthreads=1,
+                            returnCoords=False):
+    '''
+    Renders a stack of monochromatic detector frames with Gaussian PSFLets
+
+    All the spots of a frame are computed at once from two arrays of 1D pixel
+    profiles, so that large sets of synthetic wavelength calibration or flat
+    frames can be produced quickly. Each frame is the same as the one returned
+    by quickMonochromatic with the same arguments.
+
+    Parameters
+    ----------
+    par: Params instance
+        If set, nlens and npix are taken from par, which is also used to place
+        the spots when coefs is None
+    lams: float or 1D array
+        Wavelengths of the frames in nm. If set and coefs is None, the spots are placed
+        with the wavelength solution of par (see lenslet.lensletLocations)
+    fwhm: float or 1D array
+        FWHM of the spots of each frame in detector pixels. If None, par.FWHM is
+        scaled to each of lams
+    coefs: 1D or 2D array
+        Polynomial coefficients of the x then y positions (see locate_psflets.transform),
+        for all the frames or one row per frame
+    Dx, Dy: float or 1D array
+        Offsets of the spots of each frame in detector pixels, when coefs is None
+    flux: float or 1D array
+        Flux of each spot, for each frame
+    gsize: int
+        Half-size of the spots in detector pixels
+    order: int
+        Order of the polynomial coefficients
+    nlens, npix: int
+        Number of lenslets on a side and size of the detector, when par is None
+    filename: string
+        If set, the frames are written to a memory-mapped .npy cube of that name,
+        which is returned instead of an array in memory
+    nthreads: int
+        Number of threads among which the frames are split
+    returnCoords: boolean
+        Whether to also return the coordinates of the spots
+
+    Returns
+    -------
+    frames: 3D ndarray
+        Stack of (npix, npix) frames, one for each value of the arguments given as arrays
+    coords: tuple
+        If returnCoords, (Xc, Yc) arrays with the spot coordinates of each frame
+
+    Notes
+    -----
+    All the arguments given as arrays need to have the same length, the others
+    are shared by all the frames.
+    '''
+    if coefs is None and par is None:
+        raise ValueError('Either par or coefs need to be set')
+    if fwhm is None:
+        fwhm = par.FWHM * np.asarray(lams, dtype=float) / par.FWHMlam
     if par is not None:
         nlens = par.nlens
         npix = par.npix
-    
+
+    ######################################################################
+    # Number of frames and per-frame arguments
+    ######################################################################
+    if coefs is not None:
+        coefs = np.atleast_2d(coefs)
+    lengths = [np.size(arg) for arg in (lams, fwhm, flux, Dx, Dy) if arg is not None]
+    if coefs is not None:
+        lengths += [coefs.shape[0]]
+    nframes = max(lengths)
+    fwhm = np.broadcast_to(fwhm, (nframes,))
+    flux = np.broadcast_to(flux, (nframes,))
+    Dx = np.broadcast_to(Dx, (nframes,))
+    Dy = np.broadcast_to(Dy, (nframes,))
+
+    ######################################################################
+    # Spot coordinates of all the frames
+    ######################################################################
     xindx = np.arange(-nlens / 2, nlens / 2)
     xindx, yindx = np.meshgrid(xindx, xindx)
-    
-    Xc, Yc = transform(xindx,yindx,order,coefs)
-    
-    lx = npix+2*gsize
-    detectorFrame = np.zeros((lx,lx))
-    ry = np.reshape(Yc,-1)
-    rx = np.reshape(Xc,-1)
-    for i in range(len(ry)):
-            yi = ry[i]+gsize
-            xi = rx[i]+gsize
-            xmin = int(xi)-gsize
-            xmax = xmin+2*gsize
-            ymin = int(yi)-gsize
-            ymax = ymin+2*gsize
-            if ymin>0 and xmin>0 and xmax<lx and ymax<lx:
-                dx = xi - np.floor(xi) + 0.5
-                dy = yi - np.floor(yi) + 0.5
-                detectorFrame[ymin:ymax,xmin:xmax]+=flux*gausspsf(size=2*gsize,fwhm=fwhm,offx=-dx,offy=-dy)
-
-    detectorFrame = detectorFrame[gsize:-gsize,gsize:-gsize]
+    Xc = np.zeros((nframes,) + xindx.shape)
+    Yc = np.zeros((nframes,) + xindx.shape)
+    if coefs is not None:
+        coefs = np.broadcast_to(coefs, (nframes, coefs.shape[1]))
+        for i in range(nframes):
+            Xc[i], Yc[i] = transform(xindx, yindx, order, coefs[i])
+    elif lams is not None:
+        psftool, allcoef = loadPSFLetPositions(par)
+        lams = np.broadcast_to(lams, (nframes,))
+        for i in range(nframes):
+            Xc[i], Yc[i] = lensletLocations(par, lams[i], xindx, yindx, order,
+                                            psftool=psftool, allcoef=allcoef)
+            Xc[i] += Dx[i]
+            Yc[i] += Dy[i]
+    else:
+        scale = par.pitch / par.pixsize
+        cphi = np.cos(par.philens)
+        sphi = np.sin(par.philens)
+        for i in range(nframes):
+            Xcoefs = np.array([par.npix // 2 + Dx[i], cphi * scale, 0.0, 0., -sphi * scale,
+                               0.0, 0.0, 0.0, 0.0, 0.0])
+            Ycoefs = np.array([par.npix // 2 + Dy[i], sphi * scale, 0.0, 0., cphi * scale,
+                               0.0, 0.0, 0.0, 0.0, 0.0])
+            Xc[i], Yc[i] = transform(xindx, yindx, order, np.concatenate([Xcoefs, Ycoefs]))
+
+    dtype = getDtype(par) if par is not None else np.float64
+    if filename is not None:
+        frames = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                           shape=(nframes, npix, npix))
+    else:
+        frames = np.zeros((nframes, npix, npix), dtype=dtype)
+
+    lx = npix + 2 * gsize
+    offsets = np.arange(2 * gsize)
+
+    def _renderFrame(i):
+        ######################################################################
+        # Each spot is the product of two normalized 1D profiles integrated
+        # over the detector pixels, as in imgtools.gausspsf
+        ######################################################################
+        ry = np.reshape(Yc[i], -1) + gsize
+        rx = np.reshape(Xc[i], -1) + gsize
+        ymin = np.floor(ry).astype(int) - gsize
+        xmin = np.floor(rx).astype(int) - gsize
+        ok = (ymin > 0) * (xmin > 0) * (xmin + 2 * gsize < lx) * (ymin + 2 * gsize < lx)
+        s = np.sqrt(2) * fwhm[i] / 2.35
+        dy = (ymin[ok] - ry[ok] - 0.5)[:, np.newaxis] + offsets[np.newaxis, :]
+        dx = (xmin[ok] - rx[ok] - 0.5)[:, np.newaxis] + offsets[np.newaxis, :]
+        yprof = erf((dy + 0.5) / s) - erf((dy - 0.5) / s)
+        xprof = erf((dx + 0.5) / s) - erf((dx - 0.5) / s)
+        yprof *= flux[i] / np.sum(yprof, axis=1, keepdims=True)
+        xprof /= np.sum(xprof, axis=1, keepdims=True)
+        frame = np.zeros((lx, lx))
+        addStamps(frame, yprof[:, :, np.newaxis] * xprof[:, np.newaxis, :], ymin[ok], xmin[ok])
+        frames[i] = frame[gsize:-gsize, gsize:-gsize]
+
+    threadMap(_renderFrame, [(i,) for i in range(nframes)], nthreads)
+    if filename is not None:
+        frames.flush()
     if returnCoords:
-        return detectorFrame,(Xc, Yc)
-    return detectorFrame
\ No newline at end of file
+        return frames, (Xc, Yc)
+    return frames
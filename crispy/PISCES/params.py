@@ -58,6 +58,11 @@ class Params(object):
         self.npix = 1024            # Number of pixels in final detector
         self.pixsize = 13e-6        # Pixel size (meters)
         self.pxperdetpix = 1       # Oversampling of the final detector pixels
+        self.precision = 'float64'  # Floating-point type of the large arrays ('float32' halves memory)
+        self.lamtol = None          # Max PSFLet shift (px) between sub-wavelengths, None for a fixed number
+        self.preblend = False       # Blend the field-dependent templates once per lenslet and bin
+        self.nphase = None          # Sub-pixel phases per pixel of the PSFLet stamp lookup tables, None to interpolate
+        self.polychromeStamps = False  # Extract from the compact polychrome stamps instead of the dense polychrome
         self.convolve = True        # whether to convolve the existing kernels with
                                     # gaussian kernel (simulating defocus)
         self.FWHM = 2               # FWHM of gaussian kernel
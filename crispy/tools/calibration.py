@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+'''
+Process-wide cache of the calibration files
+
+The wavelength solution (lamsol.dat), the PSFLet widths (PSFwidths.fits),
+the polychrome keys (polychromekeyR*.fits), the compact polychromes
+(polychromeStampsR*.npy) and the lenslet flat and mask are
+read by many routines, often several times per call and once per worker.
+The functions of this module parse each file once per process and hand out
+read-only arrays.
+
+Each entry remembers the modification time and size of its file, and is
+reloaded if either changes, e.g. when buildcalibrations rewrites the
+calibration directory.
+'''
+
+import os
+import threading
+import numpy as np
+try:
+    from astropy.io import fits
+except BaseException:
+    import pyfits as fits
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+
+def _readonly(value):
+    '''
+    Flags an array, or all the arrays of a tuple, as read-only
+    '''
+    if isinstance(value, tuple):
+        return tuple([_readonly(v) for v in value])
+    value = np.asarray(value)
+    value.setflags(write=False)
+    return value
+
+
+class CalibrationCache(object):
+    """
+    Cache of parsed calibration files, keyed by file name and loader, and
+    invalidated by file modification time and size.
+
+    Notes
+    -----
+    Arrays handed out by the cache are read-only since they are shared
+    between all the callers. Copy them before modifying them.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, filename, loader):
+        '''
+        Return the content of a file parsed by loader
+
+        Parameters
+        ----------
+        filename: string
+            Name of the file
+        loader: function
+            Function taking the file name and returning an array or a tuple of arrays
+
+        Returns
+        -------
+        value: ndarray or tuple of ndarrays
+            Read-only output of loader
+        '''
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+        key = (filename, loader.__name__)
+
+        with self._lock:
+            if key in self._entries:
+                oldstamp, value = self._entries[key]
+                if oldstamp == stamp:
+                    self.hits += 1
+                    return value
+                self.invalidations += 1
+                log.info('Calibration file changed, reloading ' + filename)
+
+        value = _readonly(loader(filename))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (stamp, value)
+        return value
+
+    def clear(self):
+        '''
+        Empty the cache and reset the statistics
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def stats(self):
+        '''
+        Cache statistics
+
+        Returns
+        -------
+        stats: dict
+            Number of hits, of misses (files actually parsed), of entries
+            reloaded because their file changed, and current number of entries
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries)}
+
+
+# Process-wide cache shared by the simulation and reduction routines
+calibrationCache = CalibrationCache()
+
+
+def _loadtxt(filename):
+    return np.loadtxt(filename)
+
+
+def _loadPrimary(filename):
+    return fits.getdata(filename, 0)
+
+
+def _loadFirstExtension(filename):
+    return fits.getdata(filename, 1)
+
+
+def _loadMemmap(filename):
+    return np.load(filename, mmap_mode='r')
+
+
+def _loadPolychromeKey(filename):
+    hdus = fits.open(filename)
+    key = tuple([hdus[i].data for i in range(4)])
+    hdus.close()
+    return key
+
+
+def loadLamsol(par, wavecalDir=None):
+    '''
+    Wavelength solution
+
+    Parameters
+    ----------
+    par: Parameters instance
+        Crispy parameter instance
+    wavecalDir: string
+        Calibration directory. Defaults to par.wavecalDir
+
+    Returns
+    -------
+    lamsol: 2D ndarray
+        Content of lamsol.dat: the wavelengths in the first column, followed by the
+        polynomial coefficients of the PSFLet positions at each wavelength
+    '''
+    if wavecalDir is None:
+        wavecalDir = par.wavecalDir
+    return calibrationCache.get(os.path.join(wavecalDir, 'lamsol.dat'), _loadtxt)
+
+
+def loadPSFWidths(par):
+    '''
+    PSFLet widths measured by buildcalibrations
+
+    Parameters
+    ----------
+    par: Parameters instance
+        Crispy parameter instance
+
+    Returns
+    -------
+    sig: ndarray
+        Content of PSFwidths.fits
+    '''
+    return calibrationCache.get(os.path.join(par.wavecalDir, 'PSFwidths.fits'), _loadPrimary)
+
+
+def loadPolychromeKey(par):
+    '''
+    Key of the polychrome used for the least-squares extraction
+
+    Parameters
+    ----------
+    par: Parameters instance
+        Crispy parameter instance
+
+    Returns
+    -------
+    lam_midpts: 1D array
+        Central wavelengths of the polychrome bins
+    xindx, yindx: 3D arrays
+        Positions of all the PSFLets in each bin
+    good: 3D array
+        Whether each PSFLet lies on the detector
+    '''
+    return calibrationCache.get(os.path.join(par.wavecalDir, 'polychromekeyR%d.fits' % (par.R)),
+                                _loadPolychromeKey)
+
+
+def loadPolychromeStamps(par):
+    '''
+    Compact polychrome used for the least-squares extraction, see tools.polychrome
+
+    Parameters
+    ----------
+    par: Parameters instance
+        Crispy parameter instance
+
+    Returns
+    -------
+    stamps: 1D structured ndarray
+        Memory-mapped content of polychromeStampsR%d.npy, or None if there is no
+        such file or if it is older than the FITS polychrome or its key
+    '''
+    filename = os.path.join(par.wavecalDir, 'polychromeStampsR%d.npy' % (par.R))
+    if not os.path.isfile(filename):
+        return None
+    for other in ['polychromeR%d.fits.gz', 'polychromeR%d.fits', 'polychromekeyR%d.fits']:
+        other = os.path.join(par.wavecalDir, other % (par.R))
+        if os.path.isfile(other) and os.path.getmtime(other) > os.path.getmtime(filename):
+            log.warning('Ignoring %s, which is older than %s' % (filename, other))
+            return None
+    return calibrationCache.get(filename, _loadMemmap)
+
+
+def loadLensletFlat(par):
+    '''
+    Lenslet flatfield from the first extension of par.lenslet_flat
+    '''
+    return calibrationCache.get(par.lenslet_flat, _loadFirstExtension)
+
+
+def loadLensletMask(par):
+    '''
+    Lenslet mask from the first extension of par.lenslet_mask
+    '''
+    return calibrationCache.get(par.lenslet_mask, _loadFirstExtension)
@@ -7,7 +7,7 @@ import scipy.ndimage
 import numpy as np
 import multiprocessing
 import matplotlib.pyplot as plt
-from crispy.tools.detutils import frebin
+from crispy.tools.detutils import frebin, getDtype
 from crispy.tools.par_utils import Task, Consumer
 
 from crispy.tools.initLogger import getLogger
@@ -57,6 +57,7 @@ def readDetector(par, IFSimage, inttime=100):
     Input is IFSimage in average photons per second
     Quantum efficiency considerations are already taken care of when
     generating IFSimage images
+    The frames are computed with the floating-point type set by par.precision
     '''
 
     if 'RN' not in par.hdr:
@@ -120,7 +121,8 @@ def readDetector(par, IFSimage, inttime=100):
 
     eff = par.losses * par.PhCountEff * par.pol
 
-    photoelectrons = IFSimage.data * eff * inttime
+    dtype = getDtype(par)
+    photoelectrons = (IFSimage.data * eff * inttime).astype(dtype, copy=False)
 
     if par.nonoise:
         return photoelectrons
@@ -132,7 +134,7 @@ def readDetector(par, IFSimage, inttime=100):
             photoelectrons[photoelectrons > 0] *= np.minimum(np.ones(photoelectrons[photoelectrons > 0].shape),
                                                              1 + par.lifefraction * 0.51296 * (np.log10(photoelectrons[photoelectrons > 0]) + 0.0147233))
 
-        average = photoelectrons + par.dark * inttime + par.CIC
+        average = photoelectrons + dtype(par.dark * inttime + par.CIC)
 
         # calculate electron generation in the CCD frame
         if par.poisson:
@@ -143,20 +145,20 @@ def readDetector(par, IFSimage, inttime=100):
         # calculate the number of electrons after the EM register
         if par.EMStats:
             EMmask = atEMRegister > 0
-            afterEMRegister = np.zeros(atEMRegister.shape)
+            afterEMRegister = np.zeros(atEMRegister.shape, dtype=dtype)
             afterEMRegister[EMmask] = np.random.gamma(
                 atEMRegister[EMmask], par.EMGain, atEMRegister[EMmask].shape)
         else:
-            afterEMRegister = par.EMGain * atEMRegister
+            afterEMRegister = (par.EMGain * atEMRegister).astype(dtype)
 
         # add read noise
         if par.EMStats and par.RN > 0:
             afterRN = afterEMRegister + \
-                np.random.normal(par.PCbias, par.RN, afterEMRegister.shape)
+                np.random.normal(par.PCbias, par.RN, afterEMRegister.shape).astype(dtype)
             # clip at zero
             afterRN[afterRN < 0] = 0
         else:
-            afterRN = afterEMRegister + par.PCbias
+            afterRN = afterEMRegister + dtype(par.PCbias)
 
         # add photon counting thresholding
         if par.PCmode:
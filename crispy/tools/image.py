@@ -12,6 +12,63 @@ log = getLogger('crispy')
 ''' most of this code is due to Tim Brandt '''
 
 
+def _fileHeader(header):
+    '''
+    Primary header of the files written by crispy: the creation date
+    followed by the cards of header.
+    '''
+    hdr = fits.PrimaryHDU().header
+    today = date.today().timetuple()
+    yyyymmdd = '%d%02d%02d' % (today[0], today[1], today[2])
+    hdr['date'] = (yyyymmdd, 'File creation date (yyyymmdd)')
+
+    for i, key in enumerate(header):
+        hdr.append(
+            (key,
+             header[i],
+             header.comments[i]),
+            end=True)
+    return hdr
+
+
+def writeSlices(filename, cube, header=None):
+    '''
+    Writes a cube to a FITS file one slice at a time
+
+    The file has the same layout as the ones written by Image.write (a
+    header-only primary HDU followed by the float32 data), but the cube is
+    never converted as a whole, so that it can be a memory-mapped array
+    larger than the available memory.
+
+    Parameters
+    ----------
+    filename: string
+        Name of the output file, overwritten if it exists
+    cube: 3D ndarray
+        Cube to write, typically a numpy memmap
+    header: FITS header
+        Cards added to the primary header
+    '''
+    if header is None:
+        header = fits.PrimaryHDU().header
+    try:
+        fits.HDUList(fits.PrimaryHDU(None, _fileHeader(header))).writeto(
+            filename, overwrite=True)
+        hdr = fits.ImageHDU().header
+        hdr['BITPIX'] = -32
+        hdr['NAXIS'] = 3
+        hdr['NAXIS1'] = cube.shape[2]
+        hdr['NAXIS2'] = cube.shape[1]
+        hdr['NAXIS3'] = cube.shape[0]
+        out = fits.StreamingHDU(filename, hdr)
+        for i in range(cube.shape[0]):
+            out.write(np.asarray(cube[i], dtype='>f4'))
+        out.close()
+        log.info("Writing data to " + filename)
+    except BaseException:
+        log.error("Unable to write FITS file " + filename)
+
+
 class Image:
 
     """
@@ -95,17 +152,7 @@ class Image:
         clobber is provided as a keyword to fits.HDUList.writeto.
         """
 
-        hdr = fits.PrimaryHDU().header
-        today = date.today().timetuple()
-        yyyymmdd = '%d%02d%02d' % (today[0], today[1], today[2])
-        hdr['date'] = (yyyymmdd, 'File creation date (yyyymmdd)')
-
-        for i, key in enumerate(self.header):
-            hdr.append(
-                (key,
-                 self.header[i],
-                 self.header.comments[i]),
-                end=True)
+        hdr = _fileHeader(self.header)
 
         out = fits.HDUList(fits.PrimaryHDU(None, hdr))
         out.append(fits.PrimaryHDU(self.data.astype(np.float32)))
@@ -1,19 +1,185 @@
 #!/usr/bin/env python
 
 import numpy as np
+import threading
 try:
     from astropy.io import fits as pyf
 except BaseException:
     import pyfits as pyf
-from crispy.tools.rotate import Rotate
 from crispy.tools.initLogger import getLogger
 log = getLogger('crispy')
 import matplotlib.pyplot as plt
-from crispy.tools.detutils import frebin
+from crispy.tools.detutils import frebinMatrix, getDtype
+from collections import OrderedDict
 from scipy import ndimage
+from scipy import sparse
 from scipy.special import erf
 from crispy.tools.spectrograph import distort
 from crispy.tools.locate_psflets import initcoef, transform, PSFLets
+from crispy.tools.templates import templateCache, templateSetKey, templateAnchors
+from crispy.tools.phasetables import loadPhaseTables, phaseTablesAt
+from crispy.tools.calibration import loadLamsol
+from crispy.tools.par_utils import threadMap
+
+
+# resampling operators used by processImageCube, most recent last
+_planeOperators = OrderedDict()
+_maxplaneoperators = 4
+
+# Number of zeros added around each slice before the spline prefilter. The
+# prefilter kernel decays as 0.268**k, so coefficients further away from the
+# image are below 1e-9 of its edge values and are neglected.
+_splinepad = 16
+
+# Number of mirrored rows and columns around each pre-blended template, which
+# the cubic spline reads at the edges of the template, and number of lenslets
+# blended at once
+_blendpad = 2
+_blendblock = 512
+
+
+def _bspline3Weights(t):
+    '''
+    Cubic B-spline weights of the four coefficients floor(c)-1 to floor(c)+2
+    when interpolating at coordinate c, with t = c - floor(c)
+    '''
+    return [(1. - t)**3 / 6.,
+            (4. - 6. * t**2 + 3. * t**3) / 6.,
+            (1. + 3. * t + 3. * t**2 - 3. * t**3) / 6.,
+            t**3 / 6.]
+
+
+def imagePlaneOperator(par, shape, noRot=False):
+    '''
+    Sparse operator performing the padding, rotation and flux-conservative
+    rebinning of processImagePlane for a given slice shape
+
+    Parameters
+    ----------
+    par :   Parameters instance
+            Contains all IFS parameters, with par.philens and par.pixperlenslet
+    shape : tuple
+            Shape of the input slices
+    noRot : boolean
+            Skip the rotation
+
+    Returns
+    -------
+    operator : scipy.sparse.csr_matrix
+            Matrix acting on the flattened cubic spline coefficients of a slice
+            zero-padded by _splinepad on each side (or on the padded slice itself
+            if noRot), and returning the flattened rotated and rebinned slice
+    outshape : tuple
+            Shape of the rotated and rebinned slices
+
+    Notes
+    -----
+    The operators are cached in memory for each (shape, par.philens,
+    par.pixperlenslet, noRot).
+    '''
+    key = (tuple(shape), float(par.philens), float(par.pixperlenslet), bool(noRot))
+    if key in _planeOperators:
+        _planeOperators[key] = _planeOperators.pop(key)
+        return _planeOperators[key]
+
+    xdim, ydim = int(shape[0] * np.sqrt(2)), int(shape[1] * np.sqrt(2))
+    xpad = (xdim - shape[0]) // 2
+    ypad = (ydim - shape[1]) // 2
+    inshape = (shape[0] + 2 * _splinepad, shape[1] + 2 * _splinepad)
+
+    ######################################################################
+    # Rotation about the center of the padded plane, with the same
+    # coordinates as tools.rotate.Rotate
+    ######################################################################
+    if noRot:
+        rotshape = (xdim, ydim)
+        yr, xr = np.indices(rotshape)
+        yr = yr - xpad + _splinepad
+        xr = xr - ypad + _splinepad
+        fy, fx = yr, xr
+        wy = wx = [np.ones(rotshape)]
+    else:
+        rotshape = (xdim, xdim)
+        x = np.arange(xdim)
+        med_n = np.median(x)
+        x -= int(med_n)
+        x, y = np.meshgrid(x, x)
+        r = np.sqrt(x**2 + y**2)
+        theta = np.arctan2(y, x)
+        xr = r * np.cos(theta + par.philens) + med_n - ypad + _splinepad
+        yr = r * np.sin(theta + par.philens) + med_n - xpad + _splinepad
+        fy = np.floor(yr).astype(int) - 1
+        fx = np.floor(xr).astype(int) - 1
+        wy = _bspline3Weights(yr - fy - 1)
+        wx = _bspline3Weights(xr - fx - 1)
+
+    outindx = np.arange(rotshape[0] * rotshape[1])
+    rows = []
+    cols = []
+    data = []
+    for a in range(len(wy)):
+        for b in range(len(wx)):
+            iy = np.reshape(fy + a, -1)
+            ix = np.reshape(fx + b, -1)
+            w = np.reshape(wy[a] * wx[b], -1)
+            ok = (iy >= 0) * (iy < inshape[0]) * (ix >= 0) * (ix < inshape[1]) * (w != 0)
+            rows += [outindx[ok]]
+            cols += [iy[ok] * inshape[1] + ix[ok]]
+            data += [w[ok]]
+    rotate = sparse.csr_matrix((np.concatenate(data),
+                                (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(rotshape[0] * rotshape[1], inshape[0] * inshape[1]))
+
+    ######################################################################
+    # Flux conservative rebinning, as in frebin
+    ######################################################################
+    newShape = (int(rotshape[0] / par.pixperlenslet),
+                int(rotshape[1] / par.pixperlenslet))
+    rebin = sparse.kron(frebinMatrix(rotshape[0], newShape[1]),
+                        frebinMatrix(rotshape[1], newShape[0]))
+    operator = sparse.csr_matrix(rebin.dot(rotate))
+    outshape = (newShape[1], newShape[0])
+
+    _planeOperators[key] = (operator, outshape)
+    while len(_planeOperators) > _maxplaneoperators:
+        _planeOperators.popitem(last=False)
+    return operator, outshape
+
+
+def processImageCube(par, cube, noRot=False):
+    '''
+    Rotates all the slices of a cube, and rebins them in a flux-conservative way
+    on the array of lenslets, as processImagePlane does for a single slice.
+
+    The whole resampling is a single cached sparse operator (see imagePlaneOperator)
+    applied to all the slices at once, after one spline prefiltering of the cube
+    along each spatial axis.
+
+    Parameters
+    ----------
+    par :   Parameters instance
+            Contains all IFS parameters
+    cube : 3D array
+            Input cube to IFS sim, first dimension of data is wavelength
+    noRot : boolean
+            Skip the rotation
+
+    Returns
+    -------
+    cubeRot : 3D array
+            Rotated and rebinned cube, one pixel per lenslet
+    '''
+    cube = np.asarray(cube, dtype=float)
+    operator, outshape = imagePlaneOperator(par, cube.shape[1:], noRot)
+    coefs = np.pad(cube, ((0, 0), (_splinepad, _splinepad), (_splinepad, _splinepad)),
+                   mode='constant')
+    if not noRot:
+        coefs = ndimage.spline_filter1d(coefs, order=3, axis=1)
+        coefs = ndimage.spline_filter1d(coefs, order=3, axis=2)
+    cubeRot = operator.dot(np.reshape(coefs, (cube.shape[0], -1)).T)
+    cubeRot = np.reshape(cubeRot.T, (cube.shape[0],) + outshape)
+    log.debug('Input plane is %dx%d' % outshape)
+    return cubeRot
 
 
 def processImagePlane(par, imagePlane, noRot=False):
@@ -37,33 +203,726 @@ def processImagePlane(par, imagePlane, noRot=False):
     -------
     imagePlaneRot : 2D array
             Rotated image plane on same sampling as original.
+
+    Notes
+    -----
+    This is processImageCube applied to a single slice. Use processImageCube directly
+    to process all the slices of a cube in one go.
     '''
+    return processImageCube(par, np.asarray(imagePlane)[np.newaxis], noRot)[0]
 
-    paddedImagePlane = np.zeros(
-        (int(imagePlane.shape[0] * np.sqrt(2)), int(imagePlane.shape[1] * np.sqrt(2))))
 
-    xdim, ydim = paddedImagePlane.shape
-    xpad = xdim - imagePlane.shape[0]
-    ypad = ydim - imagePlane.shape[1]
-    xpad //= 2
-    ypad //= 2
-    paddedImagePlane[xpad:-xpad, ypad:-ypad] = imagePlane
+def _template_weights(xcen, ycen, imshape, nsubarr):
+    """
+    Weights of the four nearest field regions on which the
+    high-resolution PSFlets have been made, for an array of centroids.
 
-    if noRot:
-        imagePlaneRot = paddedImagePlane.copy()
+    Bilinear interpolation by hand.  Do not extrapolate, but instead
+    use the nearest PSFlet near the edge of the image.  The outer
+    regions will therefore have slightly less reliable PSFlet
+    reconstructions.
+
+    Parameters
+    ----------
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets on the (padded) detector
+    imshape: tuple
+        Shape of the (padded) detector image
+    nsubarr: tuple
+        Shape (ny, nx) of the grid of field regions
+
+    Returns
+    -------
+    weights: list of 4 tuples
+        (j, i, weight) for each of the four neighbouring templates, where
+        j and i are integer arrays of template indices and weight is
+        normalized so that the four weights add up to one
+    """
+    x_hires = xcen * 1. / imshape[1] * nsubarr[1] - 0.5
+    y_hires = ycen * 1. / imshape[0] * nsubarr[0] - 0.5
+
+    xedge = (x_hires <= 0) | (x_hires >= nsubarr[1] - 1)
+    i1 = np.clip(x_hires, 0, nsubarr[1] - 1).astype(int)
+    i2 = np.where(xedge, i1, i1 + 1)
+
+    yedge = (y_hires < 0) | (y_hires >= nsubarr[0] - 1)
+    j1 = np.clip(y_hires, 0, nsubarr[0] - 1).astype(int)
+    j2 = np.where(yedge, j1, j1 + 1)
+
+    weight22 = np.maximum(0, (x_hires - i1) * (y_hires - j1))
+    weight12 = np.maximum(0, (x_hires - i1) * (j2 - y_hires))
+    weight21 = np.maximum(0, (i2 - x_hires) * (y_hires - j1))
+    weight11 = np.maximum(0, (i2 - x_hires) * (j2 - y_hires))
+    totweight = weight11 + weight21 + weight12 + weight22
+    totweight[totweight == 0] = 1.
+
+    return [(j1, i1, weight11 / totweight),
+            (j1, i2, weight12 / totweight),
+            (j2, i1, weight21 / totweight),
+            (j2, i2, weight22 / totweight)]
+
+
+def _stamp_origins(xcen, ycen, npix):
+    """
+    Lower-left detector pixel of the npix x npix stamp of each PSFLet
+    """
+    iy1 = ycen.astype(int) - npix // 2
+    ix1 = xcen.astype(int) - npix // 2
+    return iy1, ix1
+
+
+def _stamp_indices(iy1, ix1, npix, shape):
+    """
+    Flat detector indices of every pixel of every stamp, shape (n, npix, npix)
+    """
+    offsets = np.arange(npix)
+    return (iy1[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]) * shape[1] + \
+        ix1[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+
+
+def addStamps(image, stamps, iy1, ix1):
+    """
+    Scatter-add a stack of square stamps into an image, in place.
+
+    Parameters
+    ----------
+    image: 2D ndarray
+        Image to which the stamps are added. Needs to be C-contiguous.
+    stamps: 3D ndarray
+        Stack of (n, npix, npix) stamps
+    iy1, ix1: 1D int arrays
+        Lower-left pixel of each stamp in the image. All stamps must lie
+        entirely within the image.
+    """
+    if stamps.shape[0] == 0:
+        return image
+    indx = np.reshape(_stamp_indices(iy1, ix1, stamps.shape[-1], image.shape), -1)
+    # only accumulate over the range of pixels covered by the stamps
+    lo = np.amin(indx)
+    hi = np.amax(indx) + 1
+    flat = image.reshape(-1)
+    flat[lo:hi] += np.bincount(indx - lo, weights=np.reshape(stamps, -1),
+                                     minlength=hi - lo)
+    return image
+
+
+def makeStamps(hires, xcen, ycen, vals, imshape, upsample=3, npix=13):
+    """
+    Interpolates the prefiltered high-resolution PSFLet templates at the
+    sub-pixel position of every PSFLet, in a single call to
+    ndimage.map_coordinates per template.
+
+    Parameters
+    ----------
+    hires: 4D ndarray
+        nsubarr x nsubarr spline-prefiltered templates, see templates.interpolateTemplates
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets in image coordinates. All PSFLets need to
+        fall at least npix//2 pixels away from the edges of the image.
+    vals: 1D array
+        Flux of each PSFLet
+    imshape: tuple
+        Shape of the (padded) detector image, used to select the templates
+    upsample: int
+        Factor by which the templates are oversampled
+    npix: int
+        Size of each stamp in detector pixels
+
+    Returns
+    -------
+    stamps: 3D ndarray
+        (n, npix, npix) stack of PSFLet stamps, with the same type as hires
+    iy1, ix1: 1D int arrays
+        Lower-left pixel of each stamp in the image
+    """
+    iy1, ix1 = _stamp_origins(xcen, ycen, npix)
+    offsets = np.arange(npix)
+    yinterp = ((iy1 - ycen)[:, np.newaxis] + offsets[np.newaxis, :]) * upsample + upsample * npix / 2.
+    xinterp = ((ix1 - xcen)[:, np.newaxis] + offsets[np.newaxis, :]) * upsample + upsample * npix / 2.
+    yinterp = np.broadcast_to(yinterp[:, :, np.newaxis], (len(xcen), npix, npix))
+    xinterp = np.broadcast_to(xinterp[:, np.newaxis, :], (len(xcen), npix, npix))
+
+    if len(xcen) == 0:
+        stamps = np.zeros((0, npix, npix), dtype=hires.dtype)
+    elif hires.shape[0] == 1 and hires.shape[1] == 1:
+        stamps = ndimage.map_coordinates(hires[0, 0], [yinterp, xinterp], prefilter=False)
+        stamps *= vals[:, np.newaxis, np.newaxis].astype(hires.dtype)
     else:
-        imagePlaneRot = Rotate(paddedImagePlane, par.philens, clip=False)
+        ################################################################
+        # Take the weighted average of the four nearest templates.
+        # Each template is interpolated only once, for all the PSFLets
+        # that use it.
+        ################################################################
+        stamps = np.zeros((len(xcen), npix, npix), dtype=hires.dtype)
+        weights = _template_weights(xcen, ycen, imshape, hires.shape[:2])
+        for j in range(hires.shape[0]):
+            for i in range(hires.shape[1]):
+                totweight = np.zeros(len(xcen))
+                for jw, iw, w in weights:
+                    totweight += w * (jw == j) * (iw == i)
+                use = np.where(totweight > 0)[0]
+                if len(use) == 0:
+                    continue
+                stamps[use] += (vals[use] * totweight[use]).astype(hires.dtype)[:, np.newaxis, np.newaxis] * \
+                    ndimage.map_coordinates(hires[j, i], [yinterp[use], xinterp[use]], prefilter=False)
 
-    ######################################################################
-    # Flux conservative rebinning
-    ######################################################################
-    newShape = (int(imagePlaneRot.shape[0] /
-                    par.pixperlenslet), int(imagePlaneRot.shape[1] /
-                                            par.pixperlenslet))
-    imagePlaneRot = frebin(imagePlaneRot, newShape)
-    log.debug('Input plane is %dx%d' % imagePlaneRot.shape)
+    return stamps, iy1, ix1
+
+
+def phaseStamps(tables, xcen, ycen, vals, imshape, npix=13, blend=True):
+    """
+    Looks the stamps of every PSFLet up in sub-pixel phase tables instead of
+    interpolating the templates, see tools.phasetables.
+
+    Parameters
+    ----------
+    tables: list of tuples
+        (table, weight) of the phase tables that bracket the wavelength of the
+        PSFLets, see phasetables.phaseTablesAt. The stamps are blended from them
+        with these weights.
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets in image coordinates. All PSFLets need to
+        fall at least npix//2 pixels away from the edges of the image.
+    vals: 1D array
+        Flux of each PSFLet
+    imshape: tuple
+        Shape of the (padded) detector image, used to select the templates
+    npix: int
+        Size of each stamp in detector pixels
+    blend: boolean
+        Blend the stamps of the four phases around each centroid bilinearly.
+        If False, use the stamp of the nearest phase.
+
+    Returns
+    -------
+    stamps: 3D ndarray
+        (n, npix, npix) stack of PSFLet stamps, with the same type as the tables
+    iy1, ix1: 1D int arrays
+        Lower-left pixel of each stamp in the image
+    """
+    iy1, ix1 = _stamp_origins(xcen, ycen, npix)
+    table = tables[0][0]
+    stamps = np.zeros((len(xcen), npix, npix), dtype=table.dtype)
+    if len(xcen) == 0:
+        return stamps, iy1, ix1
+
+    nphase = table.shape[2] - 1
+    yphase = (ycen - iy1 - npix // 2) * nphase
+    xphase = (xcen - ix1 - npix // 2) * nphase
+    if blend:
+        my = np.minimum(yphase.astype(int), nphase - 1)
+        mx = np.minimum(xphase.astype(int), nphase - 1)
+        ty = yphase - my
+        tx = xphase - mx
+        phases = [(my, mx, (1 - ty) * (1 - tx)),
+                  (my + 1, mx, ty * (1 - tx)),
+                  (my, mx + 1, (1 - ty) * tx),
+                  (my + 1, mx + 1, ty * tx)]
+    else:
+        phases = [(np.rint(yphase).astype(int), np.rint(xphase).astype(int), 1.)]
+
+    if table.shape[0] == 1 and table.shape[1] == 1:
+        zero = np.zeros(len(xcen), dtype=int)
+        weights = [(zero, zero, 1.)]
+    else:
+        weights = _template_weights(xcen, ycen, imshape, table.shape[:2])
+
+    for table, wlam in tables:
+        for j, i, w in weights:
+            for my, mx, wphase in phases:
+                scale = (vals * w * wphase * wlam).astype(table.dtype)
+                stamps += scale[:, np.newaxis, np.newaxis] * table[j, i, my, mx]
+    return stamps, iy1, ix1
+
+
+def stampPSFLets(image, hires, xcen, ycen, vals, upsample=3, npix=13):
+    """
+    Batched PSFLet stamping engine.
+
+    Builds the stamps of all the PSFLets with makeStamps and scatter-adds
+    them into the image at once.
+
+    Parameters
+    ----------
+    image: 2D ndarray
+        Detector image (padded) to which the PSFLets are added, modified in place
+    hires: 4D ndarray
+        nsubarr x nsubarr spline-prefiltered templates, see templates.interpolateTemplates
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets in image coordinates. All PSFLets need to
+        fall at least npix//2 pixels away from the edges of the image.
+    vals: 1D array
+        Flux of each PSFLet
+    upsample: int
+        Factor by which the templates are oversampled
+    npix: int
+        Size of each stamp in detector pixels
+
+    Returns
+    -------
+    image: 2D ndarray
+        The input image with the PSFLets added
+    """
+    if len(xcen) == 0:
+        return image
+    stamps, iy1, ix1 = makeStamps(hires, xcen, ycen, vals, image.shape, upsample, npix)
+    return addStamps(image, stamps, iy1, ix1)
+
+
+def blendTemplates(hires, xcen, ycen, imshape):
+    """
+    Blends the four field-dependent templates nearest to each PSFLet into a
+    single template per PSFLet
+
+    Parameters
+    ----------
+    hires: 4D ndarray
+        nsubarr x nsubarr spline-prefiltered templates, see templates.interpolateTemplates
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets on the (padded) detector, used for the blending weights
+    imshape: tuple
+        Shape of the (padded) detector image
+
+    Returns
+    -------
+    blended: 3D ndarray
+        One template per PSFLet, extended by _blendpad mirrored coefficients on
+        each side. Since the spline interpolation is linear in the prefiltered
+        coefficients, interpolating a blended template is the same as blending
+        the interpolated templates.
+
+    Notes
+    -----
+    ndimage.map_coordinates with mode='constant' reads the coefficients beyond
+    the edges of a template mirrored, and returns zero at coordinates outside of
+    it. The mirrored border reproduces the former in a mosaic of templates;
+    blendedStamps does the latter.
+    """
+    p = _blendpad
+    nsub = hires.shape[0] * hires.shape[1]
+    weights = np.zeros((len(xcen), nsub), dtype=hires.dtype)
+    for jw, iw, w in _template_weights(xcen, ycen, imshape, hires.shape[:2]):
+        np.add.at(weights, (np.arange(len(xcen)), jw * hires.shape[1] + iw), w)
+    blended = np.reshape(np.dot(weights, np.reshape(hires, (nsub, -1))),
+                         (len(xcen),) + hires.shape[2:])
+    return np.pad(blended, ((0, 0), (p, p), (p, p)), mode='reflect')
+
+
+def blendedStamps(blended, sel, xcen, ycen, vals, upsample=3, npix=13):
+    """
+    PSFLet stamps from pre-blended templates, with a single call to
+    ndimage.map_coordinates on the mosaic of all the templates
+
+    Parameters
+    ----------
+    blended: 3D ndarray
+        Pre-blended templates, see blendTemplates
+    sel: 1D int array
+        Template of each PSFLet
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets in image coordinates
+    vals: 1D array
+        Flux of each PSFLet
+    upsample: int
+        Factor by which the templates are oversampled
+    npix: int
+        Size of each stamp in detector pixels
+
+    Returns
+    -------
+    stamps: 3D ndarray
+        (n, npix, npix) stack of PSFLet stamps
+    iy1, ix1: 1D int arrays
+        Lower-left pixel of each stamp in the image
+    """
+    nblend, ny, nx = blended.shape
+    iy1, ix1 = _stamp_origins(xcen, ycen, npix)
+    offsets = np.arange(npix)
+    yinterp = ((iy1 - ycen)[:, np.newaxis] + offsets[np.newaxis, :]) * upsample + upsample * npix / 2.
+    xinterp = ((ix1 - xcen)[:, np.newaxis] + offsets[np.newaxis, :]) * upsample + upsample * npix / 2.
 
-    return imagePlaneRot
+    # zero outside of the template, as map_coordinates does in makeStamps
+    yinside = (yinterp >= 0) & (yinterp <= ny - 2 * _blendpad - 1)
+    xinside = (xinterp >= 0) & (xinterp <= nx - 2 * _blendpad - 1)
+
+    yinterp = yinterp + _blendpad + (sel * ny)[:, np.newaxis]
+    xinterp = xinterp + _blendpad
+    yinterp = np.broadcast_to(yinterp[:, :, np.newaxis], (len(xcen), npix, npix))
+    xinterp = np.broadcast_to(xinterp[:, np.newaxis, :], (len(xcen), npix, npix))
+    stamps = ndimage.map_coordinates(np.reshape(blended, (nblend * ny, nx)),
+                                     [yinterp, xinterp], prefilter=False)
+    stamps *= vals[:, np.newaxis, np.newaxis].astype(blended.dtype)
+    stamps *= yinside[:, :, np.newaxis] & xinside[:, np.newaxis, :]
+    return stamps, iy1, ix1
+
+
+def _preblendBlock(image, lock, hires, xblend, yblend, fullshape, positions, block,
+                   vals, upsample, npix, origin):
+    '''
+    Stamps a block of lenslets at all the sub-wavelengths of a bin, from
+    templates blended once for the whole bin at each anchor wavelength
+    '''
+    blended = [blendTemplates(h, xblend[block], yblend[block], fullshape) for h in hires]
+    # each stamp pixel reads 4 x 4 spline coefficients
+    combine = blended[0].shape[1] * blended[0].shape[2] < 16 * npix ** 2
+    for xcen, ycen, use, terms in positions:
+        sel = np.where(use[block])[0]
+        if len(sel) == 0:
+            continue
+        indx = block[sel]
+        if len(terms) > 1 and combine:
+            # combining the anchors is cheaper than a second interpolation
+            mosaic = sum([blended[ia] * coef for ia, coef in terms])
+            terms = [(mosaic, 1.)]
+        else:
+            terms = [(blended[ia], coef) for ia, coef in terms]
+        stamps = 0
+        for mosaic, coef in terms:
+            _stamps, iy1, ix1 = blendedStamps(mosaic, sel, xcen[indx], ycen[indx],
+                                              vals[indx] * coef, upsample, npix)
+            stamps = stamps + _stamps
+        with lock:
+            addStamps(image, stamps, iy1 - origin[0], ix1 - origin[1])
+
+
+def addPreblendedStamps(image, hires, xblend, yblend, fullshape, positions, vals,
+                        upsample=3, npix=13, origin=(0, 0), nthreads=1):
+    """
+    Adds the PSFLets of a wavelength bin to an image, blending the
+    field-dependent templates of each PSFLet once for the whole bin
+
+    Parameters
+    ----------
+    image: 2D ndarray
+        Image to which the PSFLets are added, in place
+    hires: list of 4D ndarrays
+        Spline-prefiltered templates at each anchor wavelength, see templates.templateAnchors
+    xblend, yblend: 1D arrays
+        Centroids on the full (padded) detector used for the blending weights
+        of each PSFLet, usually at the center of the bin
+    fullshape: tuple
+        Shape of the full (padded) detector
+    positions: list of tuples
+        (xcen, ycen, use, terms) at each sub-wavelength: centroids on the full
+        detector, boolean mask of the PSFLets to stamp, and (anchor, coefficient)
+        pairs giving the templates at that sub-wavelength
+    vals: 1D array
+        Flux of each PSFLet at each sub-wavelength
+    upsample, npix:
+        Same as in makeStamps
+    origin: tuple
+        Detector pixel (y, x) of the lower-left corner of image
+    nthreads: int
+        Number of threads among which the PSFLets are split
+
+    Returns
+    -------
+    image: 2D ndarray
+        Input image with the PSFLets added
+
+    Notes
+    -----
+    The blending weights are frozen at (xblend, yblend) for the whole bin,
+    while the wavelength dependence of the templates is kept exactly. The
+    PSFLets are processed in blocks of _blendblock to bound the size of the
+    blended templates.
+    """
+    lock = threading.Lock()
+    active = np.where(np.any([pos[2] for pos in positions], axis=0))[0]
+    nblocks = max(nthreads, int(np.ceil(len(active) * 1. / _blendblock)))
+    blocks = [block for block in np.array_split(active, nblocks) if len(block) > 0]
+    threadMap(_preblendBlock,
+              [(image, lock, hires, xblend, yblend, fullshape, positions, block,
+                vals, upsample, npix, origin) for block in blocks],
+              nthreads)
+    return image
+
+
+def _erfProfile(d, sigma, width):
+    """
+    Integral of a unit 1D Gaussian over intervals of size width centered on d,
+    divided by width
+    """
+    s = np.sqrt(2) * sigma
+    return (erf((d + width / 2.) / s) - erf((d - width / 2.) / s)) / (2. * width)
+
+
+def gaussianStamps(par, lam, xcen, ycen, vals, upsample=10, npix=13):
+    """
+    Closed-form Gaussian PSFLet stamps, used instead of the templates when
+    par.gaussian is True.
+
+    Each stamp is the outer product of two 1D differences of error functions,
+    evaluated for all the PSFLets at once. This is the function tabulated by
+    wavecal.get_sim_hires, so no templates nor spline interpolation are needed.
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy, with FWHM (in detector pixels at FWHMlam)
+        and FWHMlam
+    lam: float
+        Wavelength in nm. The width of the PSFLet scales linearly with lam
+    xcen, ycen: 1D arrays
+        Centroids of the PSFLets in image coordinates. All PSFLets need to
+        fall at least npix//2 pixels away from the edges of the image.
+    vals: 1D array
+        Flux of each PSFLet
+    upsample: int
+        The Gaussian is integrated over 1/upsample of a detector pixel around the
+        center of each pixel, which reproduces the templates of get_sim_hires
+        oversampled by the same factor. Use upsample=1 to integrate over the full
+        detector pixels.
+    npix: int
+        Size of each stamp in detector pixels
+
+    Returns
+    -------
+    stamps: 3D ndarray
+        (n, npix, npix) stack of PSFLet stamps, with the type set by par.precision
+    iy1, ix1: 1D int arrays
+        Lower-left pixel of each stamp in the image
+
+    Notes
+    -----
+    As with the templates, the PSFLet is centered half a pixel away from
+    (xcen, ycen) along each axis. If par.pxperdetpix > 1, the profiles are
+    averaged over par.pxperdetpix points across each pixel, like the templates
+    in templates.pixelIntegrate.
+    """
+    dtype = getDtype(par)
+    iy1, ix1 = _stamp_origins(xcen, ycen, npix)
+    sigma = par.FWHM / 2.35 * lam / par.FWHMlam
+    nsub = int(getattr(par, 'pxperdetpix', 1))
+    offsets = np.arange(npix) - 0.5
+    yprof = 0.
+    xprof = 0.
+    for sub in (np.arange(nsub) + 0.5) / nsub - 0.5:
+        yprof = yprof + _erfProfile((iy1 - ycen)[:, np.newaxis] + offsets[np.newaxis, :] + sub,
+                                    sigma, 1. / upsample) / nsub
+        xprof = xprof + _erfProfile((ix1 - xcen)[:, np.newaxis] + offsets[np.newaxis, :] + sub,
+                                    sigma, 1. / upsample) / nsub
+    yprof *= vals[:, np.newaxis]
+    stamps = yprof.astype(dtype)[:, :, np.newaxis] * xprof.astype(dtype)[:, np.newaxis, :]
+    return stamps, iy1, ix1
+
+
+def _stampBlock(image, lock, render, xcen, ycen, vals):
+    '''
+    Stamps a block of lenslets into a frame shared between threads. The
+    stamps are computed concurrently by render(xcen, ycen, vals), only the
+    accumulation is serialized.
+    '''
+    stamps, iy1, ix1 = render(xcen, ycen, vals)
+    with lock:
+        addStamps(image, stamps, iy1, ix1)
+
+
+def subWavelengths(lam1, lam2, nlam):
+    """
+    Wavelengths used to sample the bin [lam1, lam2], evenly spaced in log
+    """
+    dloglam = (np.log(lam2) - np.log(lam1)) / nlam
+    loglam = np.log(lam1) + dloglam / 2. + np.arange(nlam) * dloglam
+    return np.exp(loglam)
+
+
+def adaptiveNlam(xcen1, ycen1, xcen2, ycen2, lamtol):
+    """
+    Number of sub-wavelengths needed to sample a wavelength bin so that no
+    PSFLet moves by more than lamtol pixels between consecutive sub-wavelengths
+
+    Parameters
+    ----------
+    xcen1, ycen1: arrays
+        Positions of the PSFLets at the short end of the bin
+    xcen2, ycen2: arrays
+        Positions of the same PSFLets at the long end of the bin
+    lamtol: float
+        Maximum PSFLet motion in detector pixels between two sub-wavelengths
+
+    Returns
+    -------
+    nlam: int
+        Number of sub-wavelengths, at least 1
+    """
+    shift = np.sqrt((np.asarray(xcen2) - xcen1)**2 + (np.asarray(ycen2) - ycen1)**2)
+    shift = shift[np.isfinite(shift)]
+    if len(shift) == 0:
+        return 1
+    return max(1, int(np.ceil(np.amax(shift) / lamtol)))
+
+
+def subWavelengthCounts(par, shape, wavelist_endpts, lamtol=None, nlam=10,
+                        order=3, x0=0.0):
+    """
+    Number of sub-wavelengths used by propagateLenslets in each wavelength bin
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    shape: tuple
+        Shape of the image plane, where each pixel corresponds to one lenslet
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    lamtol: float
+        Maximum PSFLet motion in detector pixels between two sub-wavelengths.
+        If None, every bin uses nlam sub-wavelengths
+    nlam: int
+        Number of sub-wavelengths per bin when lamtol is None
+    order, x0:
+        Same as in propagateLenslets
+
+    Returns
+    -------
+    nlams: tuple of ints
+        Number of sub-wavelengths in each bin
+
+    Notes
+    -----
+    The motion is predicted from the same wavelength solution as the PSFLet
+    positions, i.e. PSFLets.return_locations if par.PSFLetPositions, or par.npixperdlam
+    otherwise, for all the lenslets of the image plane.
+    """
+    nbins = len(wavelist_endpts) - 1
+    if lamtol is None:
+        return tuple([int(nlam)] * nbins)
+    psftool, allcoef = loadPSFLetPositions(par)
+    xindx, yindx, inplane, planeindx = lensletGrid(shape)
+    inplane = np.reshape(inplane, xindx.shape)
+    xindx = xindx[inplane]
+    yindx = yindx[inplane]
+    locs = [lensletLocations(par, lam, xindx, yindx, order, x0, psftool, allcoef)
+            for lam in wavelist_endpts]
+    return tuple([adaptiveNlam(locs[k][0], locs[k][1], locs[k + 1][0], locs[k + 1][1], lamtol)
+                  for k in range(nbins)])
+
+
+def lensletGrid(shape):
+    """
+    Lenslet indices corresponding to an image plane, as used by propagateLenslets
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the image plane, where each pixel corresponds to one lenslet
+
+    Returns
+    -------
+    xindx, yindx: 2D int arrays
+        Lenslet indices relative to the center of the array
+    inplane: 1D boolean array
+        Whether each (flattened) lenslet falls within the image plane
+    planeindx: 1D int array
+        Flat index in the image plane of each lenslet, -1 where not inplane
+    """
+    ydim, xdim = shape
+    xindx = np.arange(-xdim // 2, -xdim // 2 + xdim)
+    xindx, yindx = np.meshgrid(xindx, xindx)
+
+    # these are the coordinates of the lenslets within the image plane
+    Ycoord = np.reshape(yindx + shape[0] // 2, -1)
+    Xcoord = np.reshape(xindx + shape[1] // 2, -1)
+    inplane = (Xcoord > 0) * (Xcoord < shape[1]) * \
+        (Ycoord > 0) * (Ycoord < shape[0])
+    planeindx = np.where(inplane, Xcoord * shape[1] + Ycoord, -1)
+    return xindx, yindx, inplane, planeindx
+
+
+def activeLenslets(cube, threshold=0.0):
+    """
+    Lenslets that receive flux in a cube of image planes
+
+    Parameters
+    ----------
+    cube: 3D ndarray
+        Stack of image planes, where each pixel corresponds to one lenslet
+    threshold: float
+        Lenslets whose flux stays at or below threshold times the flux of the
+        brightest lenslet of the cube in every slice are dropped. With the default
+        of 0, only the lenslets that are dark in all the slices are dropped.
+
+    Returns
+    -------
+    lenslets: 1D int array
+        Flat indices, in the order of lensletGrid, of the lenslets to propagate
+    dropped: float
+        Fraction of the total (absolute) flux of the cube carried by the dropped lenslets
+    """
+    cube = np.asarray(cube)
+    xindx, yindx, inplane, planeindx = lensletGrid(cube.shape[1:])
+    candidates = np.where(inplane)[0]
+    flux = np.abs(np.reshape(cube, (cube.shape[0], -1))[:, planeindx[candidates]])
+    if flux.size == 0:
+        return candidates, 0.0
+    keep = np.any(flux > threshold * np.amax(flux), axis=0)
+    total = np.sum(flux)
+    dropped = np.sum(flux[:, ~keep]) / total if total > 0 else 0.0
+    return candidates[keep], float(dropped)
+
+
+def loadPSFLetPositions(par):
+    """
+    Loads the wavelength solution used to place the PSFLets when
+    par.PSFLetPositions is True
+
+    Returns
+    -------
+    psftool: PSFLets instance or None
+    allcoef: 2D array or None
+    """
+    if not par.PSFLetPositions:
+        return None, None
+    psftool = PSFLets()
+    lamsol = loadLamsol(par)
+    lamlist = lamsol[:, 0]
+    allcoef = lamsol[:, 1:]
+    psftool.geninterparray(lamlist, allcoef)
+    return psftool, allcoef
+
+
+def lensletLocations(par, lam, xindx, yindx, order=3, x0=0.0,
+                     psftool=None, allcoef=None):
+    """
+    Detector location of the PSFLets of the lenslets xindx, yindx at wavelength lam
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    lam: float
+        Wavelength in nm
+    xindx, yindx: arrays
+        Lenslet indices
+    order: int
+        Order used in the polynomial fit of the wavelength solution
+    x0: float
+        Offset from the center of the detector in the vertical direction (x)
+    psftool, allcoef:
+        Wavelength solution as returned by loadPSFLetPositions, used when
+        par.PSFLetPositions is True
+
+    Returns
+    -------
+    xcen, ycen: arrays
+        Detector coordinates of the PSFLets, with the same shape as xindx
+    """
+    ################################################################
+    # here is where one could import any kind of polynomial mapping
+    # and introduce distortions
+    ################################################################
+    if par.PSFLetPositions:
+        return psftool.return_locations(
+            lam, allcoef, xindx, yindx, order=order)
+    dispersion = par.npixperdlam * par.R * np.log(lam / par.FWHMlam)
+    coef = initcoef(
+        order,
+        scale=par.pitch / par.pixsize,
+        phi=par.philens,
+        x0=par.npix // 2 + dispersion,
+        y0=par.npix // 2 + x0)
+    return transform(xindx, yindx, order, coef)
 
 
 def propagateLenslets(
@@ -77,7 +936,10 @@ def propagateLenslets(
         nlam=10,
         npix=13,
         order=3,
-        x0=0.0):
+        x0=0.0,
+        nthreads=1,
+        lenslets=None,
+        region=None):
     """
     Function propagateLenslets
 
@@ -97,198 +959,176 @@ def propagateLenslets(
     lam2: float
         Maximum wavelength in IFS band
     hires_arr: 4D ndarray
-        For each wavelength, for each location on the detector, a 2D array of the oversampled PSFLet
+        For each wavelength, for each location on the detector, a 2D array of the oversampled PSFLet.
+        Not used if par.gaussian is True
     lam_arr: 1D array
         Wavelength array corresponding to the hires_arr array
     upsample: int
         Factor by which the PSFLets are oversampled
     nlam: int
-        Number of wavelengths to oversample a given wavelength bin
+        Number of wavelengths to oversample a given wavelength bin, see subWavelengthCounts
+        to choose it from the PSFLet motion across the bin
     npix: int
        PSFLet will be put on npix*npix detector pixels, models will be (npix*upsample)^2
     order: int
         Order used in the polynomial fit of the wavelength solution
     x0: float
         Offset from the center of the detector in the vertical direction (x)
-    """
+    nthreads: int
+        Number of threads among which the lenslets are split. The stamps of each
+        block of lenslets are computed concurrently and added to the same frame.
+    lenslets: 1D int array
+        Flat indices of the lenslets to propagate, as returned by activeLenslets. Computing
+        them once for a whole cube avoids going through the dark lenslets at every
+        wavelength. Defaults to all the lenslets of the image plane.
+    region: tuple
+        (y1, y2, x1, x2) detector pixels to compute, see tools.tiling. Defaults to the
+        whole detector. PSFLets that fall partly outside the region are cut as they would
+        be at the edges of the detector.
 
-    padding = 10
-    ydim, xdim = imageplane.shape
+    Returns
+    -------
+    image: 2D ndarray
+        Detector image, or the part of it given by region
 
-    xindx = np.arange(-xdim // 2, -xdim // 2 + xdim)
-    xindx, yindx = np.meshgrid(xindx, xindx)
+    Notes
+    -----
+    All the lenslets are stamped at once for each sub-wavelength, with makeStamps.
+    The interpolated templates are taken from the shared templates.templateCache.
+    If par.gaussian is True, the stamps are instead computed in closed form by
+    gaussianStamps and no templates are needed.
 
-    image = np.zeros((par.npix + 2 * padding, par.npix + 2 * padding))
-    x = np.arange(image.shape[0])
-    x, y = np.meshgrid(x, x)
+    If par.preblend is True and the templates vary across the field, the four templates
+    nearest to each lenslet are blended once per bin (see blendTemplates), with the weights
+    of the lenslet position at the center of the bin. Each stamp then needs one
+    interpolation instead of four (two for coarsely sampled templates between two
+    wavelengths of lam_arr). The wavelength dependence of the templates is kept
+    exactly; only the motion of the PSFLet across the field regions within one bin is
+    neglected, which changes the frames by about 4e-4 of their peak for 10 nm bins
+    with the Calibra_170425 templates.
 
-    dloglam = (np.log(lam2) - np.log(lam1)) / nlam
-    loglam = np.log(lam1) + dloglam / 2. + np.arange(nlam) * dloglam
+    If par.pxperdetpix > 1, each detector pixel is the average of the PSFLet over
+    pxperdetpix x pxperdetpix points across the pixel, as if the frame was computed
+    pxperdetpix times oversampled and rebinned. The averaging is folded into the
+    templates (see templates.pixelIntegrate) or into the closed-form Gaussian, so the
+    frame is computed directly on the par.npix grid at the same cost.
+
+    If par.nphase is set (and par.preblend is not), the stamps are looked up in
+    tables of stamps precomputed on a grid of par.nphase sub-pixel phases per pixel
+    and blended bilinearly between phases, see phaseStamps and tools.phasetables.
+    Only the tables of the templates that bracket lam1 and lam2 are used. They are
+    saved in par.wavecalDir, and the error of the lookup is logged when they are built
+    or loaded. It falls as 1/nphase**2, except along the border of templates that do
+    not go to zero there (see tools.phasetables).
+    """
+
+    if not par.gaussian and ((hires_arrs is None) or (lam_arr is None)):
+        log.error('No template PSFLets given!')
+        return
+
+    padding = 10
+    if region is None:
+        region = (0, par.npix, 0, par.npix)
+    y1, y2, x1, x2 = region
+    image = np.zeros((y2 - y1 + 2 * padding, x2 - x1 + 2 * padding))
+    fullshape = (par.npix + 2 * padding, par.npix + 2 * padding)
 
     # load external PSFLet positions
-    if par.PSFLetPositions:
-        psftool = PSFLets()
-        lamlist = np.loadtxt(par.wavecalDir + "lamsol.dat")[:, 0]
-        allcoef = np.loadtxt(par.wavecalDir + "lamsol.dat")[:, 1:]
-        psftool.geninterparray(lamlist, allcoef)
+    psftool, allcoef = loadPSFLetPositions(par)
 
-    for lam in np.exp(loglam):
+    ################################################################
+    # Flux of each lenslet of the compact index.  Lenslets with zero
+    # flux are dropped right away.
+    ################################################################
+    xindx, yindx, inplane, planeindx = lensletGrid(imageplane.shape)
+    if lenslets is None:
+        lenslets = np.where(inplane)[0]
+    xindx = np.reshape(xindx, -1)[lenslets]
+    yindx = np.reshape(yindx, -1)[lenslets]
+    vals = np.reshape(imageplane, -1)[planeindx[lenslets]]
+    lit = vals != 0.0
 
+    if not par.gaussian and getattr(par, 'preblend', False) and \
+            hires_arrs[0].shape[0] * hires_arrs[0].shape[1] > 1:
         ################################################################
-        # Build the appropriate average hires image by averaging over
-        # the nearest wavelengths.  Then apply a spline filter to the
-        # interpolated high resolution PSFlet images to avoid having
-        # to do this later, saving a factor of a few in time.
+        # Blend the field-dependent templates of each lenslet once for
+        # the bin, with the weights of its central position, at one or
+        # two anchor wavelengths per interval of lam_arr (see
+        # templateAnchors). The blended templates at each sub-wavelength
+        # are linear combinations of those, so each stamp needs a single
+        # interpolation instead of four.
         ################################################################
+        lamsub = subWavelengths(lam1, lam2, nlam)
+        anchors, allterms = templateAnchors(lam_arr, lamsub)
+        setkey = templateSetKey(hires_arrs, lam_arr)
+        hires = [templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey, upsample=upsample,
+                                   pxperdetpix=par.pxperdetpix) for lam in anchors]
+        xblend, yblend = lensletLocations(par, subWavelengths(lam1, lam2, 1)[0], xindx, yindx,
+                                          order, x0, psftool, allcoef)
+        positions = []
+        for lam, terms in zip(lamsub, allterms):
+            xcen, ycen = lensletLocations(par, lam, xindx, yindx, order, x0,
+                                          psftool, allcoef)
+            xcen = np.reshape(xcen, -1) + padding
+            ycen = np.reshape(ycen, -1) + padding
+            ondet = (xcen - x1 > npix // 2) * (xcen - x1 < image.shape[1] - npix // 2) * \
+                (ycen - y1 > npix // 2) * (ycen - y1 < image.shape[0] - npix // 2)
+            positions += [(xcen, ycen, ondet * lit, terms)]
+        addPreblendedStamps(image, hires, np.reshape(xblend, -1) + padding,
+                            np.reshape(yblend, -1) + padding, fullshape, positions,
+                            vals / nlam, upsample, npix, (y1, x1), nthreads)
+        image = image[padding:-padding, padding:-padding]
+        return image.astype(getDtype(par))
 
-        if (hires_arrs is None) or (lam_arr is None):
-            log.error('No template PSFLets given!')
-            return
-        else:
-            hires = np.zeros((hires_arrs[0].shape))
-            if lam <= np.amin(lam_arr):
-                hires[:] = hires_arrs[0]
-            elif lam >= np.amax(lam_arr):
-                hires[:] = hires_arrs[-1]
-            else:
-                i1 = np.amax(np.arange(len(lam_arr))[np.where(lam > lam_arr)])
-                i2 = i1 + 1
-                hires = hires_arrs[i1] * \
-                    (lam - lam_arr[i1]) / (lam_arr[i2] - lam_arr[i1])
-                hires += hires_arrs[i2] * \
-                    (lam_arr[i2] - lam) / (lam_arr[i2] - lam_arr[i1])
-
-            for i in range(hires.shape[0]):
-                for j in range(hires.shape[1]):
-                    hires[i, j] = ndimage.spline_filter(hires[i, j])
+    nphase = getattr(par, 'nphase', None)
+    if par.gaussian:
+        pass
+    elif nphase:
+        tables = loadPhaseTables(hires_arrs, lam_arr, list(subWavelengths(lam1, lam2, nlam)),
+                                 upsample, npix, nphase, par.pxperdetpix,
+                                 getattr(par, 'wavecalDir', None))[0]
+    else:
+        setkey = templateSetKey(hires_arrs, lam_arr)
+    lock = threading.Lock()
+    for lam in subWavelengths(lam1, lam2, nlam):
 
-        ################################################################
-        # Run through lenslet centroids at this wavelength using the
-        # fitted coefficients in psftool to get the centroids.  For
-        # each centroid, compute the weights for the four nearest
-        # regions on which the high-resolution PSFlets have been made.
-        # Interpolate the high-resolution PSFlets and take their
-        # weighted average, adding this to the image in the
-        # appropriate place.
-        ################################################################
+        if par.gaussian:
+            def render(xcen, ycen, vals, lam=lam):
+                return gaussianStamps(par, lam, xcen, ycen, vals, upsample, npix)
+        elif nphase:
+            lamtables = phaseTablesAt(tables, lam_arr, lam)
 
-        ################################################################
-        # here is where one could import any kind of polynomial mapping
-        # and introduce distortions
-        ################################################################
-        if par.PSFLetPositions:
-            xcen, ycen = psftool.return_locations(
-                lam, allcoef, xindx, yindx, order=order)
+            def render(xcen, ycen, vals, lamtables=lamtables):
+                stamps, iy1, ix1 = phaseStamps(lamtables, xcen + x1, ycen + y1, vals, fullshape,
+                                               npix)
+                return stamps, iy1 - y1, ix1 - x1
         else:
-            dispersion = par.npixperdlam * par.R * np.log(lam / par.FWHMlam)
-            coef = initcoef(
-                order,
-                scale=par.pitch / par.pixsize,
-                phi=par.philens,
-                x0=par.npix // 2 + dispersion,
-                y0=par.npix // 2 + x0)
-            xcen, ycen = transform(xindx, yindx, order, coef)
-
-        xcen += padding
-        ycen += padding
-        xindx = np.reshape(xindx, -1)
-        yindx = np.reshape(yindx, -1)
-        xcen = np.reshape(xcen, -1)
-        ycen = np.reshape(ycen, -1)
-        for i in range(xcen.shape[0]):
-            if not (
-                    xcen[i] > npix //
-                    2 and xcen[i] < image.shape[0] -
-                    npix //
-                    2 and ycen[i] > npix //
-                    2 and ycen[i] < image.shape[0] -
-                    npix //
-                    2):
-                continue
-
-            # these are the coordinates of the lenslet within the image plane
-            Ycoord = yindx[i] + imageplane.shape[0] // 2
-            Xcoord = xindx[i] + imageplane.shape[1] // 2
-
-            if not (Xcoord > 0 and Xcoord <
-                    imageplane.shape[1] and Ycoord > 0 and Ycoord < imageplane.shape[0]):
-                continue
-
-            val = imageplane[Xcoord, Ycoord]
-
-            # if the value is 0, don't waste time
-            if val == 0.0:
-                continue
-
-            # central pixel -> npix*upsample//2
-            iy1 = int(ycen[i]) - npix // 2
-            iy2 = iy1 + npix
-            ix1 = int(xcen[i]) - npix // 2
-            ix2 = ix1 + npix
-
-            yinterp = (y[iy1:iy2, ix1:ix2] - ycen[i]) * \
-                upsample + upsample * npix / 2.
-            xinterp = (x[iy1:iy2, ix1:ix2] - xcen[i]) * \
-                upsample + upsample * npix / 2.
-
-            # Now find the closest high-resolution PSFs from a library
-            if hires.shape[0] == 1 and hires.shape[1] == 1:
-                image[iy1:iy2,
-                      ix1:ix2] += val * ndimage.map_coordinates(hires[0,
-                                                                      0],
-                                                                [yinterp,
-                                                                 xinterp],
-                                                                prefilter=False) / nlam
-            else:
-                x_hires = xcen[i] * 1. / image.shape[1]
-                y_hires = ycen[i] * 1. / image.shape[0]
-
-                x_hires = x_hires * hires_arrs[0].shape[1] - 0.5
-                y_hires = y_hires * hires_arrs[0].shape[0] - 0.5
-
-                totweight = 0
-
-                if x_hires <= 0:
-                    i1 = i2 = 0
-                elif x_hires >= hires_arrs[0].shape[1] - 1:
-                    i1 = i2 = hires_arrs[0].shape[1] - 1
-                else:
-                    i1 = int(x_hires)
-                    i2 = i1 + 1
-
-                if y_hires < 0:
-                    j1 = j2 = 0
-                elif y_hires >= hires_arrs[0].shape[0] - 1:
-                    j1 = j2 = hires_arrs[0].shape[0] - 1
-                else:
-                    j1 = int(y_hires)
-                    j2 = j1 + 1
-
-                ##############################################################
-                # Bilinear interpolation by hand.  Do not extrapolate, but
-                # instead use the nearest PSFlet near the edge of the
-                # image.  The outer regions will therefore have slightly
-                # less reliable PSFlet reconstructions.  Then take the
-                # weighted average of the interpolated PSFlets.
-                ##############################################################
-                weight22 = max(0, (x_hires - i1) * (y_hires - j1))
-                weight12 = max(0, (x_hires - i1) * (j2 - y_hires))
-                weight21 = max(0, (i2 - x_hires) * (y_hires - j1))
-                weight11 = max(0, (i2 - x_hires) * (j2 - y_hires))
-                totweight = weight11 + weight21 + weight12 + weight22
-                weight11 /= totweight * nlam
-                weight12 /= totweight * nlam
-                weight21 /= totweight * nlam
-                weight22 /= totweight * nlam
-
-                image[iy1:iy2, ix1:ix2] += val * weight11 * \
-                    ndimage.map_coordinates(hires[j1, i1], [yinterp, xinterp], prefilter=False)
-                image[iy1:iy2, ix1:ix2] += val * weight12 * \
-                    ndimage.map_coordinates(hires[j1, i2], [yinterp, xinterp], prefilter=False)
-                image[iy1:iy2, ix1:ix2] += val * weight21 * \
-                    ndimage.map_coordinates(hires[j2, i1], [yinterp, xinterp], prefilter=False)
-                image[iy1:iy2, ix1:ix2] += val * weight22 * \
-                    ndimage.map_coordinates(hires[j2, i2], [yinterp, xinterp], prefilter=False)
+            hires = templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey,
+                                      upsample=upsample, pxperdetpix=par.pxperdetpix)
+
+            # the templates are selected from the position on the whole detector
+            def render(xcen, ycen, vals, hires=hires):
+                stamps, iy1, ix1 = makeStamps(hires, xcen + x1, ycen + y1, vals, fullshape,
+                                              upsample, npix)
+                return stamps, iy1 - y1, ix1 - x1
+
+        xcen, ycen = lensletLocations(par, lam, xindx, yindx, order, x0,
+                                      psftool, allcoef)
+        xcen = np.reshape(xcen, -1) + padding - x1
+        ycen = np.reshape(ycen, -1) + padding - y1
+        ondet = (xcen > npix // 2) * (xcen < image.shape[1] - npix // 2) * \
+            (ycen > npix // 2) * (ycen < image.shape[0] - npix // 2)
+        use = np.where(ondet * lit)[0]
+
+        if nthreads > 1 and len(use) > nthreads:
+            blocks = np.array_split(use, nthreads)
+            threadMap(_stampBlock,
+                      [(image, lock, render, xcen[block], ycen[block],
+                        vals[block] / nlam) for block in blocks],
+                      nthreads)
+        elif len(use) > 0:
+            stamps, iy1, ix1 = render(xcen[use], ycen[use], vals[use] / nlam)
+            addStamps(image, stamps, iy1, ix1)
 
     image = image[padding:-padding, padding:-padding]
-    return image
+    return image.astype(getDtype(par))
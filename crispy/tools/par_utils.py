@@ -1,4 +1,5 @@
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 ######################################################################
 # Controllers for parallel execution, one per worker.
@@ -32,3 +33,39 @@ class Task(object):
 
     def __call__(self):
         return self.index, self.func(*self.args)
+
+
+def threadMap(func, arglist, nthreads=None):
+    '''
+    Calls func(*args) for each args in arglist on a pool of threads
+
+    This is meant for work dominated by numpy/scipy routines that release
+    the GIL (e.g. ndimage.map_coordinates). Unlike the Consumer/Task
+    processes, nothing needs to be pickled: the threads share the templates
+    and can write into the same output arrays.
+
+    Parameters
+    ----------
+    func: function
+        Function to call
+    arglist: list of tuples
+        Arguments of each call
+    nthreads: int
+        Number of threads. Defaults to the number of CPUs
+
+    Returns
+    -------
+    results: list
+        Return values of func, in the order of arglist
+    '''
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    nthreads = max(1, min(nthreads, len(arglist)))
+    if nthreads == 1:
+        return [func(*args) for args in arglist]
+    pool = ThreadPool(nthreads)
+    try:
+        return pool.map(lambda args: func(*args), arglist)
+    finally:
+        pool.close()
+        pool.join()
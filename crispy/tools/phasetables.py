@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''
+Sub-pixel phase lookup tables of PSFLet stamps
+
+A stamp of npix x npix detector pixels only depends on the field region and
+wavelength of its templates, and on the sub-pixel phase of the PSFLet
+centroid, i.e. the fractional part of its position. The stamps are therefore
+computed once on a grid of nphase + 1 phases per axis, for every field region
+and every wavelength of the template set. Stamping a PSFLet then reduces to
+looking its stamps up in the table, blending the four phases around it
+bilinearly (or taking the nearest one), and adding them to the frame.
+
+The tables are linear in the templates, so the stamps at any wavelength are
+the same combination of the tables of the template set as the templates
+themselves (see templates.wavelengthWeights). Only the tables of the templates
+that bracket the wavelengths of a call are built or loaded, and phaseStamps
+blends the two of them while it looks the stamps up.
+
+The error made by the lookup is measured for each template when its table is
+built, against the exact interpolation of the template at the phases halfway
+between the grid points, where it is largest. It is split in two parts:
+
+- the phase error, over the pixels whose samples stay inside the template,
+  which decreases as 1/nphase**2 with the bilinear blend and as 1/nphase with
+  the nearest phase;
+- the edge error, over the pixels along the border of the stamp whose samples
+  cross the border of the template between two phases of the grid. The
+  interpolation drops to zero there as soon as the sample leaves the template,
+  so the error is about half the value of the template at its border, whatever
+  nphase. It is only small for templates that fall to zero at their borders.
+
+Tables are saved next to the hires templates, in single precision, as .npy files
+named after a hash of the template and of the table settings, so they are
+rebuilt whenever the templates change. They are memory-mapped when loaded.
+'''
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage
+from crispy.tools.templates import interpolateTemplates, templateSetKey, wavelengthWeights
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+# In-process cache of loaded tables, keyed by template and settings
+_tables = OrderedDict()
+_maxtables = 32
+_tablesLock = threading.Lock()
+
+
+def _phaseCoordinates(phases, upsample, npix):
+    '''
+    Template coordinates of the npix pixels of a stamp along one axis, for each phase
+    '''
+    offsets = np.arange(npix) - npix // 2
+    return (offsets[np.newaxis, :] - phases[:, np.newaxis]) * upsample + upsample * npix / 2.
+
+
+def _sampleTemplates(hires, yphases, xphases, upsample, npix):
+    '''
+    Stamps of every template of hires at every combination of yphases and xphases
+
+    Returns an array of shape (ny, nx, len(yphases), len(xphases), npix, npix)
+    '''
+    ycoords = _phaseCoordinates(yphases, upsample, npix)
+    xcoords = _phaseCoordinates(xphases, upsample, npix)
+    shape = (len(yphases), len(xphases), npix, npix)
+    yinterp = np.broadcast_to(ycoords[:, np.newaxis, :, np.newaxis], shape)
+    xinterp = np.broadcast_to(xcoords[np.newaxis, :, np.newaxis, :], shape)
+    stamps = np.zeros(hires.shape[:2] + shape, dtype=hires.dtype)
+    for j in range(hires.shape[0]):
+        for i in range(hires.shape[1]):
+            stamps[j, i] = ndimage.map_coordinates(hires[j, i], [yinterp, xinterp],
+                                                   prefilter=False)
+    return stamps
+
+
+def phaseTable(hires, upsample=3, npix=13, nphase=16):
+    '''
+    Stamps of a set of prefiltered templates on a grid of sub-pixel phases
+
+    Parameters
+    ----------
+    hires: 4D ndarray
+        nsubarr x nsubarr spline-prefiltered templates, see templates.interpolateTemplates
+    upsample: int
+        Factor by which the templates are oversampled
+    npix: int
+        Size of each stamp in detector pixels
+    nphase: int
+        Number of phases per detector pixel
+
+    Returns
+    -------
+    table: 6D ndarray
+        (ny, nx, nphase + 1, nphase + 1, npix, npix) stamps, where table[j, i, m, n]
+        is the stamp of template (j, i) for a PSFLet whose centroid is m / nphase
+        pixels above and n / nphase pixels to the right of a pixel boundary.
+        Phase nphase is the stamp of phase 0 shifted by one pixel, and is only
+        kept for the blend.
+    '''
+    phases = np.arange(nphase + 1) * 1. / nphase
+    return _sampleTemplates(hires, phases, phases, upsample, npix)
+
+
+def _edgePixels(nphase, upsample, npix, size):
+    '''
+    Whether the sample of each pixel of a stamp along one axis falls outside a
+    template of size samples at either end of each interval of the phase grid
+    '''
+    coords = _phaseCoordinates(np.arange(nphase + 1) * 1. / nphase, upsample, npix)
+    outside = (coords < 0) + (coords > size - 1)
+    return outside[:-1] + outside[1:]
+
+
+def phaseTableError(hires, table, upsample=3, npix=13):
+    '''
+    Largest errors of a phase table, relative to the peak of its stamps
+
+    The lookup is compared with the exact interpolation of the templates
+    halfway between the phases of the table, where the error is largest,
+    separately for the pixels whose samples cross the border of the templates
+    between two phases (see the module docstring).
+
+    Parameters
+    ----------
+    hires: 4D ndarray
+        Spline-prefiltered templates from which table was made
+    table: 6D ndarray
+        Phase table, see phaseTable
+    upsample, npix:
+        Same as in phaseTable
+
+    Returns
+    -------
+    error: 2D array
+        Phase error (first row) and edge error (second row) of the nearest
+        phase (first column) and of the bilinear blend of phases (second column)
+    '''
+    nphase = table.shape[2] - 1
+    midphases = (np.arange(nphase) + 0.5) / nphase
+    yedge = _edgePixels(nphase, upsample, npix, hires.shape[2])
+    xedge = _edgePixels(nphase, upsample, npix, hires.shape[3])
+    edge = yedge[:, np.newaxis, :, np.newaxis] + xedge[np.newaxis, :, np.newaxis, :]
+    error = np.zeros((2, 2))
+    for j in range(hires.shape[0]):
+        for i in range(hires.shape[1]):
+            exact = _sampleTemplates(hires[j:j + 1, i:i + 1], midphases, midphases,
+                                     upsample, npix)[0, 0]
+            t = table[j, i]
+            nearest = np.abs(t[:-1, :-1] - exact)
+            blend = np.abs(0.25 * (t[:-1, :-1] + t[1:, :-1] + t[:-1, 1:] + t[1:, 1:]) - exact)
+            for row, pixels in enumerate([~edge, edge]):
+                if np.any(pixels):
+                    error[row] = np.maximum(error[row], [np.amax(nearest[pixels]),
+                                                         np.amax(blend[pixels])])
+    return error / max(np.amax(np.abs(table)), 1e-30)
+
+
+def _tableFiles(store, arr, lam, upsample, npix, nphase, pxperdetpix):
+    '''
+    Files of the phase table of a single template and of its error
+    '''
+    name = os.path.join(store, 'phasetable_%s_u%d_n%d_p%d_px%d' %
+                        (templateSetKey([arr], [lam]), upsample, npix, nphase, pxperdetpix))
+    return name + '.npy', name + '_error.npy'
+
+
+def _buildPhaseTable(arr, lam, upsample, npix, nphase, pxperdetpix, store):
+    '''
+    Loads the phase table of a single template from store, or builds and saves it
+    '''
+    if store is not None:
+        filename, errorname = _tableFiles(store, arr, lam, upsample, npix, nphase, pxperdetpix)
+        if os.path.isfile(filename) and os.path.isfile(errorname):
+            try:
+                return np.load(filename, mmap_mode='r'), np.load(errorname)
+            except BaseException:
+                log.warning('Could not read phase table from ' + filename)
+
+    hires = interpolateTemplates([arr], [lam], lam, upsample, pxperdetpix)
+    table = phaseTable(hires, upsample, npix, nphase)
+    error = phaseTableError(hires, table, upsample, npix)
+    table = table.astype(np.float32)
+    if store is not None:
+        try:
+            for name, data in [(filename, table), (errorname, error)]:
+                tmpname = name + '.%d.tmp' % os.getpid()
+                with open(tmpname, 'wb') as f:
+                    np.save(f, data)
+                os.rename(tmpname, name)
+            table = np.load(filename, mmap_mode='r')
+        except BaseException:
+            log.warning('Could not write phase table to ' + filename)
+    return table, error
+
+
+def loadPhaseTables(hires_arrs, lam_arr, lams, upsample=3, npix=13, nphase=16,
+                    pxperdetpix=1, store=None):
+    '''
+    Phase tables of the templates of a set needed at some wavelengths, loaded
+    from disk or built
+
+    Parameters
+    ----------
+    hires_arrs: list of 4D ndarrays
+        Oversampled PSFLet templates, not spline-filtered
+    lam_arr: 1D array
+        Wavelengths corresponding to hires_arrs
+    lams: 1D array
+        Wavelengths at which the stamps will be looked up. Only the tables of
+        the templates that bracket them are loaded.
+    upsample, npix, nphase:
+        Same as in phaseTable
+    pxperdetpix: int
+        Integrate the templates over the detector pixels, see templates.pixelIntegrate
+    store: string
+        Directory in which the tables are saved, normally the one of the hires
+        templates (par.wavecalDir). Leave to None to only keep them in memory.
+
+    Returns
+    -------
+    tables: list
+        Single-precision phase table of each template of hires_arrs, read-only
+        and memory-mapped if store is set, or None for the templates that are
+        not needed at lams
+    errors: 3D array
+        (len(hires_arrs), 2, 2) errors of each table relative to the peak of its
+        stamps, see phaseTableError. NaN for the tables that were not loaded.
+    '''
+    if store is not None and not os.path.isdir(store):
+        try:
+            os.makedirs(store)
+        except BaseException:
+            log.warning('Could not create ' + store)
+            store = None
+
+    needed = set()
+    for lam in np.atleast_1d(lams):
+        needed.update([i for i, weight in wavelengthWeights(lam_arr, lam) if weight != 0])
+
+    tables = [None] * len(hires_arrs)
+    errors = np.full((len(hires_arrs), 2, 2), np.nan)
+    loaded = []
+    for i in sorted(needed):
+        key = (templateSetKey([hires_arrs[i]], [lam_arr[i]]), upsample, npix, nphase,
+               pxperdetpix, store)
+        with _tablesLock:
+            if key in _tables:
+                _tables[key] = _tables.pop(key)
+                tables[i], errors[i] = _tables[key]
+                continue
+        tables[i], errors[i] = _buildPhaseTable(hires_arrs[i], lam_arr[i], upsample, npix,
+                                                nphase, pxperdetpix, store)
+        loaded += [i]
+        with _tablesLock:
+            _tables.pop(key, None)
+            _tables[key] = (tables[i], errors[i])
+            while len(_tables) > _maxtables:
+                _tables.popitem(last=False)
+
+    # the errors are only reported for the tables that were not already in memory
+    if len(loaded) > 0:
+        lams_loaded = np.asarray(lam_arr)[loaded]
+        phase = np.argmax(errors[loaded, 0, 1])
+        log.info('Phase tables with %d phases per pixel: error %.1e of the peak with the '
+                 'bilinear blend (%.1e with the nearest phase), largest at %g nm; it falls '
+                 'as 1/nphase**2' % (nphase, errors[loaded[phase], 0, 1],
+                                     errors[loaded[phase], 0, 0], lams_loaded[phase]))
+        edge = np.argmax(errors[loaded, 1, 1])
+        if errors[loaded[edge], 1, 1] > errors[loaded[phase], 0, 1]:
+            log.warning('The templates at %g nm are not zero at their borders: along the '
+                        'border of the templates, the stamps of the PSFLets differ by up to '
+                        '%.1e of the peak from the interpolation, whatever the number of '
+                        'phases. Set par.nphase to None to interpolate them instead.'
+                        % (lams_loaded[edge], errors[loaded[edge], 1, 1]))
+    return tables, errors
+
+
+def phaseTablesAt(tables, lam_arr, lam):
+    '''
+    Phase tables combined at wavelength lam in the same way as the templates
+    by interpolateTemplates, without combining them
+
+    Parameters
+    ----------
+    tables: list of 6D ndarrays
+        Phase tables of the templates, see loadPhaseTables
+    lam_arr: 1D array
+        Wavelengths of the templates
+    lam: float
+        Wavelength of the stamps
+
+    Returns
+    -------
+    tables: list of tuples
+        (table, weight) of the one or two tables that bracket lam, to be
+        blended by lenslet.phaseStamps
+    '''
+    return [(tables[i], weight) for i, weight in wavelengthWeights(lam_arr, lam) if weight != 0]
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+'''
+Compact polychrome made of one stamp per lenslet and wavelength
+
+The polychrome written by buildcalibrations (polychromeR%d.fits.gz) is a dense
+Nspec x npix x npix cube, mostly zeros, that every extraction has to
+decompress and hold in memory before cutting out the microspectrum of each
+lenslet. The compact polychrome (polychromeStampsR%d.npy) keeps, for every
+lenslet whose PSFLets are all good in the polychrome key and for every
+wavelength, a small square stamp of the polychrome around the PSFLet,
+together with the detector pixel of its lower-left corner. It is a single
+uncompressed structured array, which extraction memory-maps (see
+calibration.loadPolychromeStamps) and from which it builds the cutouts of
+each lenslet directly (see reduction.get_stamp_cutouts).
+
+The stamps must hold the whole PSFLet of their lenslet. writePolychromeStamps
+measures, for every lenslet surrounded by good lenslets, the fraction of the
+polychrome flux of its own pixels (those closer to it than to any other
+lenslet, see reduction.psfletTags) that falls in its stamps, and takes the
+smallest size that keeps all but a given tolerance of it, starting from the 13
+pixels of the PSFLets of make_polychrome. It does not write the stamps if no
+size up to the lenslet windows of psfletTags does.
+
+Even then, the stamps only carry the light of the other lenslets that falls
+inside them, while the dense cutouts of reduction.get_cutouts carry all of it.
+Extraction from the stamps therefore differs from the dense extraction by the
+crosstalk between neighbouring lenslets, and is only used when par.polychromeStamps
+is set (see unitTests.testPolychromeStamps to compare them).
+
+polychromeToStamps and stampsToPolychrome convert between the two formats,
+and writePolychromeStamps and writePolychromeFits between the two files.
+Converting the stamps back to a cube restores every pixel covered by a stamp.
+Pixels further than stampsize // 2 from all the PSFLets of their wavelength
+bin are set to zero.
+'''
+
+import os
+import numpy as np
+try:
+    from astropy.io import fits
+except BaseException:
+    import pyfits as fits
+from crispy.tools.calibration import loadPolychromeKey
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+# Smallest and largest sizes of the stamps chosen by writePolychromeStamps, the
+# PSFLets of make_polychrome and the lenslet windows of psfletTags, with a
+# margin of a pixel on each side for the rounding of the centroids
+_minstampsize = 13
+_maxstampsize = 23
+
+
+def stampDtype(nlam, stampsize):
+    '''
+    Record of one lenslet in the compact polychrome
+
+    Parameters
+    ----------
+    nlam: int
+        Number of wavelength bins of the polychrome
+    stampsize: int
+        Size of the stamps in detector pixels
+
+    Returns
+    -------
+    dtype: numpy dtype
+        Fields 'lenslet' (i, j) indices of the lenslet in the polychrome key,
+        'origin' (nlam, 2) lower-left (y, x) detector pixel of each stamp, and
+        'stamp' (nlam, stampsize, stampsize) stamps
+    '''
+    return np.dtype([('lenslet', np.int32, (2,)),
+                     ('origin', np.int32, (nlam, 2)),
+                     ('stamp', np.float32, (nlam, stampsize, stampsize))])
+
+
+def _stampPixels(origins, stampsize, shape):
+    '''
+    Detector pixels of a stack of stamps and whether they fall on the detector
+    '''
+    offsets = np.arange(stampsize)
+    iy = origins[:, 0, np.newaxis] + offsets
+    ix = origins[:, 1, np.newaxis] + offsets
+    inside = ((iy >= 0) * (iy < shape[0]))[:, :, np.newaxis] * \
+        ((ix >= 0) * (ix < shape[1]))[:, np.newaxis, :]
+    iy = np.clip(iy, 0, shape[0] - 1)[:, :, np.newaxis]
+    ix = np.clip(ix, 0, shape[1] - 1)[:, np.newaxis, :]
+    return iy, ix, inside
+
+
+def polychromeToStamps(psflets, xindx, yindx, good, stampsize=_minstampsize):
+    '''
+    Compact polychrome from a dense one
+
+    Parameters
+    ----------
+    psflets: 3D ndarray
+        Dense polychrome, Nspec x npix x npix
+    xindx, yindx: 3D ndarrays
+        Positions of all the PSFLets in each bin, from the polychrome key
+    good: 3D ndarray
+        Whether each PSFLet lies on the detector, from the polychrome key
+    stampsize: int
+        Size of the stamps in detector pixels, centered on each PSFLet
+
+    Returns
+    -------
+    stamps: 1D structured ndarray
+        One record per lenslet whose PSFLets are all good, in the order of
+        np.where(np.prod(good, axis=0)), see stampDtype
+    '''
+    ilens, jlens = np.where(np.prod(good, axis=0))
+    nlam = psflets.shape[0]
+    stamps = np.zeros(len(ilens), dtype=stampDtype(nlam, stampsize))
+    stamps['lenslet'] = np.transpose([ilens, jlens])
+    stamps['origin'][:, :, 0] = yindx[:nlam, ilens, jlens].T.astype(int) - stampsize // 2
+    stamps['origin'][:, :, 1] = xindx[:nlam, ilens, jlens].T.astype(int) - stampsize // 2
+    for k in range(nlam):
+        iy, ix, inside = _stampPixels(stamps['origin'][:, k], stampsize, psflets.shape[1:])
+        stamps['stamp'][:, k] = psflets[k][iy, ix] * inside
+    return stamps
+
+
+def stampsToPolychrome(stamps, shape, k=None):
+    '''
+    Dense polychrome, or one of its slices, from a compact one
+
+    Parameters
+    ----------
+    stamps: 1D structured ndarray
+        Compact polychrome, see polychromeToStamps
+    shape: tuple
+        Shape (npix, npix) of the detector
+    k: int
+        Index of the wavelength bin to return. Returns all of them if None.
+
+    Returns
+    -------
+    psflets: 3D or 2D ndarray
+        Dense polychrome, or its slice k. Stamps sample the same polychrome, so
+        where they overlap they are simply written over each other.
+    '''
+    nlam, stampsize = stamps['stamp'].shape[1], stamps['stamp'].shape[-1]
+    bins = range(nlam) if k is None else [k]
+    psflets = np.zeros((len(bins),) + tuple(shape), dtype=np.float32)
+    for i, kk in enumerate(bins):
+        iy, ix, inside = _stampPixels(stamps['origin'][:, kk], stampsize, shape)
+        iy = np.broadcast_to(iy, inside.shape)[inside]
+        ix = np.broadcast_to(ix, inside.shape)[inside]
+        psflets[i][iy, ix] = stamps['stamp'][:, kk][inside]
+    if k is None:
+        return psflets
+    return psflets[0]
+
+
+def stampCapture(psflets, xindx, yindx, good, tags, stampsizes):
+    '''
+    Fraction of the flux of each lenslet kept by stamps of several sizes
+
+    Parameters
+    ----------
+    psflets: 3D ndarray
+        Dense polychrome, Nspec x npix x npix
+    xindx, yindx: 3D ndarrays
+        Positions of all the PSFLets in each bin, from the polychrome key
+    good: 3D ndarray
+        Whether each PSFLet lies on the detector, from the polychrome key
+    tags: 3D ndarray
+        Index of the lenslet of each pixel in every bin, see reduction.psfletTags
+    stampsizes: list of ints
+        Odd sizes of the stamps
+
+    Returns
+    -------
+    capture: 2D ndarray
+        (len(stampsizes), nlenslets) smallest fraction, over the wavelength bins,
+        of the flux of the pixels of each lenslet that falls in its stamp, for
+        the lenslets of polychromeToStamps. NaN for the lenslets that are not
+        surrounded by good lenslets, whose pixels extend to empty regions.
+    '''
+    ilens, jlens = np.where(np.prod(good, axis=0))
+    isgood = np.prod(good, axis=0).astype(bool)
+    inner = np.zeros(isgood.shape, bool)
+    inner[1:-1, 1:-1] = isgood[1:-1, 1:-1] * isgood[:-2, 1:-1] * isgood[2:, 1:-1] * \
+        isgood[1:-1, :-2] * isgood[1:-1, 2:]
+    own = np.ravel_multi_index((ilens, jlens), isgood.shape)
+
+    # stamps of the largest size, of which the others are the central part
+    size = max(stampsizes)
+    capture = np.ones((len(stampsizes), len(ilens)))
+    for k in range(psflets.shape[0]):
+        origins = np.transpose([yindx[k, ilens, jlens], xindx[k, ilens, jlens]]).astype(int) - size // 2
+        iy, ix, inside = _stampPixels(origins, size, psflets.shape[1:])
+        flux = psflets[k][iy, ix] * inside * (tags[k][iy, ix] == own[:, np.newaxis, np.newaxis])
+        total = np.bincount(np.reshape(tags[k], -1), weights=np.reshape(psflets[k], -1),
+                            minlength=np.amax(own) + 1)[own]
+        lit = total > 0
+        for n, stampsize in enumerate(stampsizes):
+            a = size // 2 - stampsize // 2
+            kept = np.sum(flux[lit, a:a + stampsize, a:a + stampsize], axis=(1, 2))
+            capture[n, lit] = np.minimum(capture[n, lit], kept / total[lit])
+    capture[:, ~inner[ilens, jlens]] = np.nan
+    return capture
+
+
+def writePolychromeStamps(par, psflets=None, stampsize=None, tolerance=1e-2, dy=3):
+    '''
+    Writes the compact polychrome of par.wavecalDir
+
+    Parameters
+    ----------
+    par: Parameter instance
+        Contains all IFS parameters
+    psflets: 3D ndarray
+        Dense polychrome, read from the polychromeR%d.fits(.gz) file of
+        par.wavecalDir if None
+    stampsize: int
+        Size of the stamps in detector pixels. If None, the smallest odd size
+        between 13 and 23 pixels that keeps enough of the flux of every lenslet.
+    tolerance: float
+        Largest fraction of the flux of a lenslet that its stamps may lose, see
+        stampCapture
+    dy: int
+        Margin of the cutouts, for the lenslet index of each pixel (see
+        reduction.psfletTags)
+
+    Returns
+    -------
+    filename: string
+        Name of the polychromeStampsR%d.npy file, or None if the stamps would lose
+        more than the tolerance, in which case the file is not written (and any
+        older one is removed)
+    '''
+    from crispy.tools.reduction import psfletTags
+
+    if psflets is None:
+        filename = par.wavecalDir + 'polychromeR%d.fits.gz' % (par.R)
+        if not os.path.isfile(filename):
+            filename = par.wavecalDir + 'polychromeR%d.fits' % (par.R)
+        psflets = fits.getdata(filename)
+    lams, xindx, yindx, good = loadPolychromeKey(par)
+    filename = par.wavecalDir + 'polychromeStampsR%d.npy' % (par.R)
+
+    if stampsize is None:
+        stampsizes = list(range(_minstampsize, _maxstampsize + 1, 2))
+    else:
+        stampsizes = [stampsize]
+    tags = psfletTags(par, psflets.shape[1:], dy)
+    capture = np.nanmin(stampCapture(psflets, xindx, yindx, good, tags, stampsizes), axis=1)
+    ok = np.flatnonzero(capture >= 1 - tolerance)
+    if len(ok) == 0:
+        log.warning('Stamps of %d pixels keep only %.4f of the flux of some lenslets, '
+                    'not writing the compact polychrome' % (stampsizes[-1], capture[-1]))
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return None
+    stampsize = stampsizes[ok[0]]
+    stamps = polychromeToStamps(psflets, xindx, yindx, good, stampsize)
+
+    tmpname = filename + '.%d.tmp' % os.getpid()
+    with open(tmpname, 'wb') as f:
+        np.save(f, stamps)
+    os.rename(tmpname, filename)
+    log.info('Wrote %d lenslets to %s, in stamps of %d pixels that keep at least %.4f of their flux' %
+             (len(stamps), filename, stampsize, capture[ok[0]]))
+    return filename
+
+
+def writePolychromeFits(par, filename=None):
+    '''
+    Writes the dense polychrome rebuilt from the compact one of par.wavecalDir
+
+    Parameters
+    ----------
+    par: Parameter instance
+        Contains all IFS parameters
+    filename: string
+        Name of the FITS file. Defaults to polychromeR%d.fits.gz in par.wavecalDir
+
+    Returns
+    -------
+    filename: string
+        Name of the FITS file
+    '''
+    if filename is None:
+        filename = par.wavecalDir + 'polychromeR%d.fits.gz' % (par.R)
+    stamps = np.load(par.wavecalDir + 'polychromeStampsR%d.npy' % (par.R), mmap_mode='r')
+    psflets = stampsToPolychrome(stamps, (par.npix, par.npix))
+    fits.HDUList(fits.PrimaryHDU(psflets)).writeto(filename, overwrite=True)
+    return filename
@@ -3,7 +3,7 @@ import astropy.units as u
 import astropy.constants as c
 from crispy.tools.inputScene import convert_krist_cube, calc_contrast, calc_contrast_Bijan, zodi_cube, adjust_krist_header
 import glob
-from crispy.IFS import reduceIFSMap, polychromeIFS
+from crispy.IFS import reduceIFSMap, polychromeIFS, polychromeIFSBatch
 from crispy.tools.initLogger import getLogger
 log = getLogger('crispy')
 from crispy.tools.image import Image
@@ -23,6 +23,7 @@ from crispy.tools.inputScene import calc_contrast
 from crispy.tools.reduction import calculateWaveList
 from crispy.tools.imgtools import bowtie, scale2imgs, circularMask
 from crispy.tools.rotate import shiftCube
+from crispy.tools.detutils import getDtype
 from scipy import ndimage
 from scipy.interpolate import interp1d
 import scipy
@@ -156,96 +157,40 @@ def process_SPC_IFS(par,
     ##########################################################################
     ref_outlist = []
     target_outlist = []
-    # Parallelized propagation
-    if parallel:
-        if process_cubes:
-            tasks = multiprocessing.Queue()
-            results = multiprocessing.Queue()
-            ncpus = multiprocessing.cpu_count()
-            consumers = [Consumer(tasks, results)
-                         for i in range(ncpus)]
-            for w in consumers:
-                w.start()
-
-            # you call the function here, with all its arguments in a list
-            for i in range(len(filelist)):
-                reffile = filelist[i]
-                log.info('Processing file ' + reffile.split('/')[-1])
-                cube = fits.open(reffile)[0]
-                if i < n_ref_star_imgs:
-                    cube.data *= ref_star_cube
-                else:
-                    cube.data *= target_star_cube
-                # adjust headers for slightly different wavelength
-                log.debug('Modifying cube header')
-                adjust_krist_header(cube, lamc=lamc)
-                par.saveDetector = False
-
-                tasks.put(Task(i, polychromeIFS, (par, lamlist.value, cube)))
-
-            for i in range(ncpus):
-                tasks.put(None)
-
-            for i in range(len(filelist)):
-                index, result = results.get()
-                reffile = filelist[index]
-                if index < n_ref_star_imgs:
-                    Image(data=result, header=par.hdr).write(outdir_time_series + '/' + \
-                          reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits', clobber=True)
-                    ref_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits')
-                else:
-                    Image(data=result, header=par.hdr).write(outdir_time_series + '/' + \
-                          reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits', clobber=True)
-                    target_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits')
-
-        else:
-            for i in range(len(filelist)):
-                reffile = filelist[i]
-                if i < n_ref_star_imgs:
-                    ref_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits')
-                else:
-                    target_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits')
 
-    else:
+    def _cubes():
         for i in range(len(filelist)):
             reffile = filelist[i]
-            if process_cubes:
-                log.info('Processing file ' + reffile.split('/')[-1])
-                cube = fits.open(reffile)[0]
-                if i < n_ref_star_imgs:
-                    cube.data *= ref_star_cube
-                else:
-                    cube.data *= target_star_cube
-                # adjust headers for slightly different wavelength
-                log.debug('Modifying cube header')
-                adjust_krist_header(cube, lamc=lamc)
-                par.saveDetector = False
-
-                detectorFrame = polychromeIFS(
-                    par, lamlist.value, cube, QE=useQE)
-
-                if i < n_ref_star_imgs:
-                    Image(data=detectorFrame, header=par.hdr).write(outdir_time_series + '/' + \
-                          reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits', clobber=True)
-                    ref_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits')
-                else:
-                    Image(data=detectorFrame, header=par.hdr).write(outdir_time_series + '/' + \
-                          reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits', clobber=True)
-                    target_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits')
+            log.info('Processing file ' + reffile.split('/')[-1])
+            cube = fits.open(reffile)[0]
+            if i < n_ref_star_imgs:
+                cube.data *= ref_star_cube
             else:
+                cube.data *= target_star_cube
+            # adjust headers for slightly different wavelength
+            log.debug('Modifying cube header')
+            adjust_krist_header(cube, lamc=lamc)
+            yield cube
 
-                if i < n_ref_star_imgs:
-                    ref_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits')
-                else:
-                    target_outlist.append(
-                        outdir_time_series + '/' + reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits')
+    if process_cubes:
+        par.saveDetector = False
+        # templates and workers are set up once for the whole time series
+        frames = polychromeIFSBatch(par, lamlist.value, _cubes(),
+                                    QE=useQE, parallel=parallel)
+
+    for i in range(len(filelist)):
+        reffile = filelist[i]
+        if i < n_ref_star_imgs:
+            outname = outdir_time_series + '/' + \
+                reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits'
+            ref_outlist.append(outname)
+        else:
+            outname = outdir_time_series + '/' + \
+                reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits'
+            target_outlist.append(outname)
+        if process_cubes:
+            detectorFrame = next(frames)
+            Image(data=detectorFrame, header=par.hdr).write(outname, clobber=True)
 
     times['Process cubes through IFS'] = time()
 
@@ -1693,6 +1638,9 @@ def construct_mflib(par, planet_cube, threshold, lamc, BW, outdir, mask,
     order: int
         Order at which we do the spline transformation to move offaxis PSF around.
 
+    Notes
+    -----
+    The library is stored with the floating-point type set by par.precision.
 
     '''
 
@@ -1716,7 +1664,7 @@ def construct_mflib(par, planet_cube, threshold, lamc, BW, outdir, mask,
     # trim the data to save space
     psftrim = psf.data[:, trim:-trim, trim:-trim]
     masktrim = mask[trim:-trim, trim:-trim]
-    mflib = np.zeros(list(xlist.shape) + list(psftrim.shape))
+    mflib = np.zeros(list(xlist.shape) + list(psftrim.shape), dtype=getDtype(par))
 
     # Now loop on all the valid pixel coordinates
     for ii in range(len(xlist)):
@@ -1865,24 +1813,33 @@ def processReferenceCubes(par, xshift=0.0, yshift=0.0, order=3,
     ##########################################################################
     # simulate the IFS flux at the detector plane (no losses other than QE)
     ##########################################################################
-    ref_outlist = []
-    for i in range(len(ref_input_list)):
-        reffile = ref_input_list[i]
-        if process_cubes:
+    def _cubes():
+        for reffile in ref_input_list:
             log.info('Processing file ' + reffile.split('/')[-1])
             cube = fits.open(reffile)[0]
             cube.data *= ref_star_cube
 
             # adjust headers for slightly different wavelength
             adjust_krist_header(cube, lamc=lamc)
-            par.saveDetector = False
 
             # shift the cube
             log.info("Shifting input cube")
             cube.data = ndimage.interpolation.shift(
                 cube.data, [
                     0.0, yshift * par.pixperlenslet, xshift * par.pixperlenslet], order=order)
-            detectorFrame = polychromeIFS(par, lamlist.value, cube, QE=True)
+            yield cube
+
+    if process_cubes:
+        par.saveDetector = False
+        frames = polychromeIFSBatch(par, lamlist.value, _cubes(), QE=True)
+
+    ref_outlist = []
+    for i in range(len(ref_input_list)):
+        reffile = ref_input_list[i]
+        outname = outdir_time_series + '/' + \
+            reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits'
+        if process_cubes:
+            detectorFrame = next(frames)
 
             par.hdr.append(
                 ('XSHIFT',
@@ -1895,14 +1852,8 @@ def processReferenceCubes(par, xshift=0.0, yshift=0.0, order=3,
                  'Y Shift in px in original cubes'),
                 end=True)
 
-            Image(data=detectorFrame, header=par.hdr).write(outdir_time_series + '/' + \
-                  reffile.split('/')[-1].split('.')[0] + '_refstar_IFS.fits', clobber=True)
-            ref_outlist.append(outdir_time_series + '/' + reffile.split('/')
-                               [-1].split('.')[0] + '_refstar_IFS.fits')
-
-        else:
-            ref_outlist.append(outdir_time_series + '/' + reffile.split('/')
-                               [-1].split('.')[0] + '_refstar_IFS.fits')
+            Image(data=detectorFrame, header=par.hdr).write(outname, clobber=True)
+        ref_outlist.append(outname)
 
     return ref_outlist
 
@@ -1968,28 +1919,29 @@ def processTargetCubes(par, target_file_list,
     ##########################################################################
     # simulate the IFS flux at the detector plane (no losses other than QE)
     ##########################################################################
-    target_outlist = []
-    for i in range(len(target_file_list)):
-        reffile = target_file_list[i]
-        if process_cubes:
+    def _cubes():
+        for reffile in target_file_list:
             log.info('Processing file ' + reffile.split('/')[-1])
             cube = fits.open(reffile)[0]
             cube.data *= target_star_cube
 
             # adjust headers for slightly different wavelength
             adjust_krist_header(cube, lamc=lamc)
-            par.saveDetector = False
-
-            detectorFrame = polychromeIFS(par, lamlist.value, cube, QE=True)
+            yield cube
 
-            Image(data=detectorFrame, header=par.hdr).write(outdir_time_series + '/' + \
-                  reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits', clobber=True)
-            target_outlist.append(outdir_time_series + '/' + reffile.split('/')
-                                  [-1].split('.')[0] + '_targetstar_IFS.fits')
+    if process_cubes:
+        par.saveDetector = False
+        frames = polychromeIFSBatch(par, lamlist.value, _cubes(), QE=True)
 
-        else:
-            target_outlist.append(outdir_time_series + '/' + reffile.split('/')
-                                  [-1].split('.')[0] + '_targetstar_IFS.fits')
+    target_outlist = []
+    for i in range(len(target_file_list)):
+        reffile = target_file_list[i]
+        outname = outdir_time_series + '/' + \
+            reffile.split('/')[-1].split('.')[0] + '_targetstar_IFS.fits'
+        if process_cubes:
+            detectorFrame = next(frames)
+            Image(data=detectorFrame, header=par.hdr).write(outname, clobber=True)
+        target_outlist.append(outname)
 
     return target_outlist
 
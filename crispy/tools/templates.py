@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+'''
+Cache of wavelength-interpolated, spline-prefiltered PSFLet templates
+
+Every call to propagateLenslets, make_polychrome and make_hires_polychrome
+needs the high-resolution PSFLet templates interpolated at each of its
+sub-wavelengths, and spline-filtered so that ndimage.map_coordinates can be
+called with prefilter=False. This work only depends on the template set
+and on the wavelength, so it is done once and kept in a bounded LRU cache.
+
+The cache can optionally be backed by a directory on disk. Entries are then
+saved as .npy files named after their key, and loaded as read-only
+memory-mapped arrays, so that worker processes can share them instead of
+recomputing them.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+
+def wavelengthWeights(lam_arr, lam):
+    '''
+    Weights of the templates of lam_arr used by interpolateTemplates at wavelength lam
+
+    Parameters
+    ----------
+    lam_arr: 1D array
+        Wavelengths of the template set
+    lam: float
+        Wavelength at which the templates are needed
+
+    Returns
+    -------
+    weights: list of tuples
+        (index in lam_arr, weight) of the one or two templates that are combined
+    '''
+    lam_arr = np.asarray(lam_arr)
+    if lam <= np.amin(lam_arr):
+        return [(0, 1.)]
+    elif lam >= np.amax(lam_arr):
+        return [(len(lam_arr) - 1, 1.)]
+    i1 = np.amax(np.arange(len(lam_arr))[np.where(lam > lam_arr)])
+    i2 = i1 + 1
+    return [(i1, (lam - lam_arr[i1]) / (lam_arr[i2] - lam_arr[i1])),
+            (i2, (lam_arr[i2] - lam) / (lam_arr[i2] - lam_arr[i1]))]
+
+
+def pixelIntegrate(hires, upsample, pxperdetpix):
+    '''
+    Averages oversampled templates over pxperdetpix x pxperdetpix points
+    spread evenly across a detector pixel
+
+    Sampling the result once per detector pixel gives the same frame as
+    sampling the templates on a grid oversampled pxperdetpix times and
+    summing the subpixels of each detector pixel (see detector.rebinDetector),
+    without ever building the oversampled frame.
+
+    Parameters
+    ----------
+    hires: 4D ndarray
+        nsubarr x nsubarr oversampled templates, not spline-filtered
+    upsample: int
+        Number of template samples per detector pixel
+    pxperdetpix: int
+        Number of points averaged along each axis of a detector pixel
+
+    Returns
+    -------
+    integrated: 4D ndarray
+        Templates averaged over the detector pixels, same shape as hires
+    '''
+    nsub = int(pxperdetpix)
+    if nsub != pxperdetpix or nsub < 1:
+        raise ValueError('pxperdetpix needs to be a positive integer')
+    shifts = ((np.arange(nsub) + 0.5) / nsub - 0.5) * upsample
+    integrated = np.zeros(hires.shape, dtype=np.result_type(hires.dtype.type, np.float32))
+    for i in range(hires.shape[0]):
+        for j in range(hires.shape[1]):
+            # the average is separable, so shift along one axis at a time
+            ysum = sum([ndimage.shift(hires[i, j], (dy, 0), order=3, mode='constant')
+                        for dy in shifts]) / nsub
+            integrated[i, j] = sum([ndimage.shift(ysum, (0, dx), order=3, mode='constant')
+                                    for dx in shifts]) / nsub
+    return integrated
+
+
+def interpolateTemplates(hires_arrs, lam_arr, lam, upsample=None, pxperdetpix=1):
+    '''
+    Build the appropriate average hires image by averaging over the
+    nearest wavelengths.  Then apply a spline filter to the interpolated
+    high resolution PSFlet images to avoid having to do this later,
+    saving a factor of a few in time.
+
+    Parameters
+    ----------
+    hires_arrs: list of 4D ndarrays
+        For each wavelength in lam_arr, the nsubarr x nsubarr oversampled PSFLet templates
+    lam_arr: 1D array
+        Wavelengths corresponding to hires_arrs
+    lam: float
+        Wavelength at which to build the templates
+    upsample: int
+        Number of template samples per detector pixel, only needed if pxperdetpix > 1
+    pxperdetpix: int
+        If larger than one, the templates are integrated over the detector pixels
+        before the spline filter, see pixelIntegrate
+
+    Returns
+    -------
+    hires: 4D ndarray
+        Spline-prefiltered templates at wavelength lam, in single precision
+        if hires_arrs are, in double precision otherwise
+    '''
+    hires = np.zeros(hires_arrs[0].shape,
+                     dtype=np.result_type(hires_arrs[0].dtype.type, np.float32))
+    for i, weight in wavelengthWeights(lam_arr, lam):
+        hires += hires_arrs[i] * weight
+    if pxperdetpix != 1:
+        hires = pixelIntegrate(hires, upsample, pxperdetpix)
+
+    for i in range(hires.shape[0]):
+        for j in range(hires.shape[1]):
+            hires[i, j] = ndimage.spline_filter(hires[i, j])
+    return hires
+
+
+def templateAnchors(lam_arr, lams):
+    '''
+    Expresses the templates at several wavelengths as linear combinations of
+    the templates at a few anchor wavelengths
+
+    interpolateTemplates is affine in wavelength between two consecutive
+    wavelengths of lam_arr, and constant outside of lam_arr, so the templates
+    at all the wavelengths that fall within one such interval are exact linear
+    combinations of the templates at the first and last of them.
+
+    Parameters
+    ----------
+    lam_arr: 1D array
+        Wavelengths of the template set
+    lams: 1D array
+        Increasing wavelengths at which the templates are needed
+
+    Returns
+    -------
+    anchors: list of floats
+        Anchor wavelengths, taken among lams
+    terms: list of lists
+        For each wavelength of lams, the (index in anchors, coefficient) pairs
+        of the linear combination
+    '''
+    lam_arr = np.asarray(lam_arr)
+
+    def _interval(lam):
+        if lam <= np.amin(lam_arr):
+            return -1
+        elif lam >= np.amax(lam_arr):
+            return len(lam_arr)
+        return np.amax(np.arange(len(lam_arr))[np.where(lam > lam_arr)])
+
+    intervals = [_interval(lam) for lam in lams]
+    anchors = []
+    terms = []
+    for i, lam in enumerate(lams):
+        members = [l for l, k in zip(lams, intervals) if k == intervals[i]]
+        la, lb = members[0], members[-1]
+        if la not in anchors:
+            anchors += [la]
+        if lam == la or intervals[i] in (-1, len(lam_arr)):
+            terms += [[(anchors.index(la), 1.0)]]
+            continue
+        if lb not in anchors:
+            anchors += [lb]
+        t = (lam - la) / (lb - la)
+        terms += [[(anchors.index(la), 1. - t), (anchors.index(lb), t)]]
+    return anchors, terms
+
+
+def templateSetKey(hires_arrs, lam_arr):
+    '''
+    Hash identifying a set of templates and their wavelengths
+
+    Parameters
+    ----------
+    hires_arrs: list of 4D ndarrays
+        Oversampled PSFLet templates
+    lam_arr: 1D array
+        Wavelengths corresponding to hires_arrs
+
+    Returns
+    -------
+    key: string
+        Hexadecimal digest of the content of the template set
+    '''
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lam_arr, dtype=np.float64).tobytes())
+    for arr in hires_arrs:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.shape, arr.dtype.str)).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+class TemplateCache(object):
+    """
+    Bounded LRU cache of prefiltered PSFLet templates, keyed by
+    (template set, wavelength).
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries kept in memory
+    store: string
+        Optional directory in which entries are also saved and from
+        which they are memory-mapped. Leave to None to keep everything
+        in memory.
+
+    Notes
+    -----
+    Arrays handed out by the cache are read-only since they are shared
+    between all the callers.
+    """
+
+    def __init__(self, maxsize=64, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.diskhits = 0
+        self.evictions = 0
+
+    def _filename(self, key):
+        setkey, lam = key
+        return os.path.join(self.store, 'hires_%s_%.6f.npy' % (setkey, lam))
+
+    def _load(self, key):
+        if self.store is None:
+            return None
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            return np.load(filename, mmap_mode='r')
+        except BaseException:
+            log.warning('Could not read cached templates from ' + filename)
+            return None
+
+    def _save(self, key, hires):
+        if self.store is None:
+            return hires
+        try:
+            if not os.path.isdir(self.store):
+                os.makedirs(self.store)
+            filename = self._filename(key)
+            tmpname = filename + '.%d.tmp' % os.getpid()
+            with open(tmpname, 'wb') as f:
+                np.save(f, hires)
+            os.rename(tmpname, filename)
+            return np.load(filename, mmap_mode='r')
+        except BaseException:
+            log.warning('Could not write cached templates to ' + self.store)
+            return hires
+
+    def get(self, hires_arrs, lam_arr, lam, setkey=None, upsample=None, pxperdetpix=1):
+        '''
+        Return the prefiltered templates at wavelength lam
+
+        Parameters
+        ----------
+        hires_arrs: list of 4D ndarrays
+            Oversampled PSFLet templates
+        lam_arr: 1D array
+            Wavelengths corresponding to hires_arrs
+        lam: float
+            Wavelength at which to build the templates
+        setkey: string
+            Key of the template set as returned by templateSetKey. Computing
+            it once and passing it here avoids rehashing the templates.
+        upsample, pxperdetpix:
+            Integrate the templates over the detector pixels, see interpolateTemplates
+
+        Returns
+        -------
+        hires: 4D ndarray
+            Read-only spline-prefiltered templates at wavelength lam
+        '''
+        if setkey is None:
+            setkey = templateSetKey(hires_arrs, lam_arr)
+        if pxperdetpix != 1:
+            setkey += '_px%dx%d' % (pxperdetpix, upsample)
+        key = (setkey, float(lam))
+
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return self._entries[key]
+
+        hires = self._load(key)
+        if hires is not None:
+            with self._lock:
+                self.diskhits += 1
+        else:
+            hires = self._save(key, interpolateTemplates(hires_arrs, lam_arr, lam,
+                                                         upsample, pxperdetpix))
+            with self._lock:
+                self.misses += 1
+        if hires.flags.writeable:
+            hires.setflags(write=False)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = hires
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return hires
+
+    def clear(self):
+        '''
+        Empty the in-memory cache and reset the statistics. Files in the
+        store are left untouched.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.diskhits = 0
+            self.evictions = 0
+
+    def stats(self):
+        '''
+        Cache statistics
+
+        Returns
+        -------
+        stats: dict
+            Number of in-memory hits, of entries loaded from the store, of
+            misses (templates actually computed), of evictions, and current
+            number of entries
+        '''
+        with self._lock:
+            return {'hits': self.hits,
+                    'diskhits': self.diskhits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._entries)}
+
+
+# Process-wide cache shared by the simulation and calibration routines
+templateCache = TemplateCache()
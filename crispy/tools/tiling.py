@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+'''
+Detector tiling for the forward simulation
+
+The detector is split into rectangular tiles. Each tile is assigned the
+lenslets whose PSFLets overlap it at some wavelength of the band, and is
+computed independently over a halo of about one PSFLet, which is discarded
+when the tiles are stitched back together. The tiles therefore add up to
+exactly the same frame as a simulation of the whole detector.
+
+A tile job only needs the flux of its own lenslets, so the jobs can be run
+by a local pool of processes or threads (see IFS.polychromeIFS), or written
+to a directory on a shared filesystem and served by workers started on any
+number of machines with
+
+    python -m crispy.tools.tiling <tileDir>
+
+Workers claim jobs by renaming their files, which is atomic on a shared
+filesystem, so any number of them can run at the same time. They keep
+going until every job has finished, and run again the jobs claimed by a
+worker that did not finish them within a lease (see tileWorker).
+'''
+
+import os
+import sys
+import glob
+import time
+import pickle
+import socket
+import numpy as np
+from crispy.tools.lenslet import propagateLenslets, lensletGrid, loadPSFLetPositions, \
+    lensletLocations
+from crispy.tools.detutils import getDtype
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+
+def detectorTiles(npix, tiles):
+    '''
+    Splits the detector into rectangular tiles
+
+    Parameters
+    ----------
+    npix: int
+        Size of the detector in pixels
+    tiles: int or tuple
+        Number of tiles along each axis, or (ny, nx)
+
+    Returns
+    -------
+    tiles: list of tuples
+        (y1, y2, x1, x2) detector pixels of each tile. The tiles cover the
+        detector without overlapping.
+    '''
+    ny, nx = np.broadcast_to(tiles, (2,))
+    yedges = np.linspace(0, npix, ny + 1).astype(int)
+    xedges = np.linspace(0, npix, nx + 1).astype(int)
+    return [(yedges[j], yedges[j + 1], xedges[i], xedges[i + 1])
+            for j in range(ny) for i in range(nx)]
+
+
+def tileRegion(tile, halo, npix):
+    '''
+    Tile extended by the halo on each side, within the detector
+    '''
+    y1, y2, x1, x2 = tile
+    return (max(0, y1 - halo), min(npix, y2 + halo),
+            max(0, x1 - halo), min(npix, x2 + halo))
+
+
+def lensletExtents(par, shape, wavelist_endpts, lenslets, order=3, x0=0.0):
+    '''
+    Detector area covered by the PSFLet centroid of each lenslet across the band
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    shape: tuple
+        Shape of the image plane, where each pixel corresponds to one lenslet
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    lenslets: 1D int array
+        Flat indices of the lenslets, see lenslet.activeLenslets
+    order, x0:
+        Same as in propagateLenslets
+
+    Returns
+    -------
+    ymin, ymax, xmin, xmax: 1D arrays
+        Bounding box of the centroids of each lenslet at all the bin endpoints
+    '''
+    psftool, allcoef = loadPSFLetPositions(par)
+    xindx, yindx = lensletGrid(shape)[:2]
+    xindx = np.reshape(xindx, -1)[lenslets]
+    yindx = np.reshape(yindx, -1)[lenslets]
+    locs = [lensletLocations(par, lam, xindx, yindx, order, x0, psftool, allcoef)
+            for lam in wavelist_endpts]
+    xcen = np.array([np.reshape(loc[0], -1) for loc in locs])
+    ycen = np.array([np.reshape(loc[1], -1) for loc in locs])
+    return np.amin(ycen, axis=0), np.amax(ycen, axis=0), \
+        np.amin(xcen, axis=0), np.amax(xcen, axis=0)
+
+
+def makeTileJobs(par, inputCube, wavelist_endpts, tiles, lenslets=None,
+                 hires_arrs=None, lam_arr=None, upsample=3, nlam=10,
+                 npix=13, order=3, x0=0.0, halo=None):
+    '''
+    Decomposes the propagation of a cube into independent detector tiles
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    inputCube: 3D ndarray
+        Rotated and rebinned input cube, one pixel per lenslet, multiplied by the bandwidths
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    tiles: int or tuple
+        Number of tiles along each axis, or (ny, nx)
+    lenslets: 1D int array
+        Flat indices of the lenslets to propagate, see lenslet.activeLenslets.
+        Defaults to all the lenslets
+    hires_arrs, lam_arr, upsample, npix, order, x0:
+        Same as in propagateLenslets
+    nlam: int or sequence of ints
+        Number of sub-wavelengths, for all bins or for each bin
+    halo: int
+        Width in pixels of the margin computed around each tile. Defaults to npix,
+        and cannot be smaller than npix // 2 + 1
+
+    Returns
+    -------
+    common: dict
+        Arguments shared by all the jobs
+    jobs: list of dicts
+        Tile, computed region, lenslets and lenslet fluxes of each job
+    '''
+    if halo is None:
+        halo = npix
+    halo = max(halo, npix // 2 + 1)
+    nbins = len(wavelist_endpts) - 1
+    planeshape = inputCube[0].shape
+    xindx, yindx, inplane, planeindx = lensletGrid(planeshape)
+    if lenslets is None:
+        lenslets = np.where(inplane)[0]
+
+    common = {'par': par,
+              'planeshape': planeshape,
+              'wavelist_endpts': np.asarray(wavelist_endpts),
+              'nlams': tuple(np.broadcast_to(nlam, (nbins,)).tolist()),
+              'hires_arrs': hires_arrs,
+              'lam_arr': lam_arr,
+              'upsample': upsample,
+              'npix': npix,
+              'order': order,
+              'x0': x0}
+
+    ######################################################################
+    # A lenslet contributes to a tile if its stamp overlaps the tile at
+    # any wavelength of the band
+    ######################################################################
+    ymin, ymax, xmin, xmax = lensletExtents(par, planeshape, wavelist_endpts,
+                                            lenslets, order, x0)
+    margin = npix // 2 + 2
+    allvals = np.reshape(inputCube, (nbins, -1))[:, planeindx[lenslets]]
+
+    jobs = []
+    for tile in detectorTiles(par.npix, tiles):
+        y1, y2, x1, x2 = tile
+        overlap = (ymax > y1 - margin) * (ymin < y2 + margin) * \
+            (xmax > x1 - margin) * (xmin < x2 + margin)
+        jobs += [{'index': len(jobs),
+                  'tile': tile,
+                  'region': tileRegion(tile, halo, par.npix),
+                  'lenslets': lenslets[overlap],
+                  'vals': allvals[:, overlap]}]
+    log.info('Split the detector into %d tiles with a %d pixel halo' % (len(jobs), halo))
+    return common, jobs
+
+
+def runTileJob(common, job):
+    '''
+    Propagates all the wavelength bins for one tile
+
+    Parameters
+    ----------
+    common: dict
+        Arguments shared by all the jobs, see makeTileJobs
+    job: dict
+        Job of the tile, see makeTileJobs
+
+    Returns
+    -------
+    stack: 3D ndarray
+        Contribution of each wavelength bin to the tile
+    '''
+    par = common['par']
+    y1, y2, x1, x2 = job['tile']
+    ry1, ry2, rx1, rx2 = job['region']
+    planeindx = lensletGrid(common['planeshape'])[3]
+    endpts = common['wavelist_endpts']
+    nbins = len(endpts) - 1
+
+    stack = np.zeros((nbins, y2 - y1, x2 - x1), dtype=getDtype(par))
+    if len(job['lenslets']) == 0:
+        return stack
+    plane = np.zeros(common['planeshape'])
+    for i in range(nbins):
+        plane.flat[planeindx[job['lenslets']]] = job['vals'][i]
+        image = propagateLenslets(par, plane, endpts[i], endpts[i + 1],
+                                  common['hires_arrs'], common['lam_arr'],
+                                  common['upsample'], common['nlams'][i],
+                                  common['npix'], common['order'], common['x0'],
+                                  lenslets=job['lenslets'], region=job['region'])
+        stack[i] = image[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1]
+    return stack
+
+
+def _dump(obj, filename):
+    '''
+    Pickles obj to filename through a temporary file, so that readers never
+    see a partial file
+    '''
+    tmpname = filename + '.%s-%d.tmp' % (socket.gethostname(), os.getpid())
+    with open(tmpname, 'wb') as f:
+        pickle.dump(obj, f, protocol=2)
+    os.rename(tmpname, filename)
+
+
+def _load(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def writeTileJobs(tileDir, common, jobs):
+    '''
+    Writes tile jobs to a directory for tileWorker
+
+    Parameters
+    ----------
+    tileDir: string
+        Directory on a filesystem shared by all the workers. Its previous jobs
+        and results are removed.
+    common: dict
+        Arguments shared by all the jobs, see makeTileJobs
+    jobs: list of dicts
+        Jobs, see makeTileJobs
+    '''
+    if not os.path.isdir(tileDir):
+        os.makedirs(tileDir)
+    for filename in glob.glob(os.path.join(tileDir, 'tile*')):
+        os.remove(filename)
+    _dump(common, os.path.join(tileDir, 'common.pkl'))
+    for job in jobs:
+        _dump(job, os.path.join(tileDir, 'tile%04d.job' % job['index']))
+    log.info('Wrote %d tile jobs to %s' % (len(jobs), tileDir))
+
+
+def _requeueExpired(tileDir, lease):
+    '''
+    Puts back the jobs claimed more than lease seconds ago, whose worker is
+    assumed to have died
+    '''
+    for runfile in glob.glob(os.path.join(tileDir, 'tile????.*.run')):
+        try:
+            if time.time() - os.path.getmtime(runfile) > lease:
+                jobfile = os.path.basename(runfile).split('.')[0] + '.job'
+                os.rename(runfile, os.path.join(tileDir, jobfile))
+                log.warning('Requeued %s, claimed more than %d seconds ago' %
+                            (os.path.basename(runfile), lease))
+        except OSError:
+            # finished or requeued by another worker in the meantime
+            continue
+
+
+def tileWorker(tileDir, lease=600., poll=1.0):
+    '''
+    Runs the jobs of a tile directory until none is left
+
+    Jobs are claimed by renaming their file, so that several workers, on
+    one or several machines, can share the same directory. A worker keeps
+    polling while jobs are still being run by others, and puts back the
+    jobs claimed more than lease seconds ago, so that the jobs of a worker
+    that died are run by another one.
+
+    Parameters
+    ----------
+    tileDir: string
+        Directory written by writeTileJobs
+    lease: float
+        Time in seconds after which a claimed job that has not finished is
+        run again. Must be longer than the longest tile job, and than the
+        clock differences between the machines sharing the directory. A job
+        that outlives its lease is run twice, which gives the same result.
+    poll: float
+        Time in seconds between checks while other workers run the last jobs
+
+    Returns
+    -------
+    njobs: int
+        Number of jobs run by this worker
+    '''
+    common = None
+    commonTime = None
+    njobs = 0
+    while True:
+        _requeueExpired(tileDir, lease)
+        jobfiles = sorted(glob.glob(os.path.join(tileDir, 'tile????.job')))
+        if len(jobfiles) == 0:
+            if len(glob.glob(os.path.join(tileDir, 'tile????.*.run'))) == 0:
+                return njobs
+            time.sleep(poll)
+            continue
+        for jobfile in jobfiles:
+            claimed = jobfile[:-4] + '.%s-%d.run' % (socket.gethostname(), os.getpid())
+            try:
+                os.rename(jobfile, claimed)
+                # the lease starts now, not when the job was written
+                os.utime(claimed, None)
+            except OSError:
+                # another worker got it first
+                continue
+            commonFile = os.path.join(tileDir, 'common.pkl')
+            if common is None or os.path.getmtime(commonFile) != commonTime:
+                commonTime = os.path.getmtime(commonFile)
+                common = _load(commonFile)
+            job = _load(claimed)
+            np.save(claimed + '.npy', runTileJob(common, job))
+            os.rename(claimed + '.npy', jobfile[:-4] + '.npy')
+            try:
+                os.remove(claimed)
+            except OSError:
+                # the lease expired and the job was put back
+                pass
+            njobs += 1
+
+
+def gatherTileJobs(tileDir, njobs, timeout=3600., poll=1.0):
+    '''
+    Waits for the results of the tile jobs of a directory
+
+    Parameters
+    ----------
+    tileDir: string
+        Directory written by writeTileJobs
+    njobs: int
+        Number of jobs
+    timeout: float
+        Maximum time to wait in seconds. Waits forever if None
+    poll: float
+        Time in seconds between checks for new results
+
+    Returns
+    -------
+    stacks: list of 3D ndarrays
+        Output of runTileJob for each job, in the order of the jobs
+    '''
+    start = time.time()
+    filenames = [os.path.join(tileDir, 'tile%04d.npy' % i) for i in range(njobs)]
+    while not all([os.path.isfile(filename) for filename in filenames]):
+        if timeout is not None and time.time() - start > timeout:
+            missing = [i for i in range(njobs) if not os.path.isfile(filenames[i])]
+            running = [i for i in missing
+                       if glob.glob(os.path.join(tileDir, 'tile%04d.*.run' % i))]
+            raise RuntimeError('%d of %d tile jobs in %s did not finish within %g seconds: '
+                               'tiles %s (claimed by a worker: %s)' %
+                               (len(missing), njobs, tileDir, timeout,
+                                ' '.join(['%d' % i for i in missing]),
+                                ' '.join(['%d' % i for i in running]) or 'none'))
+        time.sleep(poll)
+    return [np.load(filename) for filename in filenames]
+
+
+if __name__ == '__main__':
+    for tileDir in sys.argv[1:]:
+        log.info('Ran %d tile jobs from %s' % (tileWorker(tileDir), tileDir))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+'''
+Sparse IFS transfer operator
+
+For a fixed set of parameters, templates and wavelength bins, the map from
+the rotated and rebinned lenslet-plane flux in each wavelength bin to the
+detector pixels is linear. buildTransferOperator computes it once as a
+scipy.sparse matrix of shape (npix*npix, nbins*nplane), using the same
+stamping engine as propagateLenslets. Subsequent simulations through the
+same optics are then a single sparse matrix-vector product.
+
+Operators are saved to disk with a name derived from a hash of all the
+quantities they depend on, so that they can be reused across sessions.
+'''
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+from crispy.tools.lenslet import makeStamps, _stamp_indices, subWavelengths, \
+    lensletGrid, loadPSFLetPositions, lensletLocations
+from crispy.tools.templates import templateCache, templateSetKey
+from crispy.tools.calibration import loadLamsol
+from crispy.tools.initLogger import getLogger
+log = getLogger('crispy')
+
+# operators already loaded in this process, most recent last
+_operators = OrderedDict()
+_maxoperators = 2
+
+
+def transferOperatorKey(par, planeshape, wavelist_endpts, setkey,
+                        upsample=3, nlam=10, npix=13, order=3, x0=0.0):
+    '''
+    Hash of all the quantities on which the transfer operator depends
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    planeshape: tuple
+        Shape of the rotated and rebinned image plane (one pixel per lenslet)
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    setkey: string
+        Key of the template set, see templates.templateSetKey
+    upsample, nlam, npix, order, x0:
+        Same as in propagateLenslets. nlam can also be a tuple with one value per bin
+
+    Returns
+    -------
+    key: string
+        Hexadecimal digest
+    '''
+    h = hashlib.sha1()
+    h.update(repr((par.npix, par.pitch, par.pixsize, float(par.philens),
+                   par.npixperdlam, par.R, par.FWHMlam, par.PSFLetPositions, par.pxperdetpix,
+                   tuple(planeshape), upsample, nlam, npix, order, x0,
+                   setkey)).encode())
+    h.update(np.asarray(wavelist_endpts, dtype=np.float64).tobytes())
+    if par.PSFLetPositions:
+        h.update(loadLamsol(par).tobytes())
+    return h.hexdigest()
+
+
+def buildTransferOperator(par, planeshape, wavelist_endpts, hires_arrs, lam_arr,
+                          upsample=3, nlam=10, npix=13, order=3, x0=0.0,
+                          dtype=np.float32):
+    '''
+    Builds the sparse linear operator from lenslet-plane flux to detector pixels
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    planeshape: tuple
+        Shape of the rotated and rebinned image plane (one pixel per lenslet)
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    hires_arrs: list of 4D ndarrays
+        Oversampled PSFLet templates
+    lam_arr: 1D array
+        Wavelengths corresponding to hires_arrs
+    upsample, npix, order, x0:
+        Same as in propagateLenslets
+    nlam: int or tuple of ints
+        Number of sub-wavelengths, for all bins or for each bin
+    dtype: numpy dtype
+        Type used to store the matrix elements
+
+    Returns
+    -------
+    operator: scipy.sparse.csc_matrix
+        Matrix of shape (par.npix**2, nbins * nplane). Column k * nplane + p
+        holds the detector image of a unit flux in pixel p of the flattened
+        image plane of wavelength bin k.
+    '''
+    padding = 10
+    imshape = (par.npix + 2 * padding, par.npix + 2 * padding)
+    nplane = planeshape[0] * planeshape[1]
+    nbins = len(wavelist_endpts) - 1
+    nlams = np.broadcast_to(nlam, (nbins,))
+
+    psftool, allcoef = loadPSFLetPositions(par)
+    xindx, yindx, inplane, planeindx = lensletGrid(planeshape)
+    setkey = templateSetKey(hires_arrs, lam_arr)
+
+    log.info('Building transfer operator for %d wavelength bins' % nbins)
+    blocks = []
+    for k in range(nbins):
+        rows = []
+        cols = []
+        data = []
+        for lam in subWavelengths(wavelist_endpts[k], wavelist_endpts[k + 1], nlams[k]):
+            hires = templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey,
+                                      upsample=upsample, pxperdetpix=par.pxperdetpix)
+            xcen, ycen = lensletLocations(par, lam, xindx, yindx, order, x0,
+                                          psftool, allcoef)
+            xcen = np.reshape(xcen, -1) + padding
+            ycen = np.reshape(ycen, -1) + padding
+            ondet = (xcen > npix // 2) * (xcen < imshape[0] - npix // 2) * \
+                (ycen > npix // 2) * (ycen < imshape[0] - npix // 2)
+            use = np.where(ondet * inplane)[0]
+
+            stamps, iy1, ix1 = makeStamps(hires, xcen[use], ycen[use],
+                                          np.ones(len(use)) / nlams[k], imshape,
+                                          upsample, npix)
+
+            # drop the stamp pixels that fall in the padding
+            indx = _stamp_indices(iy1, ix1, npix, imshape)
+            py = indx // imshape[1] - padding
+            px = indx % imshape[1] - padding
+            keep = (py >= 0) * (py < par.npix) * (px >= 0) * (px < par.npix) * (stamps != 0)
+            rows += [(py * par.npix + px)[keep]]
+            cols += [np.broadcast_to(planeindx[use][:, np.newaxis, np.newaxis],
+                                     stamps.shape)[keep]]
+            data += [stamps[keep]]
+
+        block = sparse.coo_matrix((np.concatenate(data).astype(dtype),
+                                   (np.concatenate(rows), np.concatenate(cols))),
+                                  shape=(par.npix * par.npix, nplane))
+        blocks += [block.tocsc()]
+
+    operator = sparse.hstack(blocks, format='csc')
+    log.info('Transfer operator has %d non-zero elements' % operator.nnz)
+    return operator
+
+
+def getTransferOperator(par, planeshape, wavelist_endpts, hires_arrs, lam_arr,
+                        upsample=3, nlam=10, npix=13, order=3, x0=0.0,
+                        outdir=None):
+    '''
+    Returns the transfer operator, loading it from memory or from disk if
+    it was already computed, or building and saving it otherwise.
+
+    Parameters
+    ----------
+    par: Params instance
+        Parameters instance for crispy
+    planeshape: tuple
+        Shape of the rotated and rebinned image plane (one pixel per lenslet)
+    wavelist_endpts: 1D array
+        Endpoints of the wavelength bins in nm
+    hires_arrs: list of 4D ndarrays
+        Oversampled PSFLet templates
+    lam_arr: 1D array
+        Wavelengths corresponding to hires_arrs
+    upsample, nlam, npix, order, x0:
+        Same as in propagateLenslets. nlam can also be a tuple with one value per bin
+    outdir: string
+        Directory in which operators are stored. Defaults to par.wavecalDir
+
+    Returns
+    -------
+    operator: scipy.sparse.csc_matrix
+        See buildTransferOperator
+    '''
+    if outdir is None:
+        outdir = par.wavecalDir
+    setkey = templateSetKey(hires_arrs, lam_arr)
+    key = transferOperatorKey(par, planeshape, wavelist_endpts, setkey,
+                              upsample, nlam, npix, order, x0)
+    if key in _operators:
+        _operators[key] = _operators.pop(key)
+        return _operators[key]
+
+    filename = os.path.join(outdir, 'transfer_%s.npz' % key)
+    if os.path.isfile(filename):
+        log.info('Loading transfer operator from ' + filename)
+        operator = sparse.load_npz(filename).tocsc()
+    else:
+        operator = buildTransferOperator(par, planeshape, wavelist_endpts,
+                                         hires_arrs, lam_arr, upsample, nlam,
+                                         npix, order, x0)
+        try:
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            tmpname = filename + '.%d.tmp' % os.getpid()
+            with open(tmpname, 'wb') as f:
+                sparse.save_npz(f, operator, compressed=False)
+            os.rename(tmpname, filename)
+            log.info('Saved transfer operator to ' + filename)
+        except BaseException:
+            log.warning('Could not save transfer operator to ' + filename)
+
+    _operators[key] = operator
+    while len(_operators) > _maxoperators:
+        _operators.popitem(last=False)
+    return operator
+
+
+def applyTransferOperator(operator, imagePlanes, npix):
+    '''
+    Propagates a list of lenslet planes through the IFS
+
+    Parameters
+    ----------
+    operator: scipy.sparse.csc_matrix
+        Transfer operator, see buildTransferOperator
+    imagePlanes: list of 2D arrays or 3D array
+        Rotated and rebinned image planes, already multiplied by the bin widths
+    npix: int
+        Number of detector pixels across
+
+    Returns
+    -------
+    polyimage: 3D ndarray
+        Detector image of each wavelength bin
+    '''
+    nbins = len(imagePlanes)
+    polyimage = np.zeros((nbins, npix, npix))
+    for k in range(nbins):
+        polyimage[k] = transferSlice(operator, imagePlanes[k], k, nbins, npix)
+    return polyimage
+
+
+def transferSlice(operator, imagePlane, k, nbins, npix):
+    '''
+    Propagates the lenslet plane of a single wavelength bin through the IFS
+
+    Parameters
+    ----------
+    operator: scipy.sparse.csc_matrix
+        Transfer operator, see buildTransferOperator
+    imagePlane: 2D array
+        Rotated and rebinned image plane of bin k, already multiplied by the bin width
+    k: int
+        Index of the wavelength bin
+    nbins: int
+        Total number of wavelength bins of the operator
+    npix: int
+        Number of detector pixels across
+
+    Returns
+    -------
+    image: 2D ndarray
+        Detector image of wavelength bin k
+    '''
+    nplane = operator.shape[1] // nbins
+    return np.reshape(
+        operator[:, k * nplane:(k + 1) * nplane].dot(np.reshape(imagePlane, -1)),
+        (npix, npix))
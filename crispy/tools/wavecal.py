@@ -1,6 +1,11 @@
 from crispy.tools.locate_psflets import locatePSFlets, PSFLets,fine_transform
 from crispy.tools.image import Image
+from crispy.tools.detutils import getDtype
 from crispy.tools.par_utils import Task, Consumer
+from crispy.tools.templates import templateCache, templateSetKey, templateAnchors
+from crispy.tools.calibration import loadLamsol, loadPolychromeStamps
+from crispy.tools.phasetables import loadPhaseTables, phaseTablesAt
+from crispy.tools.lenslet import adaptiveNlam, addPreblendedStamps, phaseStamps, addStamps
 import matplotlib as mpl
 import numpy as np
 from scipy import signal
@@ -17,7 +22,8 @@ import time
 import multiprocessing
 from scipy import ndimage
 import matplotlib.pyplot as plt
-from crispy.tools.reduction import calculateWaveList
+from crispy.tools.reduction import calculateWaveList, extractionOperators, psfletTags
+from crispy.tools.polychrome import writePolychromeStamps
 from scipy.special import erf
 from shutil import copy2
 import glob
@@ -69,8 +75,16 @@ def do_inspection(par, image, xpos, ypos, lam):
 
 def make_polychrome(lam1, lam2, hires_arrs, lam_arr, psftool, allcoef,
                     xindx, yindx, ydim, xdim, finexy=None, reflam=None, upsample=10, nlam=10,
-                    ):
+                    preblend=False, nphase=None, phaseDir=None):
     """
+    Image of all the PSFLets of the wavelength bin [lam1, lam2], sampled with nlam
+    sub-wavelengths. buildcalibrations chooses nlam for each bin with
+    lenslet.adaptiveNlam if par.lamtol is set. With preblend, the field-dependent
+    templates of each PSFLet are blended once for the bin (see
+    lenslet.addPreblendedStamps), as buildcalibrations does if par.preblend is set.
+    With nphase, the stamps are looked up in sub-pixel phase tables saved in phaseDir
+    (see lenslet.phaseStamps and tools.phasetables), as buildcalibrations does
+    if par.nphase is set.
     """
 
     padding = 10
@@ -82,31 +96,63 @@ def make_polychrome(lam1, lam2, hires_arrs, lam_arr, psftool, allcoef,
     dloglam = (np.log(lam2) - np.log(lam1)) / nlam
     loglam = np.log(lam1) + dloglam / 2. + np.arange(nlam) * dloglam
 
-    for lam in np.exp(loglam):
+    setkey = templateSetKey(hires_arrs, lam_arr)
 
+    if preblend and hires_arrs[0].shape[0] * hires_arrs[0].shape[1] > 1:
+        ################################################################
+        # Blend the four templates nearest to each PSFLet with the
+        # weights of its position at the center of the bin, then stamp
+        # every sub-wavelength with a single interpolation per PSFLet.
         ################################################################
-        # Build the appropriate average hires image by averaging over
-        # the nearest wavelengths.  Then apply a spline filter to the
-        # interpolated high resolution PSFlet images to avoid having
-        # to do this later, saving a factor of a few in time.
+        anchors, allterms = templateAnchors(lam_arr, np.exp(loglam))
+        hires = [templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey) for lam in anchors]
+        positions = []
+        for lam in list(np.exp(loglam)) + [np.sqrt(lam1 * lam2)]:
+            xcen, ycen = psftool.return_locations(lam, allcoef, xindx, yindx)
+            if finexy is not None:
+                xcen += finexy[0]
+                ycen += finexy[1]
+            xcen = np.reshape(xcen, -1) + padding
+            ycen = np.reshape(ycen, -1) + padding
+            ondet = (xcen > npix // 2) * (xcen < image.shape[0] - npix // 2) * \
+                (ycen > npix // 2) * (ycen < image.shape[0] - npix // 2)
+            positions += [(xcen, ycen, ondet)]
+        xblend, yblend = positions.pop()[:2]
+        positions = [pos + (terms,) for pos, terms in zip(positions, allterms)]
+        addPreblendedStamps(image, hires, xblend, yblend, image.shape, positions,
+                            np.ones(xblend.shape) / nlam, upsample, npix)
+        return image[padding:-padding, padding:-padding]
+
+    if nphase:
         ################################################################
+        # Look the stamps of all the PSFLets up in the sub-pixel phase
+        # tables of the templates, one wavelength at a time.
+        ################################################################
+        tables = loadPhaseTables(hires_arrs, lam_arr, np.exp(loglam), upsample, npix, nphase,
+                                 store=phaseDir)[0]
+        for lam in np.exp(loglam):
+            xcen, ycen = psftool.return_locations(lam, allcoef, xindx, yindx)
+            if finexy is not None:
+                xcen += finexy[0]
+                ycen += finexy[1]
+            xcen = np.reshape(xcen, -1) + padding
+            ycen = np.reshape(ycen, -1) + padding
+            use = np.where((xcen > npix // 2) * (xcen < image.shape[0] - npix // 2) *
+                           (ycen > npix // 2) * (ycen < image.shape[0] - npix // 2))[0]
+            stamps, iy1, ix1 = phaseStamps(phaseTablesAt(tables, lam_arr, lam), xcen[use],
+                                           ycen[use], np.ones(len(use)) / nlam, image.shape,
+                                           npix)
+            addStamps(image, stamps, iy1, ix1)
+        return image[padding:-padding, padding:-padding]
 
-        hires = np.zeros((hires_arrs[0].shape))
-        if lam <= np.amin(lam_arr):
-            hires[:] = hires_arrs[0]
-        elif lam >= np.amax(lam_arr):
-            hires[:] = hires_arrs[-1]
-        else:
-            i1 = np.amax(np.arange(len(lam_arr))[np.where(lam > lam_arr)])
-            i2 = i1 + 1
-            hires = hires_arrs[i1] * \
-                (lam - lam_arr[i1]) / (lam_arr[i2] - lam_arr[i1])
-            hires += hires_arrs[i2] * \
-                (lam_arr[i2] - lam) / (lam_arr[i2] - lam_arr[i1])
+    for lam in np.exp(loglam):
+
+        ################################################################
+        # Interpolated, spline-filtered templates at this wavelength,
+        # shared with the other simulation routines.
+        ################################################################
 
-        for i in range(hires.shape[0]):
-            for j in range(hires.shape[1]):
-                hires[i, j] = ndimage.spline_filter(hires[i, j])
+        hires = templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey)
 
         ################################################################
         # Run through lenslet centroids at this wavelength using the
@@ -226,31 +272,15 @@ def make_hires_polychrome(lam1, lam2, hires_arrs, lam_arr, psftool, allcoef,
     dloglam = (np.log(lam2) - np.log(lam1)) / nlam
     loglam = np.log(lam1) + dloglam / 2. + np.arange(nlam) * dloglam
 
+    setkey = templateSetKey(hires_arrs, lam_arr)
     for lam in np.exp(loglam):
 
         ################################################################
-        # Build the appropriate average hires image by averaging over
-        # the nearest wavelengths.  Then apply a spline filter to the
-        # interpolated high resolution PSFlet images to avoid having
-        # to do this later, saving a factor of a few in time.
+        # Interpolated, spline-filtered templates at this wavelength,
+        # shared with the other simulation routines.
         ################################################################
 
-        hires = np.zeros((hires_arrs[0].shape))
-        if lam <= np.amin(lam_arr):
-            hires[:] = hires_arrs[0]
-        elif lam >= np.amax(lam_arr):
-            hires[:] = hires_arrs[-1]
-        else:
-            i1 = np.amax(np.arange(len(lam_arr))[np.where(lam > lam_arr)])
-            i2 = i1 + 1
-            hires = hires_arrs[i1] * \
-                (lam - lam_arr[i1]) / (lam_arr[i2] - lam_arr[i1])
-            hires += hires_arrs[i2] * \
-                (lam_arr[i2] - lam) / (lam_arr[i2] - lam_arr[i1])
-
-        for i in range(hires.shape[0]):
-            for j in range(hires.shape[1]):
-                hires[i, j] = ndimage.spline_filter(hires[i, j])
+        hires = templateCache.get(hires_arrs, lam_arr, lam, setkey=setkey)
 
         ################################################################
         # Run through lenslet centroids at this wavelength using the
@@ -1035,6 +1065,13 @@ def buildcalibrations(
     polychromeRXX.fits: 3D arrays of size Nspec x Npix x Npix with maps of the PSFLets put in their correct
                         positions for each wavelength bins that we want in the output cube. Each PSFLet
                         in each wavelength slice is used for least-squares fitting.
+    polychromeStampsRXX.npy: compact polychrome, one stamp per lenslet and wavelength bin, which
+                        the extraction memory-maps instead of polychromeRXX.fits, see tools.polychrome.
+                        Only written if par.polychromeStamps is set and the stamps keep the PSFLets.
+    polychromeOpsRXX_dyN_*.npy: line spread functions of the least-squares fit of each lenslet,
+                        see reduction.extractionOperators.
+    polychromeTagsRXX_dyN.npy: index of the lenslet of each pixel in each wavelength bin, used to
+                        rebuild the model and residuals of the extraction, see reduction.psfletTags.
     hiresPolychromeRXX.fits: same as polychromeRXX.fits but this time using the high-resolution PSFLets
     PSFLoc.fits:    nsubarr x nsubarr array of 2D high-resolution PSFLets at each location
                     in the detector.
@@ -1201,8 +1238,9 @@ def buildcalibrations(
             
     else:
         log.info("Loading wavelength solution from " + outdir + "lamsol.dat")
-        lam = np.loadtxt(outdir + "lamsol.dat")[:, 0]
-        allcoef = np.loadtxt(outdir + "lamsol.dat")[:, 1:]
+        lamsol = loadLamsol(par, outdir)
+        lam = lamsol[:, 0]
+        allcoef = lamsol[:, 1:]
         
         if finecal:
             ylistarr = fits.getdata(outdir + 'dylistarr.fits')
@@ -1322,6 +1360,8 @@ def buildcalibrations(
         if not makehiresPSFlets:
             hires_arrs = [
                 fits.open(filename)[0].data for filename in hires_list]
+        # templates are stored in single precision, compute in the requested one
+        hires_arrs = [arr.astype(getDtype(par)) for arr in hires_arrs]
 
         lam_midpts, lam_endpts = calculateWaveList(par, lam, method='lstsq')
         Nspec = len(lam_endpts)
@@ -1330,6 +1370,28 @@ def buildcalibrations(
         ypos = []
         good = []
 
+        ##################################################################
+        # Number of sub-wavelengths in each bin, fixed or chosen from the
+        # PSFLet motion across the bin if par.lamtol is set
+        ##################################################################
+        lamtol = getattr(par, 'lamtol', None)
+        polyhdr = fits.Header()
+        if lamtol is None:
+            nlams = [10] * (Nspec - 1)
+            polyhdr.append(('NLAM', 10, 'Sub-wavelengths per bin'), end=True)
+        else:
+            locs = [psftool.return_locations(l, allcoef, xindx, yindx) for l in lam_endpts]
+            nlams = [adaptiveNlam(locs[i][0], locs[i][1], locs[i + 1][0], locs[i + 1][1], lamtol)
+                     for i in range(Nspec - 1)]
+            log.info('Sub-wavelengths per bin: ' + ' '.join(['%d' % n for n in nlams]))
+            polyhdr.append(('LAMTOL', lamtol, 'Max PSFLet shift between sub-wavelengths (px)'),
+                           end=True)
+            for i in range(Nspec - 1):
+                polyhdr.append(('NLAM%03d' % i, nlams[i], 'Sub-wavelengths in bin %d' % i),
+                               end=True)
+
+        preblend = getattr(par, 'preblend', False)
+        nphase = getattr(par, 'nphase', None)
         log.info('Making polychrome cube')
 
         if not parallel:
@@ -1346,7 +1408,11 @@ def buildcalibrations(
                                                                                      xsize,
                                                                                      finexy=finexy,
                                                                                      reflam=lam,
-                                                                                     upsample=upsample,)
+                                                                                     upsample=upsample,
+                                                                                     nlam=nlams[i],
+                                                                                     preblend=preblend,
+                                                                                     nphase=nphase,
+                                                                                     phaseDir=outdir)
                 _x, _y = psftool.return_locations(
                     lam_midpts[i], allcoef, xindx, yindx)
                 if finecal:
@@ -1381,7 +1447,11 @@ def buildcalibrations(
                                    xsize,
                                    finexy,
                                    lam,
-                                   upsample)))
+                                   upsample,
+                                   nlams[i],
+                                   preblend,
+                                   nphase,
+                                   outdir)))
 
             for i in range(ncpus):
                 tasks.put(None)
@@ -1401,7 +1471,7 @@ def buildcalibrations(
 
         log.info('Saving polychrome cube')
         polyimage[polyimage < threshold] = 0.0
-        out = fits.HDUList(fits.PrimaryHDU(polyimage.astype(np.float32)))
+        out = fits.HDUList(fits.PrimaryHDU(polyimage.astype(np.float32), polyhdr))
         out.writeto(outdir + 'polychromeR%d.fits.gz' % (par.R), clobber=True)
         out = fits.HDUList(
             fits.PrimaryHDU(
@@ -1440,6 +1510,15 @@ def buildcalibrations(
     outkey.append(fits.PrimaryHDU(np.asarray(good).astype(np.uint8)))
     outkey.writeto(outdir + 'polychromekeyR%d.fits' % (par.R), clobber=True)
 
+    if makePolychrome:
+        log.info('Saving the extraction operators')
+        extractionOperators(par, polyimage.astype(np.float32))
+        psfletTags(par, (par.npix, par.npix))
+        if getattr(par, 'polychromeStamps', False):
+            log.info('Saving the compact polychrome')
+            if writePolychromeStamps(par) is not None:
+                extractionOperators(par, stamps=loadPolychromeStamps(par))
+
     if makehiresPolychrome:
         log.info('Making high-resolution polychrome cube (can use lots of memory)')
         if not makehiresPSFlets:
@@ -1449,6 +1528,7 @@ def buildcalibrations(
                     'hires_psflets_lam???.fits'))
             hires_arrs = [
                 fits.open(filename)[0].data for filename in hires_list]
+        hires_arrs = [arr.astype(getDtype(par)) for arr in hires_arrs]
 
         lam_midpts, lam_endpts = calculateWaveList(par, lam, method='lstsq')
         Nspec = len(lam_endpts)
@@ -1,4 +1,9 @@
 
+import os
+import time
+import glob
+import re
+import multiprocessing
 import numpy as np
 from crispy.tools.initLogger import getLogger
 log = getLogger('crispy')
@@ -9,7 +14,12 @@ try:
 except:
     import pyfits as fits
 from crispy.tools.locate_psflets import PSFLets
-from crispy.tools.reduction import get_cutout,fit_cutout,calculateWaveList
+from crispy.tools.reduction import get_cutout,fit_cutout,calculateWaveList,lstsqExtract
+from crispy.tools.calibration import loadPolychromeStamps,loadPolychromeKey
+from crispy.tools.polychrome import writePolychromeStamps,writePolychromeFits,polychromeToStamps,stampsToPolychrome
+from crispy.tools.templates import interpolateTemplates,templateAnchors
+from crispy.tools.lenslet import makeStamps,addStamps,addPreblendedStamps,phaseStamps
+from crispy.tools.phasetables import loadPhaseTables,phaseTablesAt
 from crispy.IFS import polychromeIFS
 from crispy.tools.spectrograph import selectKernel,loadKernels
 from crispy.tools.plotting import plotKernels
@@ -235,6 +245,279 @@ def testCreateFlatfield(par,pixsize = 0.1,
     Image(data=detectorFrame,header=par.hdr).write(par.unitTestsOutputs+'/'+outname,clobber=True)
     
 
+def testPolychromeStamps(par,fname,mode='lstsq',dy=3):
+    '''
+    Compares the extraction from the compact polychrome stamps with the dense one
+    
+    Parameters
+    ----------
+    par :   Parameter instance
+        Contains all IFS parameters
+    fname: string
+        Name of the detector frame to extract, e.g. a flatfield of testCreateFlatfield
+    mode: string
+        Extraction mode, 'lstsq' or 'lstsq_conv'
+    dy: int
+        Margin of the cutouts, see reduction.get_cutout
+    
+    Returns
+    -------
+    ratio: float
+        Ratio of the total flux of the cube from the stamps to that from the dense polychrome
+    lensdiff: float
+        Median over the lenslets of the relative difference of their total flux
+    maxdiff: float
+        Largest difference between the two cubes, relative to their peak
+    
+    '''
+    if loadPolychromeStamps(par) is None and writePolychromeStamps(par, dy=dy) is None:
+        log.error('The stamps would lose part of the PSFLets, there is nothing to compare')
+        return None
+
+    usestamps = getattr(par,'polychromeStamps',False)
+    cubes = []
+    for stamps in [False,True]:
+        par.polychromeStamps = stamps
+        im = Image(filename=fname)
+        cubes.append(lstsqExtract(par,par.unitTestsOutputs+'/stamps%s' % (stamps),im,
+                                  smoothandmask=False,dy=dy,mode=mode).data)
+    par.polychromeStamps = usestamps
+    dense,stamps = cubes
+    good = np.isfinite(dense)*np.isfinite(stamps)
+    ratio = np.sum(stamps[good])/np.sum(dense[good])
+    lensflux = np.nansum(dense,axis=0)
+    lensdiff = np.nansum(stamps,axis=0)/np.where(lensflux!=0,lensflux,np.nan)-1
+    lensdiff = np.nanmedian(np.abs(lensdiff))
+    maxdiff = np.amax(np.abs(stamps[good]-dense[good]))/np.amax(np.abs(dense[good]))
+    log.info('Stamps vs dense polychrome: total flux ratio %.4f, median lenslet difference %.4f, '
+             'largest difference %.4f of the peak' % (ratio,lensdiff,maxdiff))
+    Image(data=stamps-dense).write(par.unitTestsOutputs+'/stamps_minus_dense.fits',clobber=True)
+    return ratio,lensdiff,maxdiff
+    
+
+def testPolychromeRoundTrip(par,fname,mode='lstsq',dy=3):
+    '''
+    Converts the dense polychrome of par.wavecalDir to the compact stamps and back to
+    a FITS file, and extracts a frame with both dense polychromes
+    
+    The stamps keep only the lenslets whose PSFLets are all good and the pixels around
+    them, so the round trip is exact on those pixels only, and the extraction only
+    changes next to the lenslets that were dropped.
+    
+    Parameters
+    ----------
+    par :   Parameter instance
+        Contains all IFS parameters
+    fname: string
+        Name of the detector frame to extract, e.g. a flatfield of testCreateFlatfield
+    mode: string
+        Extraction mode, 'lstsq' or 'lstsq_conv'
+    dy: int
+        Margin of the cutouts, see reduction.get_cutout
+    
+    Returns
+    -------
+    polydiff: float
+        Largest difference between the two polychromes on the pixels of the stamps,
+        relative to their peak (zero if the round trip is exact)
+    lost: float
+        Fraction of the flux of the original polychrome outside of the stamps
+    restamped: boolean
+        Whether the round-tripped polychrome gives back the same stamps
+    maxdiff: float
+        Largest difference between the cubes extracted with the two polychromes, relative
+        to their peak, for the lenslets at least two lenslets away from the dropped ones
+    
+    '''
+    filename = writePolychromeStamps(par,dy=dy)
+    if filename is None:
+        log.error('The stamps would lose part of the PSFLets, there is nothing to compare')
+        return None
+    stamps = np.load(filename)
+    roundtrip = writePolychromeFits(par,par.unitTestsOutputs+'/polychromeRoundTrip.fits')
+    
+    filename = par.wavecalDir+'polychromeR%d.fits.gz' % (par.R)
+    if not os.path.isfile(filename):
+        filename = par.wavecalDir+'polychromeR%d.fits' % (par.R)
+    polychromes = [fits.getdata(filename),fits.getdata(roundtrip)]
+    covered = stamps.copy()
+    covered['stamp'] = 1
+    covered = stampsToPolychrome(covered,polychromes[0].shape[1:])>0
+    polydiff = np.amax(np.abs(polychromes[1]-polychromes[0])[covered])/np.amax(np.abs(polychromes[0]))
+    lost = np.sum(polychromes[0][~covered])/np.sum(polychromes[0])
+    
+    lams,xindx,yindx,good = loadPolychromeKey(par)
+    restamps = polychromeToStamps(polychromes[1],xindx,yindx,good,stamps['stamp'].shape[-1])
+    restamped = np.array_equal(restamps,stamps)
+    
+    cubes = []
+    for polychrome in polychromes:
+        im = Image(filename=fname)
+        cubes.append(lstsqExtract(par,par.unitTestsOutputs+'/roundtrip',im,smoothandmask=False,
+                                  dy=dy,mode=mode,specialPolychrome=polychrome).data)
+    original,stamped = cubes
+    inner = ndimage.binary_erosion(np.prod(good,axis=0),np.ones((5,5))).T
+    maxdiff = np.nanmax(np.abs(stamped-original)[:,inner])/np.nanmax(np.abs(original[:,inner]))
+    log.info('Round-tripped vs original polychrome: largest difference %.2e of the peak on the '
+             'stamps, %.4f of the flux outside of them, same stamps: %s; extracted cubes differ '
+             'by %.2e of the peak' % (polydiff,lost,restamped,maxdiff))
+    return polydiff,lost,restamped,maxdiff
+    
+
+def testExtractionScaling(par,fname,nthreads=[1,2,4,8],mode='lstsq',dy=3):
+    '''
+    Measures the time of the extraction of a frame with several numbers of threads
+    
+    Parameters
+    ----------
+    par :   Parameter instance
+        Contains all IFS parameters
+    fname: string
+        Name of the detector frame to extract
+    nthreads: list of ints
+        Numbers of threads to try, see reduction.lstsqExtract
+    mode: string
+        Extraction mode, 'lstsq' or 'lstsq_conv'
+    dy: int
+        Margin of the cutouts, see reduction.get_cutout
+    
+    Returns
+    -------
+    times: list of floats
+        Wall-clock time of the extraction with each number of threads, in seconds
+    
+    '''
+    # a first extraction caches the operators and lenslet tags
+    lstsqExtract(par,par.unitTestsOutputs+'/scaling',Image(filename=fname),smoothandmask=False,
+                 dy=dy,mode=mode)
+    times = []
+    for n in nthreads:
+        im = Image(filename=fname)
+        start = time.time()
+        lstsqExtract(par,par.unitTestsOutputs+'/scaling',im,smoothandmask=False,dy=dy,mode=mode,
+                     nthreads=n)
+        times.append(time.time()-start)
+        log.info('%d threads: %.2f s, speed-up %.2f on %d CPUs' % (n,times[-1],times[0]/times[-1],
+                                                                    multiprocessing.cpu_count()))
+    return times
+    
+
+def testPreblendStamps(par,lam=None,upsample=3,nlens=2000,shape=(1024,1024)):
+    '''
+    Compares the PSFLets stamped from pre-blended templates with those of makeStamps,
+    on the templates of par.wavecalDir and at random positions on the detector
+    
+    Parameters
+    ----------
+    par :   Parameter instance
+        Contains all IFS parameters
+    lam: float
+        Wavelength in nm, by default that of the first template, whose borders are the
+        brightest
+    upsample: int
+        Factor by which the templates are oversampled
+    nlens: int
+        Number of PSFLets
+    shape: tuple
+        Shape of the detector image
+    
+    Returns
+    -------
+    maxdiff: float
+        Largest difference between the two images, relative to their peak
+    ratio: float
+        Ratio of the total fluxes of the two images
+    
+    '''
+    hires_list = np.sort(glob.glob(par.wavecalDir+'hires_psflets_lam???.fits'))
+    hires_arrs = [fits.getdata(filename) for filename in hires_list]
+    lam_arr = np.array([int(re.sub('.*lam','',re.sub('.fits','',filename))) for filename in hires_list])
+    if lam is None:
+        lam = lam_arr[0]
+    npix = hires_arrs[0].shape[2]//upsample
+    
+    # PSFLets anywhere on the detector, with the blending weights of their own position
+    rng = np.random.RandomState(0)
+    xcen = rng.uniform(npix,shape[1]-npix,nlens)
+    ycen = rng.uniform(npix,shape[0]-npix,nlens)
+    vals = np.ones(nlens)
+    
+    hires = interpolateTemplates(hires_arrs,lam_arr,lam)
+    stamps,iy1,ix1 = makeStamps(hires,xcen,ycen,vals,shape,upsample,npix)
+    ref = addStamps(np.zeros(shape),stamps,iy1,ix1)
+    
+    anchors,allterms = templateAnchors(lam_arr,[lam])
+    hires = [interpolateTemplates(hires_arrs,lam_arr,anchor) for anchor in anchors]
+    positions = [(xcen,ycen,np.ones(nlens,dtype=bool),allterms[0])]
+    blended = addPreblendedStamps(np.zeros(shape),hires,xcen,ycen,shape,positions,vals,
+                                  upsample,npix)
+    
+    maxdiff = np.amax(np.abs(blended-ref))/np.amax(ref)
+    ratio = np.sum(blended)/np.sum(ref)
+    log.info('Pre-blended vs makeStamps at %.1f nm: largest difference %.2e of the peak, '
+             'total flux ratio %.6f' % (lam,maxdiff,ratio))
+    return maxdiff,ratio
+    
+
+def testPhaseTables(par,lam=None,nphase=8,upsample=3,nlens=200,shape=(256,256)):
+    '''
+    Builds small sub-pixel phase tables of the templates of par.wavecalDir and compares
+    the stamps looked up in them with those of makeStamps, at random positions
+    
+    Parameters
+    ----------
+    par :   Parameter instance
+        Contains all IFS parameters
+    lam: float
+        Wavelength in nm, by default halfway between the first two templates, so that
+        two tables are blended
+    nphase: int
+        Number of phases per detector pixel, see phasetables.phaseTable
+    upsample: int
+        Factor by which the templates are oversampled
+    nlens: int
+        Number of PSFLets
+    shape: tuple
+        Shape of the detector image
+    
+    Returns
+    -------
+    maxdiff: float
+        Largest difference between the two images, relative to their peak
+    error: float
+        Largest error expected from the tables, see phasetables.phaseTableError
+    ratio: float
+        Ratio of the total fluxes of the two images
+    
+    '''
+    hires_list = np.sort(glob.glob(par.wavecalDir+'hires_psflets_lam???.fits'))
+    hires_arrs = [fits.getdata(filename) for filename in hires_list]
+    lam_arr = np.array([int(re.sub('.*lam','',re.sub('.fits','',filename))) for filename in hires_list])
+    if lam is None:
+        lam = 0.5*(lam_arr[0]+lam_arr[1])
+    npix = hires_arrs[0].shape[2]//upsample
+    
+    rng = np.random.RandomState(0)
+    xcen = rng.uniform(npix,shape[1]-npix,nlens)
+    ycen = rng.uniform(npix,shape[0]-npix,nlens)
+    vals = np.ones(nlens)
+    
+    hires = interpolateTemplates(hires_arrs,lam_arr,lam)
+    stamps,iy1,ix1 = makeStamps(hires,xcen,ycen,vals,shape,upsample,npix)
+    ref = addStamps(np.zeros(shape),stamps,iy1,ix1)
+    
+    tables,errors = loadPhaseTables(hires_arrs,lam_arr,[lam],upsample,npix,nphase)
+    stamps,iy1,ix1 = phaseStamps(phaseTablesAt(tables,lam_arr,lam),xcen,ycen,vals,shape,npix)
+    looked = addStamps(np.zeros(shape),stamps,iy1,ix1)
+    
+    maxdiff = np.amax(np.abs(looked-ref))/np.amax(ref)
+    error = np.nanmax(errors[:,:,1])
+    ratio = np.sum(looked)/np.sum(ref)
+    log.info('Phase tables vs makeStamps at %.1f nm with %d phases: largest difference %.2e '
+             'of the peak (%.2e expected), total flux ratio %.6f' % (lam,nphase,maxdiff,error,ratio))
+    return maxdiff,error,ratio
+    
+
 import scipy
 from scipy.ndimage.filters import gaussian_filter1d
 def testCrosstalk(par,pixsize = 0.1, npix = 512, pixval = 1.,Nspec=45,outname='crosstalk.fits',useQE=True,method='optext'):